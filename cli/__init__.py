@@ -0,0 +1 @@
+# 命令行模块
\ No newline at end of file
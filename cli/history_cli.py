@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+命令行查询传输历史
+默认查询本机接收端的历史记录，--sender 查询发送端的历史记录。例如查询上个月是否接收过某个文件：
+    desktransfer-history --name IMG_0042 --since 2024-05-01 --until 2024-05-31
+"""
+import os
+import sys
+import argparse
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.utils import format_size
+from common.history import HistoryDatabase, RECEIVER_HISTORY_FILE, SENDER_HISTORY_FILE
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="desktransfer-history", description="DeskTransfer 传输历史查询")
+    parser.add_argument("--sender", action="store_true", help="查询发送端的历史记录")
+    parser.add_argument("--db", help="历史数据库文件，默认为本机接收端（或发送端）的数据库")
+    parser.add_argument("--since", help="开始日期或时间，如 2024-05-01 或 \"2024-05-01 08:00:00\"")
+    parser.add_argument("--until", help="结束日期或时间，只有日期时包括当天")
+    parser.add_argument("--peer", help="对方的IP地址（接收端为发送端地址，发送端为接收端地址）")
+    parser.add_argument("--status", help="状态或类型，如 发送成功、发送失败、网络接收、拖拽上传")
+    parser.add_argument("--name", help="按文件名的一部分搜索，不区分大小写")
+    parser.add_argument("--filename", help="按完整文件名查找")
+    parser.add_argument("--hash", help="按内容哈希查找")
+    parser.add_argument("-n", "--limit", type=int, default=50, help="最多显示的记录数，0表示全部，默认50")
+    parser.add_argument("--count", action="store_true", help="只输出符合条件的记录数")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """主函数，每条记录输出一行，字段以制表符分隔，方便其他程序处理"""
+    args = parse_args(argv)
+    db_file = args.db or (SENDER_HISTORY_FILE if args.sender else RECEIVER_HISTORY_FILE)
+    if not os.path.exists(db_file):
+        print(f"历史数据库不存在: {db_file}", file=sys.stderr)
+        return 1
+    
+    history_db = HistoryDatabase(db_file, log=lambda message: print(message, file=sys.stderr))
+    try:
+        history_db.loaded.wait()
+        if history_db.error:
+            print(f"打开历史数据库失败: {str(history_db.error)}", file=sys.stderr)
+            return 1
+        filters = dict(start=args.since, end=args.until, peer=args.peer, status=args.status, name=args.name,
+                       filename=args.filename, digest=args.hash)
+        if args.count:
+            print(history_db.count(**filters))
+            return 0
+        
+        records = history_db.query(limit=args.limit or None, **filters)
+        for record in records:
+            print("\t".join([record["time"], record["filename"], format_size(record["filesize"]),
+                             record["peer"], record["status"], record["path"]]))
+    finally:
+        history_db.close()
+    return 0 if records else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
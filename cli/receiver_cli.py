@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+命令行接收端
+不导入tkinter和PIL，可以在没有图形界面的Linux服务器上作为常驻服务运行，
+与图形界面共用 FileReceiver 和 ReceiverServer
+"""
+import os
+import sys
+import argparse
+import threading
+from datetime import datetime
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import PORT
+from common.utils import create_received_dir
+from common.receiver_core import FileReceiver, MAX_BUFFERED_BYTES
+from common.receiver_server import ReceiverServer, DEFAULT_MAX_CONNECTIONS, SHUTDOWN_TIMEOUT
+from common.content_index import ContentIndex
+from common.resume import ResumeIndex
+from common.history import HistoryDatabase, make_record, RECEIVER_HISTORY_FILE
+
+# 与图形界面相同的数据目录，两者共用内容索引
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+class ConsoleLog:
+    """带时间的日志输出，接收线程和事件循环线程同时写入时不会交错"""
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.lock = threading.Lock()
+    
+    def __call__(self, message):
+        if self.quiet:
+            return
+        with self.lock:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}", flush=True)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="desktransfer-receive", description="DeskTransfer 命令行接收端")
+    parser.add_argument("-d", "--dir", help="接收目录，默认在 data/received 下按时间创建")
+    parser.add_argument("--host", default="", help="监听地址，默认监听所有网卡")
+    parser.add_argument("-p", "--port", type=int, default=PORT, help=f"监听端口，默认 {PORT}")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help=f"同时处理的连接数上限，默认 {DEFAULT_MAX_CONNECTIONS}")
+    parser.add_argument("--shutdown-timeout", type=float, default=SHUTDOWN_TIMEOUT,
+                        help=f"停止时等待正在接收的文件完成的秒数，默认 {SHUTDOWN_TIMEOUT}")
+    parser.add_argument("--max-buffer", type=int, default=MAX_BUFFERED_BYTES // (1024 * 1024),
+                        help=f"所有连接排队等待写盘的数据上限（MB），默认 {MAX_BUFFERED_BYTES // (1024 * 1024)}")
+    parser.add_argument("--index", default=os.path.join(DATA_DIR, "content_index.json"),
+                        help="内容索引文件，用于跳过接收端已有的文件")
+    parser.add_argument("--no-index", action="store_true", help="不使用内容索引")
+    parser.add_argument("--resume-index", default=os.path.join(DATA_DIR, "resume_index.json"),
+                        help="续传记录文件，重启后（包括使用新的接收目录时）继续接收中断的文件")
+    parser.add_argument("--history", default=RECEIVER_HISTORY_FILE,
+                        help="传输历史数据库，默认与图形界面共用")
+    parser.add_argument("--no-history", action="store_true", help="不记录传输历史")
+    parser.add_argument("-q", "--quiet", action="store_true", help="只输出错误")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """主函数，Ctrl+C或SIGTERM时正常停止"""
+    args = parse_args(argv)
+    log = ConsoleLog(args.quiet)
+    
+    if args.dir:
+        save_dir = os.path.abspath(args.dir)
+        os.makedirs(save_dir, exist_ok=True)
+    else:
+        save_dir = create_received_dir(os.path.join(DATA_DIR, "received"))
+    content_index = None if args.no_index else ContentIndex(args.index, log=log)
+    resume_index = ResumeIndex(args.resume_index, log=log)
+    history_db = None if args.no_history else HistoryDatabase(args.history, log=log)
+    
+    def on_file_received(filename, file_path, filesize, peer, digest):
+        if history_db:
+            history_db.append(make_record(filename, filesize, peer, "网络接收", file_path, digest))
+    
+    receiver = FileReceiver(save_dir, log=log, on_file_received=on_file_received, content_index=content_index,
+                            resume_index=resume_index)
+    receiver.max_buffered_bytes = max(1, args.max_buffer) * 1024 * 1024
+    server = ReceiverServer(receiver, host=args.host, port=args.port, max_connections=args.max_connections,
+                            shutdown_timeout=args.shutdown_timeout)
+    
+    log(f"正在启动服务器，端口 {args.port}")
+    log(f"接收目录: {save_dir}")
+    try:
+        server.run(handle_signals=True)
+    except KeyboardInterrupt:
+        # 不支持信号处理的平台（Windows）上Ctrl+C直接中断事件循环
+        pass
+    finally:
+        if history_db:
+            history_db.close()
+    
+    if server.error:
+        print(f"无法启动服务器: {str(server.error)}", file=sys.stderr)
+        return 1
+    log("服务器已停止")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
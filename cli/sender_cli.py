@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+命令行发送端
+不导入tkinter和PIL，可以在脚本和数据导入流程中调用，与图形界面共用 SenderConnection 和 send_batch。
+全部文件发送成功时退出码为0，部分文件失败时为1，无法连接或连接中断时为2
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import PORT
+from common.utils import format_size
+from common.progress import TransferProgress, PROGRESS_POLL_INTERVAL
+from common.sender_core import SenderConnection, send_batch, DEFAULT_STREAM_COUNT, MAX_STREAM_COUNT
+from common.folder_scan import scan_directory
+from common.image_types import filter_images
+
+def collect_files(paths, all_files=False):
+    """展开命令行中的文件和目录（递归），目录中默认只取内容为支持的图片格式的文件"""
+    file_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = [(entry.path, None) for entry in scan_directory(path)]
+            if not all_files:
+                found = filter_images(found)
+            file_paths.extend(file_path for file_path, _ in found)
+        else:
+            # 明确指定的文件照常发送，不存在时由发送过程报告错误
+            file_paths.append(path)
+    return file_paths
+
+def report_progress(progress, done):
+    """在终端中原地刷新进度，直到done被设置"""
+    while not done.wait(PROGRESS_POLL_INTERVAL / 1000):
+        if progress.active:
+            sys.stderr.write(f"\r{progress.snapshot().describe('发送')}\033[K")
+            sys.stderr.flush()
+    sys.stderr.write("\r\033[K")
+    sys.stderr.flush()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="desktransfer-send", description="DeskTransfer 命令行发送端")
+    parser.add_argument("host", help="接收端IP地址")
+    parser.add_argument("paths", nargs="+", help="要发送的文件或目录")
+    parser.add_argument("-p", "--port", type=int, default=PORT, help=f"接收端端口，默认 {PORT}")
+    parser.add_argument("-s", "--streams", type=int, default=DEFAULT_STREAM_COUNT,
+                        help=f"并行连接数（1-{MAX_STREAM_COUNT}），默认 {DEFAULT_STREAM_COUNT}")
+    parser.add_argument("--all-files", action="store_true", help="目录中的所有文件都发送，不只是图片")
+    parser.add_argument("--no-delta", action="store_true", help="不使用增量传输")
+    parser.add_argument("-q", "--quiet", action="store_true", help="只输出错误")
+    args = parser.parse_args(argv)
+    if not 1 <= args.streams <= MAX_STREAM_COUNT:
+        parser.error(f"并行连接数必须在 1 到 {MAX_STREAM_COUNT} 之间")
+    return args
+
+def main(argv=None):
+    """主函数"""
+    args = parse_args(argv)
+    log = (lambda message: None) if args.quiet else (lambda message: print(message, flush=True))
+    
+    file_paths = collect_files(args.paths, args.all_files)
+    if not file_paths:
+        print("没有要发送的文件", file=sys.stderr)
+        return 1
+    
+    connection = SenderConnection(args.host, args.port, client_name="DeskTransfer CLI")
+    try:
+        connection.connect()
+    except Exception as e:
+        print(f"无法连接到接收端 {args.host}:{args.port}: {str(e)}", file=sys.stderr)
+        return 2
+    log(f"已连接到接收端: {connection.receiver_name}")
+    
+    failed = []
+    
+    def on_file_done(file_path, filesize, error):
+        if error is None:
+            log(f"文件发送完成: {os.path.basename(file_path)} ({format_size(filesize)})")
+        else:
+            failed.append(file_path)
+            print(f"文件发送失败: {file_path} - {str(error)}", file=sys.stderr)
+    
+    total_bytes = 0
+    for file_path in file_paths:
+        try:
+            total_bytes += os.path.getsize(file_path)
+        except OSError:
+            pass
+    progress = TransferProgress()
+    progress.reset(len(file_paths), total_bytes)
+    
+    # 只在交互式终端中显示进度行，重定向到文件时不输出
+    done = threading.Event()
+    reporter = None
+    if not args.quiet and sys.stderr.isatty():
+        reporter = threading.Thread(target=report_progress, args=(progress, done), daemon=True)
+        reporter.start()
+    
+    start_time = time.time()
+    try:
+        send_batch(connection, file_paths, stream_count=args.streams, progress=progress,
+                   on_file_done=on_file_done, log=log, delta=not args.no_delta)
+    except KeyboardInterrupt:
+        print("已中断，再次发送时已接收的部分将从断点继续传输", file=sys.stderr)
+        return 2
+    except Exception as e:
+        print(f"发送失败: {str(e)}", file=sys.stderr)
+        if connection.broken:
+            print("再次发送时已接收的部分将从断点继续传输", file=sys.stderr)
+        return 2
+    finally:
+        progress.finish()
+        done.set()
+        if reporter:
+            reporter.join()
+        connection.close()
+    
+    elapsed = time.time() - start_time
+    log(f"发送完成: {len(file_paths) - len(failed)}/{len(file_paths)} 个文件，用时 {elapsed:.1f} 秒")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""
+自适应块大小
+根据实测吞吐量和往返时延动态调整发送端每次发送的数据块大小
+"""
+from common.protocol import MIN_CHUNK_SIZE, DEFAULT_CHUNK_SIZE
+
+# 每发送一个块期望花费的时间（秒），块越大每块的固定开销占比越小，但进度和取消响应越慢
+TARGET_CHUNK_INTERVAL = 0.02
+# 累计发送超过该时长后才重新估算一次吞吐量
+SAMPLE_INTERVAL = 0.25
+# 吞吐量指数平滑系数
+SMOOTHING = 0.3
+
+class ChunkSizer:
+    """发送块大小调节器
+    
+    目标块大小 = 平滑后的吞吐量 × max(TARGET_CHUNK_INTERVAL, RTT)，
+    取不超过目标值的2的幂，并限制在 [MIN_CHUNK_SIZE, 协商的最大块大小] 之内。
+    """
+    def __init__(self, max_chunk_size, rtt=0.0, initial_size=DEFAULT_CHUNK_SIZE):
+        self.max_chunk_size = max(MIN_CHUNK_SIZE, max_chunk_size)
+        self.rtt = rtt
+        self.chunk_size = self._clamp(initial_size)
+        self.throughput = 0.0  # 字节/秒
+        self.sample_bytes = 0
+        self.sample_time = 0.0
+    
+    def _clamp(self, size):
+        """取不超过size的2的幂，并限制在允许范围内"""
+        size = max(MIN_CHUNK_SIZE, min(int(size), self.max_chunk_size))
+        power = MIN_CHUNK_SIZE
+        while power * 2 <= size:
+            power *= 2
+        return power
+    
+    def record(self, nbytes, elapsed):
+        """记录一次发送的字节数和耗时，块大小发生变化时返回True"""
+        self.sample_bytes += nbytes
+        self.sample_time += elapsed
+        if self.sample_time < SAMPLE_INTERVAL:
+            return False
+        
+        rate = self.sample_bytes / self.sample_time
+        self.sample_bytes = 0
+        self.sample_time = 0.0
+        if self.throughput:
+            self.throughput = SMOOTHING * rate + (1 - SMOOTHING) * self.throughput
+        else:
+            self.throughput = rate
+        
+        new_size = self._clamp(self.throughput * max(TARGET_CHUNK_INTERVAL, self.rtt))
+        if new_size == self.chunk_size:
+            return False
+        self.chunk_size = new_size
+        return True
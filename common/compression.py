@@ -0,0 +1,95 @@
+"""
+传输压缩
+握手时协商双方都可用的压缩算法，发送端对每个文件先试压第一块数据，
+能明显变小（如BMP、未压缩的TIFF）时才压缩数据帧，已压缩的格式（JPEG、PNG、WebP）照常发送
+"""
+import zlib
+
+# zstd 和 lz4 为可选依赖，未安装时使用标准库的 zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODEC_ZSTD = "zstd"
+CODEC_LZ4 = "lz4"
+CODEC_ZLIB = "zlib"
+
+# 压缩级别：只针对局域网传输，优先速度
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 1
+# 试压的样本大小，小于 MIN_COMPRESS_SIZE 的文件不压缩
+SAMPLE_SIZE = 64 * 1024
+MIN_COMPRESS_SIZE = 4 * 1024
+# 样本压缩后不大于原大小的该比例时才压缩整个文件
+COMPRESS_RATIO_THRESHOLD = 0.9
+
+def available_codecs():
+    """本机可用的压缩算法，按优先顺序排列"""
+    codecs = []
+    if zstandard is not None:
+        codecs.append(CODEC_ZSTD)
+    if lz4 is not None:
+        codecs.append(CODEC_LZ4)
+    codecs.append(CODEC_ZLIB)
+    return codecs
+
+def negotiate_codec(remote_codecs):
+    """按对方的优先顺序选择双方都可用的压缩算法，没有时返回None"""
+    local_codecs = available_codecs()
+    for codec in remote_codecs or []:
+        if codec in local_codecs:
+            return codec
+    return None
+
+class Codec:
+    """一种压缩算法的压缩和解压
+    
+    zstd的压缩器和解压器对象不能在线程间同时使用，每条连接各自创建一个Codec。
+    每个数据帧独立压缩，接收端不需要保存帧之间的状态。
+    """
+    def __init__(self, name):
+        if name not in available_codecs():
+            raise ValueError(f"不支持的压缩算法: {name}")
+        self.name = name
+        if name == CODEC_ZSTD:
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            self.decompressor = zstandard.ZstdDecompressor()
+    
+    def compress(self, data):
+        """压缩一个数据帧的负载"""
+        if self.name == CODEC_ZSTD:
+            return self.compressor.compress(data)
+        if self.name == CODEC_LZ4:
+            return lz4.frame.compress(data)
+        return zlib.compress(data, ZLIB_LEVEL)
+    
+    def decompress(self, data, max_size):
+        """解压一个数据帧的负载，解压后超过max_size时视为无效数据"""
+        if self.name == CODEC_ZSTD:
+            content_size = zstandard.frame_content_size(data)
+            if content_size < 0 or content_size > max_size:
+                raise ValueError("压缩数据帧的大小无效")
+            result = self.decompressor.decompress(data)
+        elif self.name == CODEC_LZ4:
+            decompressor = lz4.frame.LZ4FrameDecompressor()
+            result = decompressor.decompress(data, max_length=max_size)
+            if not decompressor.eof:
+                raise ValueError("压缩数据帧的大小无效")
+        else:
+            decompressor = zlib.decompressobj()
+            result = decompressor.decompress(data, max_size)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError("压缩数据帧的大小无效")
+        return result
+    
+    def worth_compressing(self, sample):
+        """根据文件开头的样本判断是否值得压缩"""
+        if len(sample) < MIN_COMPRESS_SIZE:
+            return False
+        return len(self.compress(sample)) <= len(sample) * COMPRESS_RATIO_THRESHOLD
@@ -0,0 +1,221 @@
+"""
+内容索引
+按文件大小和内容哈希查找接收端已有的文件，重复发送的文件直接在本地复制
+"""
+import os
+import json
+import hashlib
+import threading
+
+# 计算哈希时每次读取的字节数
+HASH_READ_SIZE = 1024 * 1024
+# BLAKE2b 摘要长度（字节），再加上文件大小比较，足以区分不同的文件
+DIGEST_SIZE = 16
+# 索引文件的行数超过有效记录数的这个倍数（且超过 COMPACT_MIN_LINES）时，加载后重写一次
+COMPACT_RATIO = 2
+COMPACT_MIN_LINES = 1000
+
+def new_hasher():
+    """创建内容哈希对象，发送端和接收端必须使用相同的算法"""
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+def file_digest(file_path):
+    """计算文件内容的哈希（十六进制字符串）"""
+    hasher = new_hasher()
+    buffer = bytearray(HASH_READ_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            hasher.update(view[:count])
+    return hasher.hexdigest()
+
+# 发送端的哈希缓存：(路径, 大小, 修改时间) -> 哈希，重复发送同一批文件时不必重新读取
+_digest_cache = {}
+_digest_cache_lock = threading.Lock()
+
+def cached_file_digest(file_path):
+    """计算文件哈希，文件未修改时使用缓存结果"""
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _digest_cache_lock:
+        digest = _digest_cache.get(key)
+    if digest is None:
+        digest = file_digest(file_path)
+        with _digest_cache_lock:
+            _digest_cache[key] = digest
+    return digest
+
+class ContentIndex:
+    """接收端的内容索引
+    
+    记录接收过的每个文件的路径、大小、修改时间和内容哈希，不随每次启动新建的接收目录变化。
+    接收时不计算哈希，只有大小相同的文件被查询时才计算并缓存，文件被修改或删除后对应记录自动失效。
+    
+    索引文件为只追加的JSON Lines：每行是一条记录的新值（{"path", "size", "mtime", "hash"}），
+    只有 path 的行表示删除，save() 只追加上次保存之后的变化，不随索引变大而重写整个文件。
+    加载时按顺序重放，失效的行过多时重写一次。保存失败时通过 log(message) 报告。
+    """
+    def __init__(self, index_file, log=None):
+        self.index_file = index_file
+        self.log = log or print
+        self.lock = threading.Lock()
+        self.entries = {}  # 路径 -> {"size": ..., "mtime": ..., "hash": ...}
+        self.by_size = {}  # 大小 -> 路径集合
+        self.by_name = {}  # 文件名 -> 路径集合
+        # 还没有写入索引文件的变化
+        self.pending = []
+        self.load()
+    
+    def load(self):
+        """加载索引，兼容旧版本整个文件为一个JSON对象的格式"""
+        lines = 0
+        legacy = False
+        with self.lock:
+            self.entries = {}
+            self.by_size = {}
+            self.by_name = {}
+            self.pending = []
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # 写入时中断留下的不完整的行
+                            continue
+                        lines += 1
+                        if "path" not in record:
+                            # 旧版本：路径 -> 记录
+                            legacy = True
+                            for path, entry in record.items():
+                                self._remove(path)
+                                self._set(path, entry)
+                            continue
+                        path = record.pop("path")
+                        self._remove(path)
+                        if record:
+                            self._set(path, record)
+            except OSError:
+                return
+        if legacy or lines > max(COMPACT_MIN_LINES, COMPACT_RATIO * len(self.entries)):
+            self.compact()
+    
+    def compact(self):
+        """按当前的记录重写索引文件，去掉被覆盖和删除的行"""
+        with self.lock:
+            records = [dict(entry, path=path) for path, entry in self.entries.items()]
+            self.pending = []
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+            temp_path = self.index_file + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(temp_path, self.index_file)
+        except OSError as e:
+            self.log(f"保存内容索引失败: {e}")
+    
+    def save(self):
+        """把上次保存之后的变化追加到索引文件"""
+        with self.lock:
+            if not self.pending:
+                return
+            records = self.pending
+            self.pending = []
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+            with open(self.index_file, 'a', encoding='utf-8') as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        except OSError as e:
+            self.log(f"保存内容索引失败: {e}")
+    
+    def add(self, file_path, digest=None):
+        """记录一个接收完成的文件，digest未知时在查询时再计算"""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return
+        self.update(file_path, {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest})
+    
+    def has_size(self, filesize):
+        """是否有同样大小的文件"""
+        with self.lock:
+            return filesize in self.by_size
+    
+    def find(self, filesize, digest):
+        """查找大小和哈希都相同的文件，返回其路径，没有时返回None"""
+        with self.lock:
+            candidates = [(path, dict(self.entries[path])) for path in self.by_size.get(filesize, ())]
+        
+        for path, entry in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.discard(path)
+                continue
+            if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime"]:
+                # 文件已被修改，重新计算
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": None}
+                if stat.st_size != filesize:
+                    self.update(path, entry)
+                    continue
+            if entry["hash"] is None:
+                try:
+                    entry["hash"] = file_digest(path)
+                except OSError:
+                    self.discard(path)
+                    continue
+                self.update(path, entry)
+            if entry["hash"] == digest:
+                return path
+        return None
+    
+    def find_by_name(self, filename, exclude=()):
+        """查找最近接收的同名文件，作为增量传输的旧文件，返回其路径，没有时返回None"""
+        with self.lock:
+            candidates = sorted(((self.entries[path]["mtime"], path) for path in self.by_name.get(filename, ())
+                                 if path not in exclude), reverse=True)
+        for _, path in candidates:
+            if os.path.isfile(path):
+                return path
+            self.discard(path)
+        return None
+    
+    def update(self, file_path, entry):
+        """更新一条记录"""
+        with self.lock:
+            self._remove(file_path)
+            self._set(file_path, entry)
+            self.pending.append(dict(entry, path=file_path))
+    
+    def discard(self, file_path):
+        """删除失效的记录"""
+        with self.lock:
+            if self._remove(file_path):
+                self.pending.append({"path": file_path})
+    
+    def _set(self, file_path, entry):
+        """添加记录（调用方持有锁）"""
+        self.entries[file_path] = entry
+        self.by_size.setdefault(entry["size"], set()).add(file_path)
+        self.by_name.setdefault(os.path.basename(file_path), set()).add(file_path)
+    
+    def _remove(self, file_path):
+        """删除记录（调用方持有锁），返回记录是否存在"""
+        entry = self.entries.pop(file_path, None)
+        if entry is None:
+            return False
+        paths = self.by_size.get(entry["size"])
+        if paths:
+            paths.discard(file_path)
+            if not paths:
+                del self.by_size[entry["size"]]
+        names = self.by_name.get(os.path.basename(file_path))
+        if names:
+            names.discard(file_path)
+            if not names:
+                del self.by_name[os.path.basename(file_path)]
+        return True
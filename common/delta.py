@@ -0,0 +1,253 @@
+"""
+增量传输
+rsync式的块级差异：接收端为已有的旧文件计算块签名（弱校验和 + 强哈希），
+发送端在新文件中滚动查找相同的块，只发送变化的部分和块引用
+"""
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+
+from common.file_writer import FileWriter, WRITE_BUFFER_SIZE
+
+# 新旧文件都不小于该大小时才使用增量传输
+DELTA_MIN_SIZE = 64 * 1024
+# 块大小范围，实际取接近旧文件大小平方根的2的幂
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 64 * 1024
+# 强哈希长度（字节）
+STRONG_DIGEST_SIZE = 12
+# 签名中每个块的条目：弱校验和(4字节) + 强哈希
+SIGNATURE_ENTRY = struct.Struct(f'!I{STRONG_DIGEST_SIZE}s')
+# 一个文件的签名数据（作为一个数据帧发送）的最大长度，更大的文件不使用增量传输
+MAX_SIGNATURE_SIZE = 64 * 1024 * 1024
+# 块引用（数据帧带 FRAME_FLAG_COPY 标志时的负载）：起始块序号(8字节) + 块数(4字节)
+COPY_OP = struct.Struct('!QI')
+# 单个文件逐字节滚动查找的字节数上限，超过后只在块边界上查找，
+# 避免完全不同的文件在纯Python的滚动计算上花费过多时间
+ROLLING_BUDGET = 1024 * 1024
+# 一次从旧文件复制的最大字节数
+COPY_READ_SIZE = 1024 * 1024
+# 新文件与旧文件路径相同时先写入临时文件，完成后再替换
+DELTA_TEMP_SUFFIX = ".delta.tmp"
+
+# Adler-32 的模数，弱校验和使用 zlib.adler32 以便在C中计算整块的值
+_ADLER_MOD = 65521
+
+def choose_block_size(filesize):
+    """根据旧文件大小选择块大小"""
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * block_size < filesize:
+        block_size *= 2
+    return block_size
+
+def signature_size(filesize):
+    """旧文件的签名数据长度"""
+    return filesize // choose_block_size(filesize) * SIGNATURE_ENTRY.size
+
+def strong_digest(data):
+    """块的强哈希"""
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+def compute_signature(file_path):
+    """计算旧文件的块签名，返回 (块大小, 签名数据)
+    
+    只为完整的块计算签名，末尾不足一块的部分总是作为新数据发送。
+    """
+    block_size = choose_block_size(os.path.getsize(file_path))
+    entries = []
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) < block_size:
+                break
+            entries.append(SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_digest(block)))
+    return block_size, b''.join(entries)
+
+def parse_signature(payload):
+    """解析签名，返回 {弱校验和: [(块序号, 强哈希), ...]}"""
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(payload)):
+        table.setdefault(weak, []).append((index, strong))
+    return table
+
+def generate_delta(data, block_size, table):
+    """对比新文件内容和旧文件的签名，依次生成差异操作
+    
+    data 为新文件内容（bytes、mmap或memoryview），生成的操作为
+    ("copy", 起始块序号, 块数) 或 ("literal", 起始位置, 结束位置)，相邻的块引用会合并。
+    """
+    view = memoryview(data)
+    size = len(view)
+    position = 0
+    literal_start = 0
+    pending_copy = None  # [起始块序号, 块数]
+    rolling_budget = ROLLING_BUDGET
+    
+    def match(weak, start):
+        candidates = table.get(weak)
+        if not candidates:
+            return None
+        digest = strong_digest(view[start:start + block_size])
+        for index, strong in candidates:
+            if strong == digest:
+                return index
+        return None
+    
+    while position + block_size <= size:
+        weak = zlib.adler32(view[position:position + block_size])
+        index = match(weak, position)
+        
+        if index is None and rolling_budget > 0:
+            # 逐字节滚动查找下一个相同的块，最多查找一个块的长度
+            a, b = weak & 0xffff, weak >> 16
+            limit = min(size - block_size, position + block_size)
+            start = position
+            while position < limit:
+                out_byte = data[position]
+                in_byte = data[position + block_size]
+                a = (a - out_byte + in_byte) % _ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+                position += 1
+                weak = (b << 16) | a
+                if weak in table:
+                    index = match(weak, position)
+                    if index is not None:
+                        break
+            rolling_budget -= position - start
+            if index is None:
+                if position == start:
+                    # 已经是最后一个完整的窗口
+                    break
+                continue
+        elif index is None:
+            position += block_size
+            continue
+        
+        if position > literal_start:
+            if pending_copy:
+                yield ("copy", pending_copy[0], pending_copy[1])
+                pending_copy = None
+            yield ("literal", literal_start, position)
+        if pending_copy and pending_copy[0] + pending_copy[1] == index:
+            pending_copy[1] += 1
+        else:
+            if pending_copy:
+                yield ("copy", pending_copy[0], pending_copy[1])
+            pending_copy = [index, 1]
+        position += block_size
+        literal_start = position
+    
+    if pending_copy:
+        yield ("copy", pending_copy[0], pending_copy[1])
+    if literal_start < size:
+        yield ("literal", literal_start, size)
+
+def map_file(f):
+    """以只读方式映射文件，空文件返回空bytes"""
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class DeltaPatcher:
+    """接收端根据块引用从旧文件复制数据"""
+    def __init__(self, base_path, block_size):
+        self.base_path = base_path
+        self.block_size = block_size
+        self.base_file = open(base_path, 'rb')
+        self.buffer = bytearray(COPY_READ_SIZE)
+    
+    def copy(self, payload, write):
+        """处理一个块引用，把旧文件中对应的数据交给write，返回复制的字节数"""
+        index, count = COPY_OP.unpack(payload)
+        self.base_file.seek(index * self.block_size)
+        remaining = count * self.block_size
+        view = memoryview(self.buffer)
+        copied = 0
+        while remaining > 0:
+            read = self.base_file.readinto(view[:min(remaining, len(self.buffer))])
+            if not read:
+                raise ValueError("块引用超出旧文件范围")
+            write(view[:read])
+            remaining -= read
+            copied += read
+        return copied
+    
+    def close(self):
+        """关闭旧文件"""
+        self.base_file.close()
+
+class DeltaWriter:
+    """增量传输的写入器
+    
+    新数据直接写入，块引用从旧文件复制，两者都按顺序写到目标文件。
+    目标文件就是旧文件本身时先写入临时文件，关闭时再替换。
+    """
+    def __init__(self, path, filesize, base_path, block_size, buffer_size=WRITE_BUFFER_SIZE, preallocate=True,
+                 hasher=None):
+        self.path = path
+        self.filesize = filesize
+        self.temp_path = None
+        if os.path.exists(path) and os.path.samefile(path, base_path):
+            self.temp_path = path + DELTA_TEMP_SUFFIX
+        self.patcher = DeltaPatcher(base_path, block_size)
+        try:
+            self.writer = FileWriter(self.temp_path or path, filesize, buffer_size=buffer_size, preallocate=preallocate,
+                                     hasher=hasher)
+        except Exception:
+            self.patcher.close()
+            raise
+    
+    @property
+    def written(self):
+        """已写入的字节数"""
+        return self.writer.written
+    
+    @property
+    def remaining(self):
+        """还没有写入的字节数"""
+        return self.writer.remaining
+    
+    @property
+    def hasher(self):
+        """写入内容的哈希"""
+        return self.writer.hasher
+    
+    def write(self, data):
+        """写入一块新数据"""
+        self.writer.write(data)
+    
+    def copy(self, payload):
+        """处理一个块引用，返回从旧文件复制的字节数"""
+        return self.patcher.copy(payload, self.writer.write)
+    
+    def close(self, sync=True):
+        """关闭文件，需要时用临时文件替换旧文件"""
+        try:
+            self.writer.close(sync)
+        finally:
+            self.patcher.close()
+        if self.temp_path:
+            os.replace(self.temp_path, self.path)
+    
+    def abort(self):
+        """传输中断时关闭文件，删除临时文件"""
+        try:
+            self.writer.abort()
+        finally:
+            self.patcher.close()
+        if self.temp_path:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+    
+    def discard(self):
+        """校验失败，删除写入的文件，旧文件保持不变"""
+        self.abort()
+        if not self.temp_path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,73 @@
+"""
+发送端的待发送文件列表
+保持添加顺序，用集合判断是否已经添加，每个文件只在添加时读取一次大小和修改时间，
+总大小随添加和移除增量更新，选择几万个文件时也不需要反复读取文件信息
+"""
+import os
+import stat
+
+class FileSelection:
+    """待发送的文件列表
+    
+    可以像列表一样遍历、取长度和判断是否包含某个路径。只在界面线程中修改。
+    """
+    def __init__(self):
+        self.paths = []
+        self.path_set = set()
+        # 路径 -> (大小, 修改时间)，只保存列表中的文件
+        self.stats = {}
+        self.total_size = 0
+    
+    def __len__(self):
+        return len(self.paths)
+    
+    def __iter__(self):
+        return iter(self.paths)
+    
+    def __contains__(self, file_path):
+        return file_path in self.path_set
+    
+    def add(self, file_path, st=None):
+        """添加一个文件，已经在列表中、不是普通文件或无法读取文件信息时返回False
+        
+        st 为已经读取的文件信息（如目录扫描时得到的），省去一次stat。
+        """
+        if file_path in self.path_set:
+            return False
+        if st is None:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        self.paths.append(file_path)
+        self.path_set.add(file_path)
+        self.stats[file_path] = (st.st_size, st.st_mtime)
+        self.total_size += st.st_size
+        return True
+    
+    def add_stats(self, found):
+        """添加 (路径, 文件信息) 列表中的文件，返回实际添加的文件列表"""
+        return [file_path for file_path, st in found if self.add(file_path, st)]
+    
+    def remove_at(self, indices):
+        """按位置移除文件（如列表框中选中的行）"""
+        removed = set(indices)
+        if not removed:
+            return
+        kept = []
+        for index, file_path in enumerate(self.paths):
+            if index in removed:
+                self.path_set.discard(file_path)
+                self.total_size -= self.stats.pop(file_path)[0]
+            else:
+                kept.append(file_path)
+        self.paths = kept
+    
+    def clear(self):
+        """清空列表"""
+        self.paths = []
+        self.path_set.clear()
+        self.stats.clear()
+        self.total_size = 0
@@ -0,0 +1,291 @@
+"""
+文件写入
+接收端为每个文件持有一个写入器，避免每个数据块都重新打开文件
+"""
+import os
+import threading
+
+# 默认写缓冲区大小
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class FileWriter:
+    """接收文件写入器
+    
+    收到FILE_INFO时创建，在整个文件传输期间保持文件打开，
+    收到FILE_END时刷新缓冲区、同步到磁盘并关闭。
+    指定hasher时在写入的同时计算内容哈希，用于与FILE_END中的哈希比较。
+    """
+    def __init__(self, path, filesize=0, buffer_size=WRITE_BUFFER_SIZE, preallocate=True, hasher=None):
+        self.path = path
+        self.filesize = filesize
+        self.written = 0
+        self.hasher = hasher
+        self.file = open(path, 'wb', buffering=buffer_size)
+        
+        # 按声明的大小预分配磁盘空间，减少碎片和写入时的元数据更新
+        if preallocate and filesize > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.file.fileno(), 0, filesize)
+            except OSError:
+                # 部分文件系统不支持预分配，忽略即可
+                pass
+    
+    @property
+    def remaining(self):
+        """还没有收到的字节数"""
+        return self.filesize - self.written
+    
+    def write(self, data):
+        """写入一块数据，超出FILE_INFO中声明的大小时抛出ValueError"""
+        if self.written + len(data) > self.filesize:
+            raise ValueError("文件数据超出声明的大小")
+        if self.hasher:
+            self.hasher.update(data)
+        self.file.write(data)
+        self.written += len(data)
+    
+    def close(self, sync=True):
+        """刷新并关闭文件，sync为True时先同步到磁盘"""
+        if self.file.closed:
+            return
+        try:
+            self.file.flush()
+            if self.written < self.filesize:
+                # 去掉预分配但没有写入的部分
+                self.file.truncate(self.written)
+            if sync:
+                os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+    
+    def abort(self):
+        """传输中断时关闭文件，不做磁盘同步"""
+        self.close(sync=False)
+    
+    def discard(self):
+        """校验失败，关闭并删除文件"""
+        self.abort()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class StripedFile:
+    """条带传输的目标文件
+    
+    同一个文件的多个条带经由不同连接并发到达，各连接通过 stripe() 获得
+    自己的 StripeWriter，用 os.pwrite 写到各自的偏移，互不影响文件位置。
+    所有条带的数据都写满后 complete 为True。文件由最后一个结束的条带关闭：失败的条带可能在其他条带
+    到达之前就结束，因此要等覆盖整个文件的条带都结束后才关闭，之后到达的条带仍可以写入。
+    始终没有到达的条带由会话结束时关闭（FileReceiver.leave_session）。
+    resume_from 大于0时在已有的部分文件上续传，前 resume_from 字节视为已接收。
+    """
+    def __init__(self, path, filesize, preallocate=True, resume_from=0):
+        self.path = path
+        self.filesize = filesize
+        self.resume_from = resume_from
+        self.received = resume_from
+        # 已结束（成功或失败）的条带覆盖的字节数
+        self.finished_bytes = resume_from
+        self.open_stripes = 0
+        self.failed = False
+        # 已结束条带的 (偏移, 写入字节数)，用于计算中断时可续传的位置
+        self.finished_stripes = []
+        self.lock = threading.Lock()
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if not resume_from:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o666)
+        
+        if preallocate and filesize > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, filesize)
+            except OSError:
+                pass
+    
+    @property
+    def complete(self):
+        """所有条带的数据是否都已写入"""
+        return not self.failed and self.received >= self.filesize
+    
+    def stripe(self, offset, length, hasher=None):
+        """为一个条带创建写入器"""
+        if offset < 0 or offset + length > self.filesize:
+            raise ValueError(f"条带范围超出文件大小: {offset}+{length}")
+        with self.lock:
+            if self.fd is None:
+                raise ValueError(f"文件的其他条带接收失败: {os.path.basename(self.path)}")
+            self.open_stripes += 1
+        return StripeWriter(self, offset, length, hasher)
+    
+    def pwrite(self, data, offset):
+        """把data完整写到offset处"""
+        view = memoryview(data)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                # Windows没有pwrite，定位和写入需要加锁
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+    
+    def stripe_finished(self, stripe, ok):
+        """条带结束，返回True表示调用方是最后一个条带，应负责关闭文件"""
+        with self.lock:
+            self.open_stripes -= 1
+            self.finished_stripes.append((stripe.offset, stripe.written))
+            self.finished_bytes += stripe.length
+            if ok and stripe.written == stripe.length:
+                self.received += stripe.written
+            else:
+                self.failed = True
+            return self.open_stripes == 0 and self.finished_bytes >= self.filesize
+    
+    def contiguous_bytes(self):
+        """从文件开头起连续写入的字节数，即中断后可以续传的位置"""
+        position = self.resume_from
+        for offset, written in sorted(self.finished_stripes):
+            if offset > position:
+                break
+            position = max(position, offset + written)
+        return position
+    
+    def close(self, sync=True):
+        """同步到磁盘并关闭文件"""
+        if self.fd is None:
+            return
+        try:
+            if sync and self.complete:
+                os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+class StripeWriter:
+    """条带写入器，接口与 FileWriter 一致"""
+    def __init__(self, striped_file, offset, length, hasher=None):
+        self.striped_file = striped_file
+        self.offset = offset
+        self.length = length
+        self.written = 0
+        self.hasher = hasher
+    
+    @property
+    def remaining(self):
+        """条带中还没有收到的字节数"""
+        return self.length - self.written
+    
+    def write(self, data):
+        """把一块数据写到条带中的下一个位置"""
+        if self.written + len(data) > self.length:
+            raise ValueError("条带数据超出声明的长度")
+        if self.hasher:
+            self.hasher.update(data)
+        self.striped_file.pwrite(data, self.offset + self.written)
+        self.written += len(data)
+    
+    def close(self, sync=True):
+        """条带接收完成，最后一个条带负责关闭文件；返回文件是否已完整接收"""
+        if self.striped_file.stripe_finished(self, True):
+            self.striped_file.close(sync)
+            return self.striped_file.complete
+        return False
+    
+    def abort(self):
+        """条带传输中断，返回文件是否因此被关闭"""
+        if self.striped_file.stripe_finished(self, False):
+            self.striped_file.close(sync=False)
+            return True
+        return False
+    
+    def discard(self):
+        """条带校验失败，写入的数据不计入可续传的部分；返回文件是否因此被关闭"""
+        self.written = 0
+        return self.abort()
+
+class BundleWriter:
+    """小文件包的写入器
+    
+    数据为包中各文件的内容依次拼接，按声明的大小切分：写满一个文件就关闭它，再创建下一个。
+    hasher 覆盖拼接后的全部数据（与FILE_END中的哈希比较），new_file_hasher 不为None时
+    还为每个文件单独计算内容哈希（digests），供内容索引使用。
+    小文件关闭时不逐个同步到磁盘，逐个fsync是接收大量小文件时的主要开销。
+    """
+    def __init__(self, entries, buffer_size=WRITE_BUFFER_SIZE, hasher=None, new_file_hasher=None):
+        # [(路径, 大小), ...]
+        self.entries = entries
+        self.buffer_size = buffer_size
+        self.hasher = hasher
+        self.new_file_hasher = new_file_hasher
+        self.filesize = sum(size for _, size in entries)
+        self.written = 0
+        self.digests = []
+        self.index = 0
+        self.file = None
+        self.file_hasher = None
+        self.remaining = 0
+        self._next_file()
+    
+    @property
+    def paths(self):
+        return [path for path, _ in self.entries]
+    
+    def _next_file(self):
+        """打开下一个还有数据要写入的文件，空文件直接创建"""
+        while self.index < len(self.entries):
+            path, size = self.entries[self.index]
+            # 缓冲区不超过文件大小（buffering=1 在二进制模式下无效，至少为2）
+            self.file = open(path, 'wb', buffering=min(self.buffer_size, max(size, 2)))
+            self.file_hasher = self.new_file_hasher() if self.new_file_hasher else None
+            self.remaining = size
+            if size > 0:
+                return
+            self._close_file()
+    
+    def _close_file(self):
+        self.file.close()
+        self.file = None
+        self.digests.append(self.file_hasher.hexdigest() if self.file_hasher else None)
+        self.index += 1
+    
+    def write(self, data):
+        """写入一块拼接的数据，可能跨越多个文件"""
+        if self.written + len(data) > self.filesize:
+            raise ValueError("小文件包的数据超出声明的大小")
+        if self.hasher:
+            self.hasher.update(data)
+        view = memoryview(data)
+        while view:
+            count = min(self.remaining, len(view))
+            self.file.write(view[:count])
+            if self.file_hasher:
+                self.file_hasher.update(view[:count])
+            self.remaining -= count
+            self.written += count
+            view = view[count:]
+            if self.remaining == 0:
+                self._close_file()
+                self._next_file()
+    
+    def close(self):
+        """包接收结束，返回所有文件是否都已完整写入"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.index == len(self.entries)
+    
+    def abort(self):
+        """传输中断，包中的文件作为一个整体重新发送，已写入的文件也删除"""
+        self.discard()
+    
+    def discard(self):
+        """校验失败，删除包中的所有文件"""
+        self.close()
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
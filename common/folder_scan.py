@@ -0,0 +1,120 @@
+"""
+目录扫描
+用 os.scandir 递归列出目录中的文件（目录项自带类型信息，不需要为每个文件单独stat），
+FolderScanner 在后台线程中展开文件和文件夹、识别图片，找到的文件分批交给界面，可以随时取消
+"""
+import os
+import stat
+import time
+import queue
+import threading
+
+from common.image_types import filter_images
+
+# 找到这么多文件，或距离上一批超过 SCAN_BATCH_INTERVAL 秒时交出一批
+SCAN_BATCH_SIZE = 1000
+SCAN_BATCH_INTERVAL = 0.1
+
+def scan_directory(root, accept=None, should_continue=None):
+    """递归列出目录中的文件（生成器，返回 os.DirEntry）
+    
+    accept(文件名) 返回False的文件被跳过。同一目录中按名称排序，先列出文件再进入子目录。
+    不进入指向目录的符号链接，无法读取的目录被跳过。should_continue() 返回False时停止。
+    """
+    stack = [root]
+    while stack:
+        if should_continue and not should_continue():
+            return
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file() and (accept is None or accept(entry.name)):
+                    yield entry
+            except OSError:
+                pass
+        # 栈顶为名称最小的子目录
+        stack.extend(reversed(subdirs))
+
+class FolderScanner:
+    """在后台线程中展开文件和文件夹（文件夹递归扫描）
+    
+    images_only 为True时按文件内容只保留图片（common.image_types），识别也在后台线程中进行。
+    找到的文件连同文件信息（os.stat_result）按批放入队列，界面线程定时调用 take() 取出；
+    扫描结束（或取消）后设置 done。skipped 为不是图片而被跳过的文件数。
+    """
+    def __init__(self, paths, images_only=True):
+        self.paths = list(paths)
+        self.images_only = images_only
+        self.skipped = 0
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="folder-scan", daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def cancel(self):
+        """停止扫描，已经找到但没有取出的文件被丢弃"""
+        self.cancelled.set()
+    
+    def take(self):
+        """取出目前为止找到的文件，返回 (路径, 文件信息) 的列表"""
+        found = []
+        while True:
+            try:
+                found.extend(self.results.get_nowait())
+            except queue.Empty:
+                break
+        return [] if self.cancelled.is_set() else found
+    
+    def _walk(self):
+        """依次产生 (路径, 文件信息)，文件夹递归展开，不存在的路径被跳过"""
+        should_continue = lambda: not self.cancelled.is_set()
+        for path in self.paths:
+            if not should_continue():
+                return
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                for entry in scan_directory(path, should_continue=should_continue):
+                    try:
+                        yield entry.path, entry.stat()
+                    except OSError:
+                        pass
+            elif stat.S_ISREG(st.st_mode):
+                yield path, st
+    
+    def _run(self):
+        batch = []
+        last_put = time.monotonic()
+        try:
+            for item in self._walk():
+                batch.append(item)
+                if len(batch) >= SCAN_BATCH_SIZE or time.monotonic() - last_put >= SCAN_BATCH_INTERVAL:
+                    self._put(batch)
+                    batch = []
+                    last_put = time.monotonic()
+            if batch:
+                self._put(batch)
+        finally:
+            self.done.set()
+    
+    def _put(self, batch):
+        if self.images_only:
+            images = filter_images(batch)
+            self.skipped += len(batch) - len(images)
+            batch = images
+        if batch:
+            self.results.put(batch)
@@ -0,0 +1,281 @@
+"""
+传输历史记录
+保存在SQLite数据库中，按时间、文件名、对方地址、状态和内容哈希建立索引，
+几十万条记录中按条件查询也不需要全部读入内存。新增记录由后台线程合并写入，
+不阻塞传输；查询可以在任意线程中进行（WAL模式下读写互不阻塞）
+"""
+import os
+import json
+import time
+import queue
+import sqlite3
+import threading
+from datetime import datetime, date
+
+# 接收端的历史记录在项目的data目录中（与内容索引相同），发送端的在用户目录中
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+RECEIVER_HISTORY_FILE = os.path.join(DATA_DIR, "transfer_history.db")
+SENDER_HISTORY_FILE = os.path.join(os.path.expanduser("~"), ".desktransfer", "sender_history.db")
+
+# 后台线程收到一条记录后再等待这么久（秒），把这段时间内的记录合并为一个事务
+FLUSH_INTERVAL = 0.2
+# 一个事务的最大记录数
+MAX_BATCH_SIZE = 1000
+# 界面线程等待后台写入的最长时间（秒），超时后不再等待，避免界面卡住
+FLUSH_TIMEOUT = 2
+# 记录中的时间格式，按字符串比较即按时间先后
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# peer: 发送端记录接收端IP，接收端记录发送端IP
+# status: 发送端为"发送成功"/"发送失败"，接收端为记录来源（"网络接收"/"拖拽上传"）
+# hash: 文件的BLAKE2b内容哈希，未知时为NULL
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    time TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    filesize INTEGER NOT NULL DEFAULT 0,
+    peer TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT '',
+    path TEXT NOT NULL DEFAULT '',
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS history_time ON history (time);
+CREATE INDEX IF NOT EXISTS history_filename ON history (filename COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS history_peer ON history (peer, time);
+CREATE INDEX IF NOT EXISTS history_status ON history (status, time);
+CREATE INDEX IF NOT EXISTS history_hash ON history (hash);
+"""
+COLUMNS = ("time", "filename", "filesize", "peer", "status", "path", "hash")
+
+def make_record(filename, filesize, peer="", status="", path="", digest=None):
+    """生成一条当前时间的历史记录"""
+    return {
+        "time": datetime.now().strftime(TIME_FORMAT),
+        "filename": filename,
+        "filesize": filesize,
+        "peer": peer,
+        "status": status,
+        "path": path,
+        "hash": digest
+    }
+
+def time_bound(value, end=False):
+    """把查询的时间范围转换为记录中的时间格式；只有日期时，结束时间包括当天"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime(TIME_FORMAT)
+    if isinstance(value, date):
+        value = value.isoformat()
+    if len(value) == 10:
+        return value + (" 23:59:59" if end else " 00:00:00")
+    return value
+
+def legacy_record(record):
+    """把旧版本历史文件中的记录转换为数据库的列"""
+    return {
+        "time": record.get("time", ""),
+        "filename": record.get("filename", ""),
+        "filesize": record.get("filesize", 0),
+        "peer": record.get("receiver", ""),
+        "status": record.get("status") or record.get("type", ""),
+        "path": record.get("path", ""),
+        "hash": None
+    }
+
+class HistoryDatabase:
+    """传输历史数据库
+    
+    写入（追加、清空、导入旧版本的历史文件）都在一个后台线程中按提交顺序执行，
+    数据库准备好之后设置 loaded，无法打开时 error 为对应的异常。
+    append() 只把记录放入队列，可以在任意线程中调用。查询使用每个线程各自的连接，会先等待数据库准备好。
+    写入失败时在后台写入线程中通过 log(message) 报告。
+    """
+    def __init__(self, db_file, legacy_files=(), log=None):
+        self.db_file = db_file
+        self.legacy_files = legacy_files
+        self.log = log or print
+        self.loaded = threading.Event()
+        self.error = None
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+    
+    def append(self, record):
+        """追加一条记录（make_record 生成的字典）"""
+        self.queue.put(("append", record))
+    
+    def clear(self):
+        """清空所有记录"""
+        self.queue.put(("clear", None))
+    
+    def flush(self, timeout=None):
+        """等待此前提交的操作全部写入数据库，超时返回False"""
+        return self.written().wait(timeout)
+    
+    def written(self):
+        """返回一个Event，此前提交的操作全部写入数据库后设置，不等待
+        
+        后台写入线程只设置Event，不调用任何回调；界面线程定时检查它，写入线程不会等待界面线程。
+        """
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        return done
+    
+    def close(self, timeout=5):
+        """写入剩余的记录后停止后台线程"""
+        if self.thread.is_alive():
+            self.queue.put(("close", None))
+            self.thread.join(timeout)
+    
+    def query(self, start=None, end=None, peer=None, status=None, name=None, filename=None, digest=None,
+              before=None, since_id=None, limit=None, offset=0):
+        """按条件查询记录，按时间从新到旧返回字典列表
+        
+        start/end 为日期或时间（字符串、date或datetime），name 按文件名的一部分搜索（不区分大小写），
+        filename 按完整文件名查找，digest 按内容哈希查找。
+        分页显示时 before 为上一页最后一条记录的 (time, id)，只返回排在它之后的记录，
+        期间新增的记录不会让后面的页重复或遗漏；since_id 只返回ID更大（之后新增）的记录。
+        """
+        where, params = self._where(start, end, peer, status, name, filename, digest, before, since_id)
+        sql = f"SELECT id, {', '.join(COLUMNS)} FROM history{where} ORDER BY time DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        cursor = self._reader().execute(sql, params)
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+    
+    def count(self, start=None, end=None, peer=None, status=None, name=None, filename=None, digest=None):
+        """符合条件的记录数"""
+        where, params = self._where(start, end, peer, status, name, filename, digest)
+        return self._reader().execute(f"SELECT COUNT(*) FROM history{where}", params).fetchone()[0]
+    
+    def last_id(self):
+        """最新一条记录的ID，没有记录时为0"""
+        return self._reader().execute("SELECT MAX(id) FROM history").fetchone()[0] or 0
+    
+    def get(self, record_id):
+        """按ID读取一条记录，不存在时返回None"""
+        cursor = self._reader().execute(f"SELECT id, {', '.join(COLUMNS)} FROM history WHERE id = ?",
+                                        (record_id,))
+        row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+    
+    def _where(self, start, end, peer, status, name, filename, digest, before=None, since_id=None):
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("time >= ?")
+            params.append(time_bound(start))
+        if end is not None:
+            conditions.append("time <= ?")
+            params.append(time_bound(end, end=True))
+        if peer:
+            conditions.append("peer = ?")
+            params.append(peer)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if filename:
+            conditions.append("filename = ? COLLATE NOCASE")
+            params.append(filename)
+        if name:
+            escaped = name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("filename LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        if digest:
+            conditions.append("hash = ?")
+            params.append(digest)
+        if before is not None:
+            conditions.append("(time < ? OR (time = ? AND id < ?))")
+            params += [before[0], before[0], before[1]]
+        if since_id is not None:
+            conditions.append("id > ?")
+            params.append(since_id)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+    
+    def _reader(self):
+        """当前线程的只读连接"""
+        self.loaded.wait()
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_file)
+            self.local.connection = connection
+        return connection
+    
+    def _run(self):
+        connection = None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_file)), exist_ok=True)
+            connection = sqlite3.connect(self.db_file)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            for legacy_file in self.legacy_files:
+                if os.path.exists(legacy_file):
+                    self._import_legacy(connection, legacy_file)
+        except Exception as e:
+            self.error = e
+            connection = None
+        self.loaded.set()
+        
+        pending = None
+        while True:
+            op, arg = pending or self.queue.get()
+            pending = None
+            try:
+                if op == "append":
+                    # 合并一段时间内的追加为一个事务；收到其他操作时立即写入
+                    batch = [arg]
+                    deadline = time.monotonic() + FLUSH_INTERVAL
+                    while len(batch) < MAX_BATCH_SIZE:
+                        try:
+                            op, arg = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                        except queue.Empty:
+                            break
+                        if op != "append":
+                            pending = (op, arg)
+                            break
+                        batch.append(arg)
+                    # 数据库无法打开时丢弃记录，只保证不阻塞调用方
+                    if connection is not None:
+                        self._insert(connection, batch)
+                elif op == "clear":
+                    if connection is not None:
+                        with connection:
+                            connection.execute("DELETE FROM history")
+                elif op == "flush":
+                    arg.set()
+                elif op == "close":
+                    if connection is not None:
+                        connection.close()
+                    return
+            except Exception as e:
+                self.log(f"写入历史记录失败: {e}")
+                if op == "flush":
+                    arg.set()
+    
+    def _insert(self, connection, records):
+        with connection:
+            connection.executemany(
+                f"INSERT INTO history ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(record.get(column) for column in COLUMNS) for record in records]
+            )
+    
+    def _import_legacy(self, connection, legacy_file):
+        """导入旧版本的历史文件（JSON数组或JSON Lines），原文件改名为 .bak 保留"""
+        records = []
+        with open(legacy_file, 'r', encoding='utf-8') as f:
+            if legacy_file.endswith(".jsonl"):
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+            else:
+                records = json.load(f)
+        self._insert(connection, [legacy_record(record) for record in records])
+        os.replace(legacy_file, legacy_file + ".bak")
@@ -0,0 +1,102 @@
+"""
+按文件内容识别图片格式
+只读取文件开头的几个字节，与预先编译好的签名表比较，不依赖扩展名：
+改错扩展名的文件不会被当作图片，没有扩展名的相机导出文件也能识别。
+结果按 (路径, 大小, 修改时间) 缓存，大量文件时在线程池中并发读取
+"""
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 识别所需读取的字节数（WebP的标识在第8-11字节）
+SNIFF_SIZE = 12
+
+# 签名表：格式名 -> 文件开头的字节模式
+IMAGE_SIGNATURES = {
+    "jpeg": rb"\xff\xd8\xff",
+    "png": rb"\x89PNG\r\n\x1a\n",
+    "gif": rb"GIF8[79]a",
+    "bmp": rb"BM",
+    "tiff": rb"II\*\x00|MM\x00\*",
+    "webp": rb"RIFF.{4}WEBP",
+}
+# 所有签名编译为一个正则表达式，一次匹配即可得到格式名
+SIGNATURE_PATTERN = re.compile(
+    b"|".join(b"(?P<%s>%s)" % (name.encode(), pattern) for name, pattern in IMAGE_SIGNATURES.items()),
+    re.DOTALL
+)
+
+# 文件数不少于这个值时在线程池中读取，网络共享上可以同时等待多个文件
+PARALLEL_THRESHOLD = 32
+SNIFF_WORKERS = 8
+# 缓存的最大条目数，超过时清空
+MAX_CACHE_ENTRIES = 500000
+
+def match_image_signature(header):
+    """根据文件开头的字节返回图片格式名，不是支持的图片时返回None"""
+    match = SIGNATURE_PATTERN.match(header)
+    return match.lastgroup if match else None
+
+def sniff_image_type(file_path):
+    """读取文件开头判断图片格式，无法读取或不是支持的图片时返回None"""
+    try:
+        with open(file_path, 'rb') as f:
+            return match_image_signature(f.read(SNIFF_SIZE))
+    except OSError:
+        return None
+
+class ImageTypeCache:
+    """按 (路径, 大小, 修改时间) 缓存识别结果，文件改变后重新识别，可以在多个线程中使用"""
+    def __init__(self):
+        self.types = {}
+        self.lock = threading.Lock()
+    
+    def filter_images(self, found):
+        """从 (路径, 文件信息) 列表中选出图片文件，文件信息可以为None
+        
+        先在缓存中查找，只读取没有缓存的文件；这样的文件较多时分成几组在线程池中并发读取。
+        """
+        found = list(found)
+        keys = [self._key(file_path, st) for file_path, st in found]
+        with self.lock:
+            image_types = [self.types.get(key) if key else None for key in keys]
+            missing = [i for i, key in enumerate(keys) if key and key not in self.types]
+        
+        if len(missing) < PARALLEL_THRESHOLD:
+            sniffed = self._sniff([keys[i] for i in missing])
+        else:
+            # 每个线程处理一组文件，避免为每个文件提交一个任务
+            groups = [[keys[i] for i in missing[n::SNIFF_WORKERS]] for n in range(SNIFF_WORKERS)]
+            with ThreadPoolExecutor(max_workers=SNIFF_WORKERS, thread_name_prefix="image-sniff") as executor:
+                results = list(executor.map(self._sniff, groups))
+            sniffed = [None] * len(missing)
+            for n, group_result in enumerate(results):
+                sniffed[n::SNIFF_WORKERS] = group_result
+        for i, image_type in zip(missing, sniffed):
+            image_types[i] = image_type
+        return [item for item, image_type in zip(found, image_types) if image_type]
+    
+    def _key(self, file_path, st):
+        if st is None:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return None
+        return (file_path, st.st_size, st.st_mtime)
+    
+    def _sniff(self, keys):
+        """识别一组文件并记入缓存"""
+        image_types = [sniff_image_type(key[0]) for key in keys]
+        with self.lock:
+            if len(self.types) + len(keys) > MAX_CACHE_ENTRIES:
+                self.types.clear()
+            self.types.update(zip(keys, image_types))
+        return image_types
+
+# 进程内共用的缓存
+image_type_cache = ImageTypeCache()
+
+def filter_images(found):
+    """从 (路径, 文件信息) 列表中选出图片文件（使用共用的缓存）"""
+    return image_type_cache.filter_images(found)
@@ -0,0 +1,152 @@
+"""
+传输进度
+传输线程只更新计数器，界面按固定频率轮询，避免每个数据块都向Tk事件队列投递回调
+"""
+import threading
+import time
+
+from common.utils import format_size, format_duration
+
+# 界面轮询进度的间隔（毫秒），约10帧每秒
+PROGRESS_POLL_INTERVAL = 100
+# 速度指数平滑系数
+RATE_SMOOTHING = 0.3
+
+class ProgressSnapshot:
+    """某一时刻的进度快照，由界面线程读取"""
+    def __init__(self, file_index, file_count, filename, file_bytes, file_size,
+                 transferred_bytes, total_bytes, rate, eta):
+        self.file_index = file_index
+        self.file_count = file_count
+        self.filename = filename
+        self.file_bytes = file_bytes
+        self.file_size = file_size
+        self.transferred_bytes = transferred_bytes
+        self.total_bytes = total_bytes
+        self.rate = rate  # 字节/秒
+        self.eta = eta  # 剩余秒数，未知时为None
+    
+    @property
+    def percent(self):
+        """总体进度百分比，总大小未知时使用当前文件的进度"""
+        if self.total_bytes > 0:
+            return int(self.transferred_bytes * 100 / self.total_bytes)
+        if self.file_size > 0:
+            return int(self.file_bytes * 100 / self.file_size)
+        return 0
+    
+    def describe(self, action):
+        """生成进度文字，action为"发送"或"接收"之一"""
+        text = f"{action}文件 {self.file_index}/{self.file_count}: {self.filename}"
+        if self.file_size > 0:
+            text += f" ({format_size(self.file_bytes)}/{format_size(self.file_size)})"
+        text += f"  {format_size(int(self.rate))}/s"
+        if self.eta is not None:
+            text += f"  剩余 {format_duration(self.eta)}"
+        return text
+
+class StreamProgress:
+    """单条连接的进度计数器，只由该连接所在的线程写入"""
+    def __init__(self):
+        self.file_index = 0
+        self.filename = ""
+        self.file_size = 0
+        self.file_bytes = 0
+        self.transferred_bytes = 0
+        self.started = 0.0
+        self.active = False
+        self.closed = False
+    
+    def start_file(self, file_index, filename, file_size):
+        """开始传输一个文件"""
+        self.file_index = file_index
+        self.filename = filename
+        self.file_size = file_size
+        self.file_bytes = 0
+        self.started = time.monotonic()
+        self.active = True
+    
+    def add_bytes(self, count):
+        """记录已传输的字节数"""
+        self.file_bytes += count
+        self.transferred_bytes += count
+    
+    def finish(self):
+        """该连接当前没有正在传输的文件"""
+        self.active = False
+
+class TransferProgress:
+    """传输进度
+    
+    每条连接通过 add_stream() 获得自己的 StreamProgress，传输线程只修改自己的
+    计数器，不加锁也不访问Tk；界面线程定时调用 snapshot() 汇总各连接的计数器，
+    计算速度和剩余时间。只有增删连接时才需要加锁。
+    """
+    def __init__(self):
+        self.streams_lock = threading.Lock()
+        self.reset()
+    
+    def reset(self, file_count=0, total_bytes=0):
+        """开始新的一批传输，total_bytes未知时传0"""
+        with self.streams_lock:
+            self.streams = []
+        self.file_count = file_count
+        self.total_bytes = total_bytes
+        
+        # 以下字段只由界面线程在snapshot()中使用
+        self._closed_bytes = 0
+        self._last_time = time.monotonic()
+        self._last_bytes = 0
+        self._rate = 0.0
+    
+    def add_stream(self):
+        """为一条连接创建进度计数器"""
+        stream = StreamProgress()
+        with self.streams_lock:
+            self.streams.append(stream)
+        return stream
+    
+    def remove_stream(self, stream):
+        """连接结束，计数器在下一次snapshot()时被合并"""
+        stream.active = False
+        stream.closed = True
+    
+    @property
+    def active(self):
+        """是否有连接正在传输文件"""
+        return any(stream.active for stream in self.streams)
+    
+    def finish(self):
+        """本批传输结束，界面停止刷新进度"""
+        for stream in self.streams:
+            stream.finish()
+    
+    def snapshot(self):
+        """汇总各连接的进度并更新平滑后的速度"""
+        with self.streams_lock:
+            # 合并已结束的连接，避免长期运行的接收端累积计数器
+            for stream in self.streams:
+                if stream.closed:
+                    self._closed_bytes += stream.transferred_bytes
+            self.streams = [stream for stream in self.streams if not stream.closed]
+            streams = list(self.streams)
+        
+        now = time.monotonic()
+        transferred = self._closed_bytes + sum(stream.transferred_bytes for stream in streams)
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            rate = (transferred - self._last_bytes) / elapsed
+            self._rate = RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self._rate if self._rate else rate
+        self._last_time = now
+        self._last_bytes = transferred
+        
+        # 显示最近开始的文件
+        current = max(streams, key=lambda stream: stream.started, default=StreamProgress())
+        if self.total_bytes > 0:
+            remaining = self.total_bytes - transferred
+        else:
+            remaining = current.file_size - current.file_bytes
+        eta = remaining / self._rate if self._rate > 0 else None
+        
+        return ProgressSnapshot(current.file_index, self.file_count, current.filename, current.file_bytes,
+                                current.file_size, transferred, self.total_bytes, self._rate, eta)
@@ -4,24 +4,75 @@
 """
 import json
 import struct
+import socket
 import os
 
 # 协议常量
-HEADER_SIZE = 4  # 消息头大小（字节）
-BUFFER_SIZE = 4096  # 缓冲区大小
+HEADER_SIZE = 4  # 消息头大小（字节），仅用于握手阶段的JSON消息
 PORT = 12345  # 默认端口
 
+# 数据块大小（字节），实际使用的值在握手时协商，发送端再根据实测吞吐量动态调整
+MIN_CHUNK_SIZE = 64 * 1024
+DEFAULT_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 协议版本
+# v1: 所有消息均为 4字节长度 + JSON，文件数据拼接在JSON之后
+# v2: 握手后使用二进制帧，JSON仅用于控制消息
+PROTOCOL_VERSION = 2
+MIN_PROTOCOL_VERSION = 2
+
+# 二进制帧头: 类型(1字节) + 标志(1字节) + 流ID(4字节) + 负载长度(4字节)，网络字节序
+FRAME_HEADER = struct.Struct('!BBII')
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+# 控制帧（以及握手消息）负载的最大长度；数据帧不超过协商的块大小
+MAX_CONTROL_FRAME_SIZE = 1024 * 1024
+# 每条查询消息最多列出的文件数，文件名很长时消息也不超过控制帧的上限
+QUERY_BATCH_SIZE = 500
+
+# 帧类型
+FRAME_CONTROL = 1  # 控制帧，负载为JSON编码的协议消息
+FRAME_DATA = 2  # 数据帧，负载为原始文件数据
+
+# 数据帧标志
+FRAME_FLAG_COPY = 1  # 增量传输的块引用，负载为 common.delta.COPY_OP，接收端从旧文件复制对应的块
+FRAME_FLAG_COMPRESSED = 2  # 负载以握手时协商的算法独立压缩（见 common.compression）
+
+# 可选功能，在握手时取双方交集
+FEATURE_RAW_DATA = "raw_data"  # 大文件在FILE_INFO之后直接发送原始数据（可使用sendfile零拷贝）
+FEATURE_RESUME = "resume"  # 批次开始前查询接收端已有的数据，中断的文件从断点继续发送
+FEATURE_DEDUP = "dedup"  # 批次开始前按大小和内容哈希查询，接收端已有的文件在本地复制
+FEATURE_DELTA = "delta"  # 接收端有同名旧文件时返回块签名，发送端只发送变化的部分
+FEATURE_CHECKSUM = "checksum"  # FILE_END携带发送数据的哈希，接收端校验后逐个文件回复FILE_ACK
+FEATURE_COMPRESSION = "compression"  # 按握手中协商的算法压缩值得压缩的文件的数据帧
+FEATURE_BUNDLE = "bundle"  # 多个小文件打包为一个数据流发送（BUNDLE_INFO列出各文件，数据为各文件内容依次拼接）
+SUPPORTED_FEATURES = [FEATURE_RAW_DATA, FEATURE_RESUME, FEATURE_DEDUP, FEATURE_DELTA, FEATURE_CHECKSUM,
+                      FEATURE_COMPRESSION, FEATURE_BUNDLE]
+
+# 不小于该大小的文件使用原始数据模式发送
+RAW_DATA_THRESHOLD = 1024 * 1024
+# 原始数据模式下每次sendfile发送的字节数，用于更新进度和响应取消
+RAW_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# 小于该长度的帧直接拼接帧头后一次发送
+SMALL_FRAME_SIZE = 1024
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
 # 消息类型
 MSG_TYPE_HANDSHAKE = "handshake"  # 握手消息
 MSG_TYPE_FILE_INFO = "file_info"  # 文件信息消息
-MSG_TYPE_FILE_DATA = "file_data"  # 文件数据消息
+MSG_TYPE_BUNDLE_INFO = "bundle_info"  # 小文件包信息消息
 MSG_TYPE_FILE_END = "file_end"  # 文件传输结束消息
+MSG_TYPE_FILE_ACK = "file_ack"  # 文件校验结果消息
 MSG_TYPE_BATCH_END = "batch_end"  # 批量传输结束消息
+MSG_TYPE_RESUME_QUERY = "resume_query"  # 续传查询消息
+MSG_TYPE_RESUME_INFO = "resume_info"  # 续传信息消息
+MSG_TYPE_DEDUP_QUERY = "dedup_query"  # 去重查询消息
+MSG_TYPE_DEDUP_INFO = "dedup_info"  # 去重信息消息
+MSG_TYPE_DELTA_QUERY = "delta_query"  # 增量传输查询消息
+MSG_TYPE_DELTA_INFO = "delta_info"  # 增量传输信息消息
 MSG_TYPE_ERROR = "error"  # 错误消息
 
-# 支持的图片格式
-SUPPORTED_IMAGE_FORMATS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp']
-
 class ProtocolMessage:
     """协议消息基类"""
     def __init__(self, msg_type):
@@ -44,47 +95,184 @@ class ProtocolMessage:
             return HandshakeMessage(**data)
         elif msg_type == MSG_TYPE_FILE_INFO:
             return FileInfoMessage(**data)
-        elif msg_type == MSG_TYPE_FILE_DATA:
-            return FileDataMessage(**data)
+        elif msg_type == MSG_TYPE_BUNDLE_INFO:
+            return BundleInfoMessage(**data)
         elif msg_type == MSG_TYPE_FILE_END:
             return FileEndMessage(**data)
+        elif msg_type == MSG_TYPE_FILE_ACK:
+            return FileAckMessage(**data)
         elif msg_type == MSG_TYPE_BATCH_END:
             return BatchEndMessage(**data)
+        elif msg_type == MSG_TYPE_RESUME_QUERY:
+            return ResumeQueryMessage(**data)
+        elif msg_type == MSG_TYPE_RESUME_INFO:
+            return ResumeInfoMessage(**data)
+        elif msg_type == MSG_TYPE_DEDUP_QUERY:
+            return DedupQueryMessage(**data)
+        elif msg_type == MSG_TYPE_DEDUP_INFO:
+            return DedupInfoMessage(**data)
+        elif msg_type == MSG_TYPE_DELTA_QUERY:
+            return DeltaQueryMessage(**data)
+        elif msg_type == MSG_TYPE_DELTA_INFO:
+            return DeltaInfoMessage(**data)
         elif msg_type == MSG_TYPE_ERROR:
             return ErrorMessage(**data)
         else:
             raise ValueError(f"未知的消息类型: {msg_type}")
 
+class ProtocolError(ValueError):
+    """对方发送了不符合协议的数据（如超出上限的帧长度），连接应当断开"""
+
+def check_frame_length(frame_type, length, max_data_size, max_control_size=MAX_CONTROL_FRAME_SIZE):
+    """检查帧头中的负载长度，超过上限时抛出ProtocolError（在读取负载、分配缓冲区之前调用）"""
+    limit = max_data_size if frame_type == FRAME_DATA else max_control_size
+    if length > limit:
+        raise ProtocolError(f"帧过长: {length} 字节，上限 {limit} 字节")
+
+def file_entries(files):
+    """消息中的文件列表只保留文件名部分，对方不能通过路径指定接收目录之外的位置"""
+    return [dict(file, filename=os.path.basename(file.get("filename") or "")) for file in files or []]
+
 class HandshakeMessage(ProtocolMessage):
     """握手消息"""
-    def __init__(self, client_name="DeskTransfer Sender"):
+    def __init__(self, client_name="DeskTransfer Sender", protocol_version=1, features=None, chunk_size=None,
+                 session_id=None, codecs=None):
         super().__init__(MSG_TYPE_HANDSHAKE)
         self.client_name = client_name
+        # 旧版本客户端不携带该字段，默认视为v1
+        self.protocol_version = protocol_version
+        # 发起方列出自己支持的功能，响应方返回协商后的功能
+        self.features = features or []
+        # 发起方请求的最大块大小，响应方返回允许的最大块大小
+        self.chunk_size = chunk_size
+        # 同一批次的多条并行连接使用相同的会话ID
+        self.session_id = session_id
+        # 发起方按优先顺序列出可用的压缩算法，响应方返回选定的一个
+        self.codecs = codecs or []
 
 class FileInfoMessage(ProtocolMessage):
     """文件信息消息"""
-    def __init__(self, filename, filesize, file_count=1, current_file=1):
+    def __init__(self, filename, filesize, file_count=1, current_file=1, stream_id=0, raw=False,
+                 offset=0, length=None, file_id=None, transfer_id=None, delta=False):
         super().__init__(MSG_TYPE_FILE_INFO)
         self.filename = os.path.basename(filename)
         self.filesize = filesize
         self.file_count = file_count
         self.current_file = current_file
+        # 该文件的数据帧所使用的流ID
+        self.stream_id = stream_id
+        # 为True时本消息之后紧跟本次发送范围内的原始文件数据，不再分帧
+        self.raw = raw
+        # 文件标识（路径、大小和修改时间的摘要），接收端据此记录中断文件的续传位置
+        self.file_id = file_id
+        # 分段传输（条带或续传）：本消息只发送文件中 [offset, offset+length) 的数据，
+        # 同一文件的各段可能经由不同连接发送，接收端通过transfer_id把它们合并到同一个文件
+        self.offset = offset
+        self.length = length
+        self.transfer_id = transfer_id
+        # 为True时以增量方式发送：数据帧为新数据，带FRAME_FLAG_COPY的数据帧为旧文件中的块引用
+        self.delta = delta
+
+    @property
+    def striped(self):
+        """是否只发送文件的一部分（条带或续传）"""
+        return self.length is not None
 
-class FileDataMessage(ProtocolMessage):
-    """文件数据消息"""
-    def __init__(self, data):
-        super().__init__(MSG_TYPE_FILE_DATA)
-        self.data = data
+    @property
+    def data_size(self):
+        """本消息之后要发送的数据字节数"""
+        return self.filesize if self.length is None else self.length
+
+class BundleInfoMessage(ProtocolMessage):
+    """小文件包信息消息
+    
+    之后的数据帧为各文件的内容按顺序拼接（一帧可以跨越文件边界），接收端按文件大小切分，
+    最后以一个FILE_END结束整个包，其中的哈希覆盖拼接后的全部数据。
+    """
+    def __init__(self, files=None, file_count=1, current_file=1, stream_id=0):
+        super().__init__(MSG_TYPE_BUNDLE_INFO)
+        # [{"filename": ..., "filesize": ..., "file_id": ...}, ...]
+        self.files = file_entries(files)
+        self.file_count = file_count
+        # 包中第一个文件在本批次中的序号
+        self.current_file = current_file
+        self.stream_id = stream_id
+    
+    @property
+    def data_size(self):
+        """本消息之后要发送的数据字节数"""
+        return sum(file["filesize"] for file in self.files)
 
 class FileEndMessage(ProtocolMessage):
     """文件传输结束消息"""
-    def __init__(self):
+    def __init__(self, hash=None):
         super().__init__(MSG_TYPE_FILE_END)
+        # 本次发送的数据（分段传输时为本段）的内容哈希，与 common.content_index.new_hasher 相同的算法
+        self.hash = hash
+
+class FileAckMessage(ProtocolMessage):
+    """文件校验结果消息，接收端按FILE_END的顺序逐个回复"""
+    def __init__(self, stream_id=0, ok=True, error=None):
+        super().__init__(MSG_TYPE_FILE_ACK)
+        self.stream_id = stream_id
+        # 为False时接收端已丢弃数据，发送端应重新发送该文件
+        self.ok = ok
+        self.error = error
 
 class BatchEndMessage(ProtocolMessage):
     """批量传输结束消息"""
-    def __init__(self):
+    def __init__(self, file_count=None):
         super().__init__(MSG_TYPE_BATCH_END)
+        # 本批次在所有并行连接上发送成功的文件数，None表示不需要等待其他连接
+        self.file_count = file_count
+
+class ResumeQueryMessage(ProtocolMessage):
+    """续传查询消息，发送端在批次开始前列出本批次的文件"""
+    def __init__(self, files=None):
+        super().__init__(MSG_TYPE_RESUME_QUERY)
+        # [{"file_id": ..., "filename": ..., "filesize": ...}, ...]
+        self.files = file_entries(files)
+
+class ResumeInfoMessage(ProtocolMessage):
+    """续传信息消息，接收端返回每个文件已经接收的字节数"""
+    def __init__(self, offsets=None):
+        super().__init__(MSG_TYPE_RESUME_INFO)
+        # {file_id: 已接收字节数}，没有记录的文件不出现
+        self.offsets = offsets or {}
+
+class DedupQueryMessage(ProtocolMessage):
+    """去重查询消息
+
+    第一轮只列出文件大小，接收端返回有同样大小文件的候选；
+    第二轮发送端只为候选文件计算内容哈希，接收端返回已有的文件。
+    """
+    def __init__(self, files=None):
+        super().__init__(MSG_TYPE_DEDUP_QUERY)
+        # [{"file_id": ..., "filename": ..., "filesize": ..., "hash": 可选}, ...]
+        self.files = file_entries(files)
+
+class DedupInfoMessage(ProtocolMessage):
+    """去重信息消息"""
+    def __init__(self, candidates=None, existing=None):
+        super().__init__(MSG_TYPE_DEDUP_INFO)
+        # 接收端有同样大小文件的file_id（回应不带哈希的查询）
+        self.candidates = candidates or []
+        # 接收端已在本地复制完成、不需要再发送的file_id（回应带哈希的查询）
+        self.existing = existing or []
+
+class DeltaQueryMessage(ProtocolMessage):
+    """增量传输查询消息，发送端列出可以增量发送的文件"""
+    def __init__(self, files=None):
+        super().__init__(MSG_TYPE_DELTA_QUERY)
+        # [{"file_id": ..., "filename": ..., "filesize": ...}, ...]
+        self.files = file_entries(files)
+
+class DeltaInfoMessage(ProtocolMessage):
+    """增量传输信息消息，之后按顺序为每个条目发送一个数据帧，负载为旧文件的块签名"""
+    def __init__(self, signatures=None):
+        super().__init__(MSG_TYPE_DELTA_INFO)
+        # [{"file_id": ..., "block_size": ..., "block_count": ...}, ...]，接收端没有旧文件的不出现
+        self.signatures = signatures or []
 
 class ErrorMessage(ProtocolMessage):
     """错误消息"""
@@ -93,57 +281,217 @@ class ErrorMessage(ProtocolMessage):
         self.error_msg = error_msg
 
 def pack_message(msg):
-    """打包消息，添加消息头"""
-    if msg.msg_type == MSG_TYPE_FILE_DATA:
-        # 文件数据消息特殊处理
-        msg_bytes = json.dumps({
-            'msg_type': msg.msg_type
-        }).encode('utf-8')
-        msg_len = len(msg_bytes) + len(msg.data)
-        header = struct.pack('!I', msg_len)  # 使用网络字节序打包消息长度
-        return header + msg_bytes + msg.data
-    else:
-        # 其他消息正常处理
-        msg_bytes = msg.to_json().encode('utf-8')
-        msg_len = len(msg_bytes)
-        header = struct.pack('!I', msg_len)  # 使用网络字节序打包消息长度
-        return header + msg_bytes
-
-def unpack_message(data):
-    """解包消息，解析消息头"""
-    msg_len = struct.unpack('!I', data[:HEADER_SIZE])[0]
-    msg_data = data[HEADER_SIZE:HEADER_SIZE+msg_len]
+    """打包消息，添加消息头（握手阶段使用）"""
+    msg_bytes = msg.to_json().encode('utf-8')
+    header = struct.pack('!I', len(msg_bytes))  # 使用网络字节序打包消息长度
+    return header + msg_bytes
+
+def negotiate_protocol_version(remote_version):
+    """协商双方都支持的协议版本，不支持时抛出ValueError"""
+    version = min(PROTOCOL_VERSION, remote_version or 1)
+    if version < MIN_PROTOCOL_VERSION:
+        raise ValueError(f"对端协议版本过旧: v{remote_version}，需要 v{MIN_PROTOCOL_VERSION} 及以上")
+    return version
+
+def negotiate_features(remote_features):
+    """返回双方都支持的功能列表"""
+    return [feature for feature in SUPPORTED_FEATURES if feature in (remote_features or [])]
+
+def negotiate_chunk_size(requested, limit=MAX_CHUNK_SIZE):
+    """协商最大块大小：不超过双方的上限，且不小于MIN_CHUNK_SIZE"""
+    chunk_size = min(requested or DEFAULT_CHUNK_SIZE, limit)
+    return max(MIN_CHUNK_SIZE, chunk_size)
+
+def pack_frame(frame_type, payload=b'', flags=0, stream_id=0):
+    """打包二进制帧（帧头 + 负载）"""
+    return FRAME_HEADER.pack(frame_type, flags, stream_id, len(payload)) + payload
+
+def unpack_frame_header(header):
+    """解析帧头，返回 (帧类型, 标志, 流ID, 负载长度)"""
+    return FRAME_HEADER.unpack(header)
+
+def pack_control_frame(msg):
+    """将控制消息打包为控制帧"""
+    return pack_frame(FRAME_CONTROL, msg.to_json().encode('utf-8'))
+
+def parse_control_frame(payload):
+    """从控制帧负载中解析协议消息"""
+    return ProtocolMessage.from_json(bytes(payload).decode('utf-8'))
+
+def send_control(sock, msg):
+    """发送控制消息"""
+    sock.sendall(pack_control_frame(msg))
+
+def send_frame(sock, frame_type, payload=b'', flags=0, stream_id=0):
+    """发送一个二进制帧
+
+    大块负载通过 sendmsg 与帧头一起分散写出，避免拼接复制数据；
+    不支持 sendmsg 的平台（Windows）退化为拼接后 sendall。
+    """
+    header = FRAME_HEADER.pack(frame_type, flags, stream_id, len(payload))
+    if not _HAS_SENDMSG or len(payload) <= SMALL_FRAME_SIZE:
+        sock.sendall(header + payload)
+        return
+    
+    sent = sock.sendmsg([header, payload])
+    if sent < FRAME_HEADER_SIZE:
+        # 极少出现的部分发送，补发剩余部分
+        sock.sendall(header[sent:])
+        sock.sendall(payload)
+    elif sent < FRAME_HEADER_SIZE + len(payload):
+        sock.sendall(memoryview(payload)[sent - FRAME_HEADER_SIZE:])
+
+def send_raw_file(sock, file_obj, filesize, on_progress=None, should_continue=None, offset=0,
+                  hasher=None, buffer=None):
+    """以原始数据模式发送文件中从offset开始的filesize字节
+
+    使用 socket.sendfile 分段发送，在支持的平台上由内核直接完成零拷贝传输。
+    每段发送完成后调用 on_progress(本段字节数)；should_continue 返回False时中止。
+    指定hasher时需要在发送的同时计算哈希，改为读入buffer（memoryview）后发送，数据只读取一次。
+    返回实际发送的字节数。
+    """
+    sent_bytes = 0
+    if hasher is not None:
+        file_obj.seek(offset)
+        while sent_bytes < filesize:
+            if should_continue and not should_continue():
+                break
+            count = file_obj.readinto(buffer[:min(len(buffer), filesize - sent_bytes)])
+            if not count:
+                raise IOError("文件在发送过程中被截断")
+            hasher.update(buffer[:count])
+            sock.sendall(buffer[:count])
+            sent_bytes += count
+            if on_progress:
+                on_progress(count)
+        return sent_bytes
     
-    # 检查是否是文件数据消息
-    try:
-        # 尝试解析JSON
-        json_data = json.loads(msg_data.decode('utf-8'))
-        msg_type = json_data.get('msg_type')
+    while sent_bytes < filesize:
+        if should_continue and not should_continue():
+            break
+        count = min(RAW_SEGMENT_SIZE, filesize - sent_bytes)
+        sent = sock.sendfile(file_obj, offset + sent_bytes, count)
+        if sent == 0:
+            raise IOError("文件在发送过程中被截断")
+        sent_bytes += sent
+        if on_progress:
+            on_progress(sent)
+    return sent_bytes
+
+class FrameReader:
+    """帧读取器
+
+    使用预分配的 bytearray 和 recv_into 从socket中读取数据，保证每条
+    消息/每个帧都完整读取后才返回，避免TCP分段导致的数据错乱。
+    返回的负载是内部缓冲区的 memoryview，只在读取下一帧之前有效。
+    帧头或消息头中的长度超过 max_data_size（数据帧）或 max_control_size（控制帧和握手消息）时
+    抛出ProtocolError，不会按对方声明的长度扩大缓冲区。
+    """
+    def __init__(self, sock, buffer_size=DEFAULT_CHUNK_SIZE + FRAME_HEADER_SIZE, max_data_size=MAX_CHUNK_SIZE,
+                 max_control_size=MAX_CONTROL_FRAME_SIZE):
+        self.sock = sock
+        self.max_data_size = max_data_size
+        self.max_control_size = max_control_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # 未消费数据的起始位置
+        self.end = 0  # 已接收数据的结束位置
+    
+    def reserve(self, size):
+        """预先把缓冲区扩大到至少size字节，通常在协商块大小后调用"""
+        if size > len(self.buffer):
+            pending = self.end - self.start
+            new_buffer = bytearray(size)
+            new_buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(self.buffer)
+            self.start = 0
+            self.end = pending
+    
+    def _fill(self, size):
+        """确保缓冲区中至少有size个未消费字节，连接在此之前关闭时返回False"""
+        if self.end - self.start >= size:
+            return True
         
-        if msg_type == MSG_TYPE_FILE_DATA:
-            # 文件数据消息，数据在JSON之后
-            file_data = data[HEADER_SIZE+len(msg_data):]
-            return FileDataMessage(data=file_data)
-        else:
-            # 其他消息，正常解析
-            return ProtocolMessage.from_json(msg_data.decode('utf-8'))
-    except (json.JSONDecodeError, UnicodeDecodeError):
-        # 如果JSON解析失败，可能是文件数据消息
-        # 尝试从消息开头获取消息类型
-        try:
-            json_part = msg_data.split(b'}', 1)[0] + b'}'
-            json_data = json.loads(json_part.decode('utf-8'))
-            if json_data.get('msg_type') == MSG_TYPE_FILE_DATA:
-                # 文件数据消息，数据在JSON之后
-                file_data = data[HEADER_SIZE+len(json_part):]
-                return FileDataMessage(data=file_data)
-        except:
-            pass
+        if self.start + size > len(self.buffer):
+            # 剩余空间不足，把未消费数据移到缓冲区开头，必要时扩容
+            pending = self.end - self.start
+            if size > len(self.buffer):
+                self.reserve(max(size, len(self.buffer) * 2))
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+                self.start = 0
+                self.end = pending
         
-        # 如果都失败，抛出异常
-        raise ValueError("无法解析消息")
-
-def is_image_file(filename):
-    """检查文件是否为支持的图片格式"""
-    _, ext = os.path.splitext(filename.lower())
-    return ext in SUPPORTED_IMAGE_FORMATS
\ No newline at end of file
+        while self.end - self.start < size:
+            received = self.sock.recv_into(self.view[self.end:])
+            if received == 0:
+                return False
+            self.end += received
+        return True
+    
+    def read_exactly(self, size):
+        """精确读取size个字节，返回memoryview；连接在读取完成前关闭时抛出ConnectionError"""
+        if not self._fill(size):
+            raise ConnectionError("连接在消息读取完成前关闭")
+        data = self.view[self.start:self.start + size]
+        self.start += size
+        return data
+    
+    def read_message(self):
+        """读取一条握手阶段的消息（4字节长度 + JSON），连接关闭时返回None"""
+        if not self._fill(HEADER_SIZE):
+            return None
+        msg_len = struct.unpack('!I', self.read_exactly(HEADER_SIZE))[0]
+        if msg_len > self.max_control_size:
+            raise ProtocolError(f"消息过长: {msg_len} 字节")
+        return ProtocolMessage.from_json(bytes(self.read_exactly(msg_len)).decode('utf-8'))
+    
+    def read_frame(self):
+        """读取一个完整的帧，返回 (帧类型, 标志, 流ID, 负载)；连接在帧边界关闭时返回None"""
+        if not self._fill(FRAME_HEADER_SIZE):
+            if self.end > self.start:
+                raise ConnectionError("连接在帧头读取完成前关闭")
+            return None
+        frame_type, flags, stream_id, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        check_frame_length(frame_type, length, self.max_data_size, self.max_control_size)
+        self.start += FRAME_HEADER_SIZE
+        return frame_type, flags, stream_id, self.read_exactly(length)
+    
+    def read_control(self):
+        """读取一个控制帧并解析为协议消息；连接关闭时返回None"""
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        frame_type, flags, stream_id, payload = frame
+        if frame_type != FRAME_CONTROL:
+            raise ValueError(f"期望控制帧，收到帧类型: {frame_type}")
+        return parse_control_frame(payload)
+    
+    def read_raw(self, size, write):
+        """读取size个不带帧头的原始字节，分块交给write处理"""
+        remaining = size
+        pending = self.end - self.start
+        if pending:
+            # 先消费缓冲区中已经收到的数据
+            count = min(pending, remaining)
+            write(self.view[self.start:self.start + count])
+            self.start += count
+            remaining -= count
+        if self.start == self.end:
+            self.start = self.end = 0
+        
+        while remaining > 0:
+            received = self.sock.recv_into(self.view, min(remaining, len(self.buffer)))
+            if received == 0:
+                raise ConnectionError("连接在文件数据读取完成前关闭")
+            write(self.view[:received])
+            remaining -= received
+    
+    def frames(self):
+        """逐帧读取，直到连接关闭"""
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
@@ -0,0 +1,821 @@
+"""
+接收端核心
+与界面无关的握手、会话管理和文件接收逻辑
+"""
+import os
+import shutil
+import socket
+import threading
+import uuid
+from collections import deque
+
+from common.protocol import *
+from common.utils import format_size
+from common.file_writer import FileWriter, StripedFile, StripeWriter, BundleWriter, WRITE_BUFFER_SIZE
+from common.progress import TransferProgress
+from common.resume import ResumeIndex, RESUME_INDEX_FILENAME
+from common.delta import (DELTA_MIN_SIZE, DeltaWriter, compute_signature, signature_size, SIGNATURE_ENTRY,
+                          MAX_SIGNATURE_SIZE)
+from common.content_index import new_hasher
+from common.compression import Codec, negotiate_codec
+
+# 批次结束时等待同一会话其他并行连接收尾的最长时间（秒）
+BATCH_WAIT_TIMEOUT = 60
+# 每条连接已经读取、排队等待写盘的数据上限：磁盘短暂变慢（机械硬盘寻道、关闭文件时的同步）时
+# 仍继续从网络读取，超过上限才暂停读取，由TCP窗口让发送端放慢
+CONNECTION_BUFFER_LIMIT = 8 * 1024 * 1024
+# 所有连接排队等待写盘的数据总量上限
+MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+
+def link_or_copy(source, target):
+    """把已有的文件放到target：优先创建硬链接，跨文件系统等情况下复制"""
+    if os.path.exists(target):
+        if os.path.samefile(source, target):
+            return
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def raw_data_size(message):
+    """紧跟在控制消息之后、不分帧的原始数据字节数（只有原始数据模式的FILE_INFO不为0）"""
+    if message.msg_type == MSG_TYPE_FILE_INFO and message.raw:
+        return message.data_size
+    return 0
+
+def is_inside(path, directory):
+    """path（解析符号链接之后）是否在directory之中"""
+    directory = os.path.realpath(directory)
+    try:
+        return os.path.commonpath([os.path.realpath(path), directory]) == directory
+    except ValueError:
+        # Windows上位于不同的驱动器
+        return False
+
+def unlink_if_shared(file_path):
+    """要覆盖的文件有其他硬链接（本地复制的已有文件）时先删除，避免改动另一处文件的内容"""
+    try:
+        if os.stat(file_path).st_nlink > 1:
+            os.remove(file_path)
+    except OSError:
+        pass
+
+class TransferSession:
+    """接收端的一个逻辑批次，同一发送端的多条并行连接共享一个会话"""
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.condition = threading.Condition()
+        self.connections = 0  # 当前打开的连接数
+        # 尚未计入批次的已接收文件大小，按到达顺序排列
+        self.received_sizes = []
+        # 分段传输中的文件，transfer_id -> StripedFile
+        self.striped_files = {}
+        # 分段文件对应的文件ID，用于会话结束时记录续传位置
+        self.striped_file_ids = {}
+        # 已返回签名、等待增量发送的文件，file_id -> (旧文件路径, 块大小, 旧文件大小, 修改时间)
+        self.delta_bases = {}
+    
+    def file_received(self, filesize):
+        """记录一个接收完成的文件"""
+        with self.condition:
+            self.received_sizes.append(filesize)
+            self.condition.notify_all()
+    
+    def end_batch(self, file_count=None, timeout=BATCH_WAIT_TIMEOUT):
+        """等待本批次的文件在各条连接上全部到达，返回 (文件数, 总字节数)
+        
+        下一批次的并行连接可能在本批次结束前就开始发送，
+        因此只取出本批次的文件数，多出的留给下一批次。
+        """
+        with self.condition:
+            if file_count is None:
+                file_count = len(self.received_sizes)
+            self.condition.wait_for(lambda: len(self.received_sizes) >= file_count, timeout=timeout)
+            sizes = self.received_sizes[:file_count]
+            del self.received_sizes[:file_count]
+        return len(sizes), sum(sizes)
+
+class FileReceiver:
+    """接收端核心
+    
+    处理单个客户端连接的握手和文件接收；同一会话ID的多条连接归为一个批次。
+    界面或命令行通过回调获得日志和接收结果：
+    log(message)、on_file_received(filename, file_path, filesize, peer, digest)、on_batch_end(file_count, total_bytes)。
+    peer为发送端的IP地址，digest为已校验的内容哈希（未知时为None）。
+    提供 content_index（ContentIndex）时，发送端重复发送的文件直接从已接收的文件复制。
+    resume_index（ResumeIndex）默认保存在接收目录中；每次启动使用新接收目录时应传入固定位置的记录，
+    中断的文件才能在重启后续传。
+    """
+    def __init__(self, save_dir, progress=None, log=None, on_file_received=None, on_batch_end=None,
+                 content_index=None, resume_index=None):
+        self.save_dir = save_dir
+        self.content_index = content_index
+        self.client_name = "DeskTransfer Receiver"
+        # 接收文件的写缓冲区大小，以及是否按声明的大小预分配磁盘空间
+        self.write_buffer_size = WRITE_BUFFER_SIZE
+        self.preallocate_files = True
+        # 允许发送端使用的最大块大小
+        self.max_chunk_size = MAX_CHUNK_SIZE
+        # 每条连接和所有连接排队等待写盘的数据上限
+        self.connection_buffer_limit = CONNECTION_BUFFER_LIMIT
+        self.max_buffered_bytes = MAX_BUFFERED_BYTES
+        # 线程模式下所有连接排队的数据量（WritePipeline），asyncio服务器自己计数
+        self.buffered_bytes = 0
+        self.buffer_condition = threading.Condition()
+        self.progress = progress or TransferProgress()
+        self.log = log or print
+        self.on_file_received = on_file_received
+        self.on_batch_end = on_batch_end
+        self.is_running = True
+        
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        # 正在写入的文件路径，避免并行连接写同一个文件
+        self.open_paths = set()
+        self.paths_lock = threading.Lock()
+        # 中断文件的续传记录
+        if resume_index is None:
+            resume_index = ResumeIndex(os.path.join(save_dir, RESUME_INDEX_FILENAME), log=self.log)
+        self.resume_index = resume_index
+    
+    def join_session(self, session_id):
+        """加入（或创建）会话"""
+        # 旧版本发送端不携带会话ID，每条连接单独成为一个会话
+        session_id = session_id or uuid.uuid4().hex
+        with self.sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = TransferSession(session_id)
+                self.sessions[session_id] = session
+        with session.condition:
+            session.connections += 1
+        return session
+    
+    def leave_session(self, session):
+        """连接结束，离开会话"""
+        with session.condition:
+            session.connections -= 1
+            empty = session.connections == 0
+        if empty:
+            with self.sessions_lock:
+                if self.sessions.get(session.session_id) is session and session.connections == 0:
+                    del self.sessions[session.session_id]
+            
+            # 还有分段没有到达的文件不会再完成，记录续传位置
+            with session.condition:
+                striped_files = [(session.striped_file_ids.get(transfer_id), striped_file)
+                                 for transfer_id, striped_file in session.striped_files.items()]
+                session.striped_files.clear()
+                session.striped_file_ids.clear()
+            for file_id, striped_file in striped_files:
+                if striped_file.fd is not None:
+                    self.close_striped_file(file_id, striped_file)
+    
+    def reserve_path(self, filename):
+        """为接收的文件分配路径，与正在写入的文件重名时自动加序号
+        
+        只使用文件名部分；路径不在接收目录中（如文件名为".."或指向外部的符号链接）时抛出ValueError。
+        """
+        filename = os.path.basename(filename)
+        if filename in ("", ".", ".."):
+            raise ValueError(f"无效的文件名: {filename!r}")
+        name, ext = os.path.splitext(filename)
+        with self.paths_lock:
+            file_path = os.path.join(self.save_dir, filename)
+            index = 1
+            while file_path in self.open_paths:
+                file_path = os.path.join(self.save_dir, f"{name}_{index}{ext}")
+                index += 1
+            if not is_inside(file_path, self.save_dir):
+                raise ValueError(f"文件路径不在接收目录中: {filename}")
+            self.open_paths.add(file_path)
+        return file_path
+    
+    def release_path(self, file_path):
+        """文件写入结束，释放路径"""
+        with self.paths_lock:
+            self.open_paths.discard(file_path)
+    
+    def claim_path(self, file_path):
+        """续传时沿用已有的部分文件，文件正在被写入时返回False"""
+        with self.paths_lock:
+            if file_path in self.open_paths:
+                return False
+            self.open_paths.add(file_path)
+            return True
+    
+    def open_writer(self, session, file_info, hasher=None):
+        """为FILE_INFO创建写入器，返回 (写入器, 文件路径)；hasher用于在写入的同时计算哈希"""
+        if file_info.delta:
+            return self.open_delta_writer(session, file_info, hasher)
+        
+        if not file_info.striped:
+            file_path = self.reserve_path(file_info.filename)
+            unlink_if_shared(file_path)
+            writer = FileWriter(
+                file_path,
+                file_info.filesize,
+                buffer_size=self.write_buffer_size,
+                preallocate=self.preallocate_files,
+                hasher=hasher
+            )
+            return writer, file_path
+        
+        # 分段传输：同一会话中transfer_id相同的各段写入同一个文件
+        transfer_id = file_info.transfer_id or file_info.file_id
+        with session.condition:
+            striped_file = session.striped_files.get(transfer_id)
+            if striped_file is None:
+                striped_file = self.create_striped_file(file_info)
+                session.striped_files[transfer_id] = striped_file
+                session.striped_file_ids[transfer_id] = file_info.file_id
+        return striped_file.stripe(file_info.offset, file_info.length, hasher), striped_file.path
+    
+    def open_bundle_writer(self, bundle_info, hasher=None, new_file_hasher=None):
+        """为BUNDLE_INFO中的所有文件分配路径并创建写入器"""
+        paths = []
+        try:
+            for file in bundle_info.files:
+                file_path = self.reserve_path(file["filename"])
+                paths.append(file_path)
+                unlink_if_shared(file_path)
+            return BundleWriter([(file_path, file["filesize"]) for file_path, file in zip(paths, bundle_info.files)],
+                                buffer_size=self.write_buffer_size, hasher=hasher, new_file_hasher=new_file_hasher)
+        except Exception:
+            for file_path in paths:
+                self.release_path(file_path)
+            raise
+    
+    def close_bundle_writer(self, writer):
+        """小文件包接收完成，释放路径并记入内容索引"""
+        for file_path, digest in zip(writer.paths, writer.digests):
+            self.release_path(file_path)
+            if self.content_index:
+                self.content_index.add(file_path, digest)
+    
+    def open_delta_writer(self, session, file_info, hasher=None):
+        """为增量发送的文件创建写入器，旧文件在返回签名之后被修改时拒绝接收"""
+        with session.condition:
+            base = session.delta_bases.pop(file_info.file_id, None)
+        if base is None:
+            raise ValueError(f"没有可用于增量传输的旧文件: {file_info.filename}")
+        base_path, block_size, base_size, base_mtime = base
+        stat = os.stat(base_path)
+        if stat.st_size != base_size or stat.st_mtime_ns != base_mtime:
+            raise ValueError(f"增量传输的旧文件已被修改: {os.path.basename(base_path)}")
+        
+        file_path = self.reserve_path(file_info.filename)
+        try:
+            writer = DeltaWriter(
+                file_path,
+                file_info.filesize,
+                base_path,
+                block_size,
+                buffer_size=self.write_buffer_size,
+                preallocate=self.preallocate_files,
+                hasher=hasher
+            )
+        except Exception:
+            self.release_path(file_path)
+            raise
+        return writer, file_path
+    
+    def create_striped_file(self, file_info):
+        """创建分段传输的目标文件，有续传记录时在部分文件上继续写入"""
+        resume_from = self.resume_index.offset(file_info.file_id, file_info.filesize) if file_info.file_id else 0
+        if resume_from:
+            file_path, _ = self.resume_index.get(file_info.file_id)
+            if self.claim_path(file_path):
+                self.log(f"续传文件: {os.path.basename(file_path)}，已有 {format_size(resume_from)}")
+                return StripedFile(file_path, file_info.filesize, preallocate=False, resume_from=resume_from)
+        
+        file_path = self.reserve_path(file_info.filename)
+        unlink_if_shared(file_path)
+        return StripedFile(file_path, file_info.filesize, preallocate=self.preallocate_files)
+    
+    def close_writer(self, session, file_info, writer, digest=None):
+        """FILE_END时关闭写入器，返回文件是否已完整接收；digest为整个文件已校验过的内容哈希"""
+        if not file_info.striped:
+            writer.close()
+            complete = True
+            file_path = writer.path
+        else:
+            complete = writer.close()
+            file_path = writer.striped_file.path
+            if complete:
+                transfer_id = file_info.transfer_id or file_info.file_id
+                with session.condition:
+                    session.striped_files.pop(transfer_id, None)
+                    session.striped_file_ids.pop(transfer_id, None)
+            elif writer.striped_file.fd is None:
+                # 本段是最后结束的一段，但其他段已经失败
+                self.close_striped_file(file_info.file_id, writer.striped_file)
+        
+        if complete:
+            self.release_path(file_path)
+            if file_info.file_id:
+                self.resume_index.remove(file_info.file_id)
+            if self.content_index:
+                self.content_index.add(file_path, digest)
+        return complete
+    
+    def answer_dedup_query(self, session, message, peer=""):
+        """回应去重查询，返回 DedupInfoMessage"""
+        if not self.content_index:
+            return DedupInfoMessage()
+        
+        files = [file for file in message.files if file.get("file_id")]
+        if not any(file.get("hash") for file in files):
+            # 第一轮：只按大小筛选候选
+            candidates = [file["file_id"] for file in files
+                          if self.content_index.has_size(file["filesize"])]
+            return DedupInfoMessage(candidates=candidates)
+        
+        existing = []
+        for file in files:
+            if not file.get("hash"):
+                continue
+            source = self.content_index.find(file["filesize"], file["hash"])
+            if source is None:
+                continue
+            try:
+                file_path = self.reserve_path(file["filename"])
+            except ValueError as e:
+                self.log(f"拒绝去重查询中的文件: {str(e)}")
+                continue
+            try:
+                link_or_copy(source, file_path)
+            except OSError as e:
+                self.log(f"复制已有文件失败: {file['filename']} - {str(e)}")
+                continue
+            finally:
+                self.release_path(file_path)
+            
+            existing.append(file["file_id"])
+            self.content_index.add(file_path, file["hash"])
+            session.file_received(file["filesize"])
+            filename = os.path.basename(file_path)
+            if self.on_file_received:
+                self.on_file_received(filename, file_path, file["filesize"], peer, file["hash"])
+            self.log(f"文件已存在，本地复制: {filename} ({format_size(file['filesize'])})")
+        
+        self.content_index.save()
+        return DedupInfoMessage(existing=existing)
+    
+    def find_delta_base(self, filename):
+        """查找增量传输的旧文件：优先使用接收目录中的同名文件，其次是内容索引中最近接收的同名文件
+        
+        只使用文件名部分，不读取接收目录之外的文件（包括指向外部的符号链接）。
+        """
+        filename = os.path.basename(filename)
+        if filename in ("", ".", ".."):
+            return None
+        file_path = os.path.join(self.save_dir, filename)
+        with self.paths_lock:
+            open_paths = set(self.open_paths)
+        if file_path not in open_paths and os.path.isfile(file_path) and is_inside(file_path, self.save_dir):
+            return file_path
+        if self.content_index:
+            return self.content_index.find_by_name(filename, exclude=open_paths)
+        return None
+    
+    def answer_delta_query(self, session, message):
+        """回应增量传输查询，返回 (DeltaInfoMessage, 签名数据列表)"""
+        signatures = []
+        payloads = []
+        for file in message.files:
+            base_path = self.find_delta_base(file["filename"])
+            if base_path is None:
+                continue
+            try:
+                stat = os.stat(base_path)
+                # 签名作为一个数据帧发送，太大的文件不使用增量传输
+                if stat.st_size < DELTA_MIN_SIZE or signature_size(stat.st_size) > MAX_SIGNATURE_SIZE:
+                    continue
+                block_size, payload = compute_signature(base_path)
+            except OSError as e:
+                self.log(f"计算文件签名失败: {os.path.basename(base_path)} - {str(e)}")
+                continue
+            
+            with session.condition:
+                session.delta_bases[file["file_id"]] = (base_path, block_size, stat.st_size, stat.st_mtime_ns)
+            signatures.append({"file_id": file["file_id"], "block_size": block_size,
+                               "block_count": len(payload) // SIGNATURE_ENTRY.size})
+            payloads.append(payload)
+        
+        if signatures:
+            self.log(f"{len(signatures)} 个文件有旧版本，使用增量传输")
+        return DeltaInfoMessage(signatures), payloads
+    
+    def abort_writer(self, file_info, writer):
+        """传输中断时关闭写入器，并记录已写入的字节数供续传使用"""
+        if file_info.msg_type == MSG_TYPE_BUNDLE_INFO:
+            # 小文件包整体重新发送，不记录续传位置
+            writer.abort()
+            for file_path in writer.paths:
+                self.release_path(file_path)
+        elif file_info.delta:
+            # 增量传输的文件不记录续传位置，下次重新查询旧文件
+            writer.abort()
+            self.release_path(writer.path)
+        elif not file_info.striped:
+            writer.abort()
+            self.resume_index.record(file_info.file_id, writer.path, writer.filesize, writer.written)
+            self.release_path(writer.path)
+        elif writer.abort():
+            # 分段文件由最后一个结束的段关闭，之后才记录续传位置并释放路径
+            self.close_striped_file(file_info.file_id, writer.striped_file)
+    
+    def reject_writer(self, file_info, writer):
+        """校验失败时丢弃写入的数据"""
+        if file_info.msg_type == MSG_TYPE_BUNDLE_INFO:
+            writer.discard()
+            for file_path in writer.paths:
+                self.release_path(file_path)
+        elif not file_info.striped:
+            writer.discard()
+            self.release_path(writer.path)
+        elif writer.discard():
+            self.close_striped_file(file_info.file_id, writer.striped_file)
+    
+    def close_striped_file(self, file_id, striped_file):
+        """关闭未完成的分段文件"""
+        striped_file.close(sync=False)
+        self.resume_index.record(file_id, striped_file.path, striped_file.filesize,
+                                 striped_file.contiguous_bytes())
+        self.release_path(striped_file.path)
+    
+    def answer_handshake(self, handshake, peer=""):
+        """处理握手消息，返回 (响应消息, ReceiveConnection)
+        
+        peer为发送端的IP地址。拒绝连接时ReceiveConnection为None，响应消息不为None时需要发送给对方。
+        """
+        if handshake.msg_type != MSG_TYPE_HANDSHAKE:
+            self.log(f"无效的握手消息: {handshake.msg_type}")
+            return None, None
+        
+        try:
+            negotiate_protocol_version(handshake.protocol_version)
+        except ValueError as e:
+            self.log(f"拒绝客户端 {handshake.client_name}: {str(e)}")
+            return ErrorMessage(str(e)), None
+        
+        chunk_size = negotiate_chunk_size(handshake.chunk_size, self.max_chunk_size)
+        self.log(f"握手成功，客户端: {handshake.client_name}，最大块大小: {format_size(chunk_size)}")
+        
+        features = negotiate_features(handshake.features)
+        codec_name = negotiate_codec(handshake.codecs) if FEATURE_COMPRESSION in features else None
+        response = HandshakeMessage(client_name=self.client_name, protocol_version=PROTOCOL_VERSION,
+                                    features=features, chunk_size=chunk_size,
+                                    codecs=[codec_name] if codec_name else [])
+        if codec_name:
+            self.log(f"压缩算法: {codec_name}")
+        
+        session = self.join_session(handshake.session_id)
+        connection = ReceiveConnection(self, session, checksum=FEATURE_CHECKSUM in features,
+                                       codec=Codec(codec_name) if codec_name else None, chunk_size=chunk_size,
+                                       peer=peer)
+        return response, connection
+    
+    def handle_client(self, client_socket, addr):
+        """在当前线程中处理一个客户端连接（阻塞socket）"""
+        try:
+            self.log(f"客户端连接: {addr[0]}:{addr[1]}")
+            
+            reader = FrameReader(client_socket)
+            
+            # 接收握手消息
+            handshake = reader.read_message()
+            if handshake is None:
+                return
+            
+            response, connection = self.answer_handshake(handshake, addr[0])
+            if response is not None:
+                client_socket.sendall(pack_message(response))
+            if connection is None:
+                return
+            
+            # 处理文件传输
+            reader.reserve(connection.chunk_size + FRAME_HEADER_SIZE)
+            reader.max_data_size = connection.chunk_size
+            try:
+                self.receive_files(reader, connection)
+            finally:
+                connection.close()
+        
+        except Exception as e:
+            self.log(f"处理客户端连接时出错: {str(e)}")
+        finally:
+            client_socket.close()
+            self.log(f"客户端断开连接: {addr[0]}:{addr[1]}")
+    
+    def receive_files(self, reader, connection):
+        """从阻塞socket逐帧读取，交给写盘线程按顺序处理，直到连接关闭"""
+        pipeline = WritePipeline(self, connection, reader.sock)
+        error = None
+        try:
+            for frame_type, flags, stream_id, payload in reader.frames():
+                if not self.is_running:
+                    break
+                
+                # 负载是读取器缓冲区的视图，读取下一帧前复制出来放入队列
+                if frame_type == FRAME_DATA:
+                    pipeline.put(connection.handle_data, (flags, stream_id, bytes(payload)), len(payload))
+                    continue
+                if frame_type != FRAME_CONTROL:
+                    raise ValueError(f"未知的帧类型: {frame_type}")
+                
+                message = parse_control_frame(payload)
+                pipeline.put(pipeline.handle_message, (message,), len(payload))
+                raw_size = raw_data_size(message)
+                if raw_size:
+                    reader.read_raw(raw_size, lambda data: pipeline.put(connection.write_raw, (bytes(data),),
+                                                                        len(data)))
+        
+        except Exception as e:
+            error = e
+        finally:
+            # 等待已经排队的数据写完，之后才能关闭文件
+            pipeline.close()
+        # 写盘出错时读取随之中断，报告写盘的错误
+        error = pipeline.error or error
+        if error:
+            self.log(f"接收文件时出错: {str(error)}")
+
+class WritePipeline:
+    """线程模式下一条连接的写盘队列
+    
+    读取线程把数据帧、控制消息和原始数据依次放入队列，写盘线程按顺序交给 ReceiveConnection
+    处理并发送响应，读取不需要等待写盘完成。排队的数据受每条连接和所有连接两个上限约束
+    （FileReceiver.connection_buffer_limit / max_buffered_bytes），超过时 put() 阻塞，
+    读取随之暂停。队列为空的连接总可以放入一项，各连接不会互相等待。
+    写盘出错后丢弃剩余的数据，并关闭socket的读取方向，让读取线程停止。
+    """
+    def __init__(self, receiver, connection, sock):
+        self.receiver = receiver
+        self.connection = connection
+        self.sock = sock
+        # (函数, 参数, 数据字节数)
+        self.items = deque()
+        self.buffered = 0
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="receiver-writer", daemon=True)
+        self.thread.start()
+    
+    def put(self, func, args, size):
+        """放入一项操作，超过排队上限时等待；写盘已经出错时抛出对应的异常"""
+        receiver = self.receiver
+        with receiver.buffer_condition:
+            receiver.buffer_condition.wait_for(lambda: self.error is not None or self.buffered == 0 or (
+                self.buffered + size <= receiver.connection_buffer_limit
+                and receiver.buffered_bytes + size <= receiver.max_buffered_bytes))
+            if self.error is not None:
+                raise self.error
+            self.buffered += size
+            receiver.buffered_bytes += size
+        with self.condition:
+            self.items.append((func, args, size))
+            self.condition.notify()
+    
+    def handle_message(self, message):
+        """处理控制消息，返回要发送的响应"""
+        return self.connection.handle_message(message)[0]
+    
+    def close(self):
+        """处理完队列中剩余的操作后停止写盘线程"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+    
+    def _release(self, size):
+        receiver = self.receiver
+        with receiver.buffer_condition:
+            self.buffered -= size
+            receiver.buffered_bytes -= size
+            receiver.buffer_condition.notify_all()
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.items or self.closed)
+                if not self.items:
+                    return
+                func, args, size = self.items.popleft()
+            try:
+                if self.error is None:
+                    for data in func(*args) or ():
+                        self.sock.sendall(data)
+            except Exception as e:
+                with self.receiver.buffer_condition:
+                    self.error = e
+                try:
+                    self.sock.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+            finally:
+                self._release(size)
+
+class ReceiveConnection:
+    """一条连接上的接收状态
+    
+    与socket的读写方式无关：调用方把读到的数据帧交给 handle_data，控制消息交给
+    handle_message，并把返回的响应数据发送给发送端。线程模式（FileReceiver.handle_client）
+    和asyncio服务器（common.receiver_server）共用这部分逻辑。
+    handle_data、handle_message 和 write_raw 会写磁盘或等待其他连接，不能在事件循环中直接调用。
+    """
+    def __init__(self, receiver, session, checksum=False, codec=None, chunk_size=MAX_CHUNK_SIZE, peer=""):
+        self.receiver = receiver
+        self.session = session
+        # 发送端的IP地址，随接收完成的文件交给界面记录
+        self.peer = peer
+        # 为True时在写入的同时计算哈希，校验FILE_END后回复FILE_ACK
+        self.checksum = checksum
+        # 协商的压缩算法（Codec），带压缩标志的数据帧解压后不超过chunk_size
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.log = receiver.log
+        
+        self.file_info = None
+        self.file_path = None
+        self.filename = None
+        self.writer = None
+        self.stream = receiver.progress.add_stream()
+    
+    def handle_data(self, flags, stream_id, payload):
+        """处理一个数据帧"""
+        if self.writer is None or stream_id != self.file_info.stream_id:
+            raise ValueError(f"数据帧流ID不匹配: {stream_id}")
+        
+        if flags & FRAME_FLAG_COMPRESSED:
+            if self.codec is None:
+                raise ValueError("未协商压缩算法，收到压缩的数据帧")
+            payload = self.codec.decompress(payload, self.chunk_size)
+        
+        if flags & FRAME_FLAG_COPY:
+            # 增量传输的块引用，从旧文件复制
+            if self.file_info.msg_type != MSG_TYPE_FILE_INFO or not self.file_info.delta:
+                raise ValueError("非增量传输的文件收到块引用")
+            self.stream.add_bytes(self.writer.copy(payload))
+            return
+        
+        self.writer.write(payload)
+        self.stream.add_bytes(len(payload))
+    
+    def write_raw(self, data):
+        """写入原始数据模式中紧跟在FILE_INFO之后的文件数据"""
+        self.writer.write(data)
+        self.stream.add_bytes(len(data))
+    
+    def handle_message(self, message):
+        """处理一条控制消息，返回 (要发送的响应数据列表, 紧跟在消息之后的原始数据字节数)"""
+        receiver = self.receiver
+        session = self.session
+        replies = []
+        
+        if message.msg_type == MSG_TYPE_FILE_INFO:
+            # 文件信息消息，整个文件传输期间保持文件打开
+            if self.writer:
+                receiver.abort_writer(self.file_info, self.writer)
+                self.writer = None
+            self.writer, self.file_path = receiver.open_writer(session, message,
+                                                              new_hasher() if self.checksum else None)
+            self.file_info = message
+            self.filename = os.path.basename(self.file_path)
+            
+            receiver.progress.file_count = message.file_count
+            self.stream.start_file(message.current_file, self.filename, message.data_size)
+            
+            if message.raw:
+                # 原始数据模式：文件内容紧跟在FILE_INFO之后，不分帧
+                return replies, message.data_size
+        
+        elif message.msg_type == MSG_TYPE_BUNDLE_INFO:
+            # 小文件包，之后的数据帧按文件大小切分写入各个文件
+            if self.writer:
+                receiver.abort_writer(self.file_info, self.writer)
+                self.writer = None
+            self.writer = receiver.open_bundle_writer(message, new_hasher() if self.checksum else None,
+                                                      new_hasher if self.checksum else None)
+            self.file_info = message
+            self.file_path = None
+            self.filename = f"{len(message.files)} 个小文件"
+            
+            receiver.progress.file_count = message.file_count
+            self.stream.start_file(message.current_file + len(message.files) - 1, self.filename,
+                                   message.data_size)
+        
+        elif message.msg_type == MSG_TYPE_FILE_END:
+            replies.extend(self.finish_file(message))
+        
+        elif message.msg_type == MSG_TYPE_RESUME_QUERY:
+            # 续传查询，返回每个文件已接收的字节数
+            offsets = {}
+            for file in message.files:
+                offset = receiver.resume_index.offset(file["file_id"], file["filesize"])
+                if offset:
+                    offsets[file["file_id"]] = offset
+            replies.append(pack_control_frame(ResumeInfoMessage(offsets)))
+            if offsets:
+                self.log(f"{len(offsets)} 个文件可以从断点续传")
+        
+        elif message.msg_type == MSG_TYPE_DEDUP_QUERY:
+            # 去重查询，已有的文件直接在本地复制
+            replies.append(pack_control_frame(receiver.answer_dedup_query(session, message, self.peer)))
+        
+        elif message.msg_type == MSG_TYPE_DELTA_QUERY:
+            # 增量传输查询，返回旧文件的块签名，每个签名作为一个数据帧紧跟在响应之后
+            response, payloads = receiver.answer_delta_query(session, message)
+            replies.append(pack_control_frame(response))
+            replies.extend(pack_frame(FRAME_DATA, payload) for payload in payloads)
+        
+        elif message.msg_type == MSG_TYPE_BATCH_END:
+            # 批量传输结束，等待同一会话的其他并行连接收尾
+            received_count, received_bytes = session.end_batch(message.file_count)
+            if receiver.content_index:
+                receiver.content_index.save()
+            self.log(f"批量传输完成，共接收 {received_count} 个文件（{format_size(received_bytes)}）")
+            if receiver.on_batch_end:
+                receiver.on_batch_end(received_count, received_bytes)
+        
+        elif message.msg_type == MSG_TYPE_ERROR:
+            # 错误消息
+            self.log(f"传输错误: {message.error_msg}")
+        
+        return replies, 0
+    
+    def finish_file(self, message):
+        """FILE_END时校验、同步到磁盘并关闭文件，返回要发送的响应数据列表"""
+        receiver = self.receiver
+        file_info = self.file_info
+        writer = self.writer
+        if writer is None:
+            raise ValueError("收到FILE_END但没有正在接收的文件")
+        self.writer = None
+        self.stream.finish()
+        if file_info.msg_type == MSG_TYPE_BUNDLE_INFO:
+            return self.finish_bundle(message, file_info, writer)
+        
+        if writer.remaining > 0:
+            # FILE_END之前没有收到声明的全部数据：按传输中断处理，记录续传位置
+            receiver.abort_writer(file_info, writer)
+            error = f"文件数据不完整，缺少 {format_size(writer.remaining)}"
+            self.log(f"{error}: {self.filename}")
+            if not self.checksum:
+                raise ValueError(error)
+            return [pack_control_frame(FileAckMessage(file_info.stream_id, ok=False, error=error))]
+        
+        digest = writer.hasher.hexdigest() if self.checksum else None
+        if self.checksum and message.hash != digest:
+            # 数据在传输中损坏或缺失，丢弃已写入的数据，发送端收到FILE_ACK后重新发送
+            receiver.reject_writer(file_info, writer)
+            self.log(f"文件校验失败，等待重新发送: {self.filename}")
+            return [pack_control_frame(FileAckMessage(file_info.stream_id, ok=False, error="文件校验失败"))]
+        
+        # 分段传输时哈希只覆盖本段，不能作为整个文件的内容哈希
+        if file_info.striped:
+            digest = None
+        complete = receiver.close_writer(self.session, file_info, writer, digest)
+        replies = [pack_control_frame(FileAckMessage(file_info.stream_id))] if self.checksum else []
+        if not complete:
+            # 条带文件还有其他条带在传输
+            return replies
+        
+        self.session.file_received(file_info.filesize)
+        if receiver.on_file_received:
+            receiver.on_file_received(self.filename, self.file_path, file_info.filesize, self.peer, digest)
+        self.log(f"文件接收完成: {self.filename} ({format_size(file_info.filesize)})")
+        return replies
+    
+    def finish_bundle(self, message, bundle_info, writer):
+        """小文件包的FILE_END：校验整个包，逐个报告接收的文件，日志中只记一行"""
+        receiver = self.receiver
+        complete = writer.close()
+        if not complete or (self.checksum and message.hash != writer.hasher.hexdigest()):
+            receiver.reject_writer(bundle_info, writer)
+            error = "小文件包校验失败" if complete else "小文件包数据不完整"
+            self.log(f"{error}，等待重新发送: {self.filename}")
+            if not self.checksum:
+                raise ValueError(error)
+            return [pack_control_frame(FileAckMessage(bundle_info.stream_id, ok=False, error=error))]
+        
+        receiver.close_bundle_writer(writer)
+        for file_path, file, digest in zip(writer.paths, bundle_info.files, writer.digests):
+            self.session.file_received(file["filesize"])
+            if receiver.on_file_received:
+                receiver.on_file_received(os.path.basename(file_path), file_path, file["filesize"], self.peer, digest)
+        self.log(f"接收了 {self.filename} ({format_size(writer.filesize)})")
+        return [pack_control_frame(FileAckMessage(bundle_info.stream_id))] if self.checksum else []
+    
+    def close(self):
+        """连接结束：中止未完成的文件（记录续传位置）并离开会话"""
+        self.receiver.progress.remove_stream(self.stream)
+        try:
+            if self.writer:
+                self.receiver.abort_writer(self.file_info, self.writer)
+                self.writer = None
+        finally:
+            self.receiver.leave_session(self.session)
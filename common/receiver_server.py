@@ -0,0 +1,369 @@
+"""
+接收端服务器
+在一个asyncio事件循环中接受和处理所有发送端的连接，图形界面和命令行共用
+"""
+import os
+import struct
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from common.protocol import *
+from common.receiver_core import raw_data_size
+
+# 监听队列长度，多台发送端同时连接时不会被拒绝
+DEFAULT_BACKLOG = 128
+# 同时处理的连接数上限，超过时拒绝新连接（发送端的并行连接建立失败时会用已有的连接继续发送）
+DEFAULT_MAX_CONNECTIONS = 64
+# 每条连接在事件循环中缓冲的未解析数据上限（已解析、等待写盘的数据另有上限，见 ConnectionPipeline）
+STREAM_BUFFER_LIMIT = 256 * 1024
+# 原始数据模式下每次读取并写盘的最大字节数
+RAW_READ_SIZE = 1024 * 1024
+# 握手消息的最大长度
+MAX_HANDSHAKE_SIZE = 64 * 1024
+# 停止服务器时等待正在传输的文件完成的最长时间（秒）
+SHUTDOWN_TIMEOUT = 10
+# 连接后等待握手消息的最长时间（秒），不发送握手的连接不能一直占用连接数
+HANDSHAKE_TIMEOUT = 10
+
+class ConnectionPipeline:
+    """一条连接的写盘队列
+    
+    读取把数据帧、控制消息和原始数据依次放入队列，run() 按顺序交给线程池执行
+    （同一连接的操作不能并行）并发送响应，读取不需要等待写盘完成。
+    排队的数据受每条连接和整个服务器两个上限约束（FileReceiver.connection_buffer_limit /
+    max_buffered_bytes），超过时 put() 等待，读取随之暂停。队列为空的连接总可以放入一项，
+    各连接不会互相等待。写盘出错后丢弃剩余的操作，并取消读取任务。
+    只在事件循环线程中使用。
+    """
+    def __init__(self, server, connection, writer, reader_task):
+        self.server = server
+        self.connection = connection
+        self.writer = writer
+        self.reader_task = reader_task
+        # (线程池, 函数, 参数, 数据字节数)
+        self.items = deque()
+        self.buffered = 0
+        # 排队和正在执行的操作数
+        self.pending = 0
+        # 读取任务停在帧边界上
+        self.at_boundary = False
+        self.closed = False
+        self.error = None
+        self.wakeup = asyncio.Event()
+        self.runner = asyncio.ensure_future(self.run())
+    
+    @property
+    def idle(self):
+        """帧边界上没有排队的操作，也没有打开的文件，可以随时断开"""
+        return self.at_boundary and not self.pending and self.connection.writer is None
+    
+    async def put(self, executor, func, args, size):
+        """放入一项操作，超过排队上限时等待；写盘已经出错时抛出对应的异常"""
+        server = self.server
+        receiver = server.receiver
+        while not (self.runner.done() or self.buffered == 0 or (
+                self.buffered + size <= receiver.connection_buffer_limit
+                and server.buffered_bytes + size <= receiver.max_buffered_bytes)):
+            await server.buffer_released.wait()
+        if self.runner.done():
+            raise self.error or ConnectionError("写盘队列已关闭")
+        self.buffered += size
+        server.buffered_bytes += size
+        self.items.append((executor, func, args, size))
+        self.pending += 1
+        self.wakeup.set()
+    
+    def handle_message(self, message):
+        """处理控制消息，返回要发送的响应（在线程池中执行）"""
+        return self.connection.handle_message(message)[0]
+    
+    async def close(self, drain=True):
+        """停止写盘任务；drain为True时先处理完队列中剩余的操作，否则只等待正在执行的操作"""
+        if not drain:
+            self._discard()
+        self.closed = True
+        self.wakeup.set()
+        await asyncio.wait([self.runner])
+    
+    async def run(self):
+        server = self.server
+        try:
+            while True:
+                if not self.items:
+                    if self.closed:
+                        return
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                executor, func, args, size = self.items.popleft()
+                try:
+                    replies = await server.loop.run_in_executor(executor, func, *args)
+                finally:
+                    self.pending -= 1
+                    self._release(size)
+                if replies:
+                    for data in replies:
+                        self.writer.write(data)
+                    await self.writer.drain()
+                if server.stopping.is_set() and self.idle:
+                    self.reader_task.cancel()
+        except Exception as e:
+            self.error = e
+            if not self.closed:
+                self.reader_task.cancel()
+        finally:
+            self._discard()
+            server.notify_buffer_released()
+    
+    def _release(self, size):
+        self.buffered -= size
+        self.server.buffered_bytes -= size
+        self.server.notify_buffer_released()
+    
+    def _discard(self):
+        while self.items:
+            self.pending -= 1
+            self._release(self.items.popleft()[3])
+
+class ReceiverServer:
+    """asyncio接收服务器
+    
+    所有连接的网络读写都在同一个事件循环线程中进行，写盘、校验和查询等阻塞操作
+    交给线程池（ReceiveConnection 的方法）。读取到的帧放入每条连接的写盘队列（ConnectionPipeline），
+    磁盘短暂变慢时仍继续读取；排队的数据超过上限时暂停读取，连接的读缓冲区写满，
+    TCP窗口随之收缩，发送端自然放慢。
+    BATCH_END需要等待同一会话的其他连接，使用单独的线程池，避免占满写盘线程后互相等待。
+    
+    停止时立即关闭监听socket，空闲的连接立即断开，正在传输文件的连接在
+    shutdown_timeout 秒内完成当前文件后断开，超时的连接被中止并记录续传位置。
+    连接后 handshake_timeout 秒内没有收到完整握手消息的连接被断开。
+    """
+    def __init__(self, receiver, host='', port=PORT, backlog=DEFAULT_BACKLOG,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, io_workers=None, shutdown_timeout=SHUTDOWN_TIMEOUT,
+                 handshake_timeout=HANDSHAKE_TIMEOUT):
+        self.receiver = receiver
+        self.log = receiver.log
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.io_workers = io_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.shutdown_timeout = shutdown_timeout
+        self.handshake_timeout = handshake_timeout
+        
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.error = None
+        self.stopping = None
+        self.io_executor = None
+        self.wait_executor = None
+        # 正在处理的连接任务，以及正在接收文件的任务的写盘队列
+        self.tasks = set()
+        self.pipelines = {}
+        # 所有连接排队等待写盘的数据量，减少时设置 buffer_released（之后换成新的Event）
+        self.buffered_bytes = 0
+        self.buffer_released = None
+    
+    def start(self):
+        """在后台线程中运行服务器，开始监听后返回；无法监听时抛出异常"""
+        self.thread = threading.Thread(target=self.run, name="receiver-server", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+    
+    def run(self, handle_signals=False):
+        """在当前线程中运行服务器直到停止；handle_signals为True时Ctrl+C触发正常停止（仅主线程）"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.io_executor = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="receiver-io")
+        self.wait_executor = ThreadPoolExecutor(max_workers=self.max_connections,
+                                                thread_name_prefix="receiver-batch")
+        try:
+            if handle_signals:
+                self._install_signal_handlers()
+            self.loop.run_until_complete(self._serve())
+        except Exception as e:
+            self.error = e
+            if self.ready.is_set():
+                self.log(f"服务器错误: {str(e)}")
+        finally:
+            self.ready.set()
+            self.io_executor.shutdown(wait=True)
+            self.wait_executor.shutdown(wait=False)
+            self.loop.close()
+    
+    def stop(self):
+        """请求停止服务器，可以从任意线程调用，不等待停止完成"""
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._begin_shutdown)
+            except RuntimeError:
+                # 事件循环已经关闭
+                pass
+    
+    def join(self, timeout=None):
+        """等待后台线程中的服务器停止"""
+        if self.thread:
+            self.thread.join(timeout)
+    
+    def _install_signal_handlers(self):
+        """收到SIGINT/SIGTERM时正常停止，不支持的平台（Windows）上忽略"""
+        import signal
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, self._begin_shutdown)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
+    
+    def _begin_shutdown(self):
+        """开始停止：不再接受新连接，断开空闲的连接"""
+        if self.stopping is None or self.stopping.is_set():
+            return
+        self.stopping.set()
+        for pipeline in list(self.pipelines.values()):
+            if pipeline.idle:
+                pipeline.reader_task.cancel()
+    
+    async def _serve(self):
+        self.stopping = asyncio.Event()
+        self.buffer_released = asyncio.Event()
+        server = await asyncio.start_server(self._handle_client, host=self.host or None, port=self.port,
+                                            backlog=self.backlog, limit=STREAM_BUFFER_LIMIT)
+        self.ready.set()
+        try:
+            await self.stopping.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            
+            # 等待正在传输的连接完成当前文件，超时后中止
+            if self.tasks:
+                _, pending = await asyncio.wait(list(self.tasks), timeout=self.shutdown_timeout)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+    
+    def notify_buffer_released(self):
+        """唤醒等待排队空间的连接"""
+        self.buffer_released.set()
+        self.buffer_released = asyncio.Event()
+    
+    async def _run_io(self, func, *args):
+        """在写盘线程池中执行阻塞操作"""
+        return await self.loop.run_in_executor(self.io_executor, func, *args)
+    
+    async def _handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        addr = writer.get_extra_info('peername') or ("?", 0)
+        try:
+            if self.stopping.is_set():
+                return
+            self.log(f"客户端连接: {addr[0]}:{addr[1]}")
+            try:
+                await self._serve_client(reader, writer, addr)
+            finally:
+                self.log(f"客户端断开连接: {addr[0]}:{addr[1]}")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.log(f"处理客户端连接时出错: {str(e)}")
+        finally:
+            writer.close()
+            self.tasks.discard(task)
+    
+    async def _serve_client(self, reader, writer, addr):
+        # 连接数超过上限时不再读取握手消息，直接拒绝
+        if len(self.tasks) > self.max_connections:
+            self.log(f"连接数已达上限（{self.max_connections}），拒绝客户端 {addr[0]}:{addr[1]}")
+            writer.write(pack_message(ErrorMessage("接收端连接数已达上限")))
+            await writer.drain()
+            return
+        
+        try:
+            handshake = await asyncio.wait_for(self._read_handshake(reader), self.handshake_timeout)
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.TimeoutError:
+            self.log(f"等待握手超时，断开客户端 {addr[0]}:{addr[1]}")
+            return
+        
+        response, connection = self.receiver.answer_handshake(handshake, addr[0])
+        if response is not None:
+            writer.write(pack_message(response))
+            await writer.drain()
+        if connection is None:
+            return
+        
+        try:
+            await self._receive_files(reader, writer, connection)
+        finally:
+            await self._run_io(connection.close)
+    
+    async def _read_handshake(self, reader):
+        """读取握手阶段的消息：4字节长度 + JSON"""
+        header = await reader.readexactly(HEADER_SIZE)
+        msg_len = struct.unpack('!I', header)[0]
+        if msg_len > MAX_HANDSHAKE_SIZE:
+            raise ProtocolError(f"握手消息过长: {msg_len}")
+        return ProtocolMessage.from_json((await reader.readexactly(msg_len)).decode('utf-8'))
+    
+    async def _receive_files(self, reader, writer, connection):
+        task = asyncio.current_task()
+        pipeline = ConnectionPipeline(self, connection, writer, task)
+        self.pipelines[task] = pipeline
+        cancelled = False
+        try:
+            await self._read_frames(reader, connection, pipeline)
+        except asyncio.CancelledError:
+            # 停止服务器或写盘出错时取消读取
+            cancelled = True
+            raise
+        finally:
+            del self.pipelines[task]
+            # 连接结束前等待排队的数据写完（取消时只等待正在执行的操作），之后才能关闭文件
+            await pipeline.close(drain=not cancelled)
+            if pipeline.error:
+                raise pipeline.error
+    
+    async def _read_frames(self, reader, connection, pipeline):
+        while self.receiver.is_running:
+            # 帧边界上没有排队的操作和打开的文件时可以随时断开
+            if pipeline.idle and self.stopping.is_set():
+                return
+            pipeline.at_boundary = True
+            try:
+                header = await reader.readexactly(FRAME_HEADER_SIZE)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise ConnectionError("连接在帧头读取完成前关闭")
+                return
+            finally:
+                pipeline.at_boundary = False
+            
+            frame_type, flags, stream_id, length = FRAME_HEADER.unpack(header)
+            # 超过协商块大小的数据帧或过长的控制帧直接断开，不按对方声明的长度缓冲
+            check_frame_length(frame_type, length, connection.chunk_size)
+            payload = await reader.readexactly(length)
+            if frame_type == FRAME_DATA:
+                await pipeline.put(self.io_executor, connection.handle_data, (flags, stream_id, payload), length)
+                continue
+            if frame_type != FRAME_CONTROL:
+                raise ValueError(f"未知的帧类型: {frame_type}")
+            
+            message = parse_control_frame(payload)
+            executor = self.wait_executor if message.msg_type == MSG_TYPE_BATCH_END else self.io_executor
+            await pipeline.put(executor, pipeline.handle_message, (message,), length)
+            
+            # 原始数据模式：文件内容紧跟在FILE_INFO之后，分块读取放入写盘队列
+            remaining = raw_data_size(message)
+            while remaining > 0:
+                data = await reader.readexactly(min(RAW_READ_SIZE, remaining))
+                await pipeline.put(self.io_executor, connection.write_raw, (data,), len(data))
+                remaining -= len(data)
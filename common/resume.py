@@ -0,0 +1,87 @@
+"""
+断点续传
+接收端记录中断文件已写入的字节数，发送端重新发送时从断点继续
+"""
+import os
+import json
+import threading
+
+# 续传记录文件名，没有指定记录文件时保存在接收目录中
+RESUME_INDEX_FILENAME = ".desktransfer_resume.json"
+
+class ResumeIndex:
+    """接收端的续传记录
+    
+    以文件ID（common.utils.generate_file_id）为键，记录中断文件的保存路径、
+    文件大小和已写入的字节数。文件接收完成后删除对应记录。
+    记录保存为JSON文件 index_file，接收端重启后仍可续传。图形界面和命令行每次启动都会创建新的接收目录，
+    因此记录放在固定的位置，中断的部分文件留在原来的接收目录中，续传时在原处继续写入。
+    保存失败时通过 log(message) 报告。
+    """
+    def __init__(self, index_file, log=None):
+        self.path = index_file
+        self.log = log or print
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.load()
+    
+    def load(self):
+        """加载续传记录"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+    
+    def save(self):
+        """保存续传记录（调用方持有锁）"""
+        try:
+            if self.entries:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                temp_path = self.path + ".tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self.entries, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+        except OSError as e:
+            self.log(f"保存续传记录失败: {e}")
+    
+    def offset(self, file_id, filesize):
+        """返回文件已接收的字节数，没有可用记录时返回0"""
+        with self.lock:
+            entry = self.entries.get(file_id)
+        if not entry or entry["filesize"] != filesize:
+            return 0
+        # 部分文件被删除或截断后不能续传
+        try:
+            if os.path.getsize(entry["path"]) < entry["received"]:
+                return 0
+        except OSError:
+            return 0
+        return entry["received"]
+    
+    def get(self, file_id):
+        """返回文件的续传记录 (路径, 已接收字节数)，没有记录时返回None"""
+        with self.lock:
+            entry = self.entries.get(file_id)
+        if not entry:
+            return None
+        return entry["path"], entry["received"]
+    
+    def record(self, file_id, path, filesize, received):
+        """记录中断文件已写入的字节数"""
+        if not file_id:
+            return
+        with self.lock:
+            if received > 0:
+                self.entries[file_id] = {"path": path, "filesize": filesize, "received": received}
+            else:
+                self.entries.pop(file_id, None)
+            self.save()
+    
+    def remove(self, file_id):
+        """文件接收完成，删除续传记录"""
+        with self.lock:
+            if self.entries.pop(file_id, None) is not None:
+                self.save()
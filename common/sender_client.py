@@ -0,0 +1,462 @@
+"""
+异步发送端
+基于asyncio的发送客户端：文件读取、哈希和压缩在线程池中进行，与网络发送重叠，
+源文件在慢速网络共享上时也能接近满速发送。可以在脚本中直接使用：
+    
+    asyncio.run(send_files("192.168.1.10", ["a.bmp", "b.png"], stream_count=2))
+"""
+import os
+import struct
+import asyncio
+import threading
+import uuid
+from collections import deque
+
+from common.protocol import *
+from common.content_index import new_hasher
+from common.compression import Codec, available_codecs, SAMPLE_SIZE, MIN_COMPRESS_SIZE
+from common.sender_core import (BatchPlan, stat_files, dedup_query_files, existing_indexes, resume_query_files,
+                                resume_offsets, DEFAULT_STREAM_COUNT)
+
+# 异步客户端支持的功能，增量传输（需要逐块比较签名）和小文件打包只由 SenderConnection 支持
+ASYNC_FEATURES = [feature for feature in SUPPORTED_FEATURES if feature not in (FEATURE_DELTA, FEATURE_BUNDLE)]
+# 每次读取和发送的最大字节数
+READ_SIZE = 1024 * 1024
+# 每个文件预先提交的读取数，慢速存储上多个读取同时进行
+READ_AHEAD = 4
+# 连接的读缓冲区大小，发送端只读取控制消息
+STREAM_LIMIT = 1024 * 1024
+
+def read_at(f, offset, size, lock):
+    """从offset处读取size字节，不依赖也不改变文件位置，可以在多个线程中同时调用"""
+    if hasattr(os, 'pread'):
+        return os.pread(f.fileno(), size, offset)
+    # Windows没有pread，定位和读取需要加锁
+    with lock:
+        f.seek(offset)
+        return f.read(size)
+
+class AsyncSenderConnection:
+    """到接收端的一条异步连接
+    
+    接收端的响应（查询结果和FILE_ACK）由后台任务按到达顺序交给等待者，
+    发送文件时不必等待上一个文件的校验结果。
+    executor 为读取文件使用的线程池，None表示事件循环的默认线程池。
+    """
+    def __init__(self, ip_address, port=PORT, client_name="DeskTransfer Sender", session_id=None, executor=None):
+        self.ip_address = ip_address
+        self.port = port
+        self.client_name = client_name
+        self.session_id = session_id or uuid.uuid4().hex
+        self.executor = executor
+        self.reader = None
+        self.writer = None
+        self.receiver_name = ""
+        self.features = []
+        self.max_chunk_size = DEFAULT_CHUNK_SIZE
+        self.codec = None
+        self.broken = False
+        # 等待接收端响应的Future，按发送顺序排列
+        self.waiters = deque()
+        self.receive_task = None
+    
+    @property
+    def checksum(self):
+        """是否与接收端协商了端到端校验"""
+        return FEATURE_CHECKSUM in self.features
+    
+    async def connect(self):
+        """建立连接并完成握手，失败时抛出异常"""
+        self.reader, self.writer = await asyncio.open_connection(self.ip_address, self.port, limit=STREAM_LIMIT)
+        try:
+            handshake = HandshakeMessage(client_name=self.client_name, protocol_version=PROTOCOL_VERSION,
+                                         features=ASYNC_FEATURES, chunk_size=MAX_CHUNK_SIZE,
+                                         session_id=self.session_id, codecs=available_codecs())
+            self.writer.write(pack_message(handshake))
+            await self.writer.drain()
+            
+            try:
+                header = await self.reader.readexactly(HEADER_SIZE)
+                msg_len = struct.unpack('!I', header)[0]
+                if msg_len > MAX_CONTROL_FRAME_SIZE:
+                    raise ProtocolError(f"握手响应过长: {msg_len}")
+                response = ProtocolMessage.from_json((await self.reader.readexactly(msg_len)).decode('utf-8'))
+            except asyncio.IncompleteReadError:
+                raise ConnectionError("未收到响应")
+            
+            if response.msg_type == MSG_TYPE_ERROR:
+                raise ConnectionError(response.error_msg)
+            if response.msg_type != MSG_TYPE_HANDSHAKE:
+                raise ConnectionError(f"无效的握手响应: {response.msg_type}")
+            
+            negotiate_protocol_version(response.protocol_version)
+            self.features = negotiate_features(response.features)
+            self.max_chunk_size = negotiate_chunk_size(response.chunk_size)
+            self.receiver_name = response.client_name
+            if FEATURE_COMPRESSION in self.features and response.codecs:
+                self.codec = Codec(response.codecs[0])
+        except Exception:
+            await self.close()
+            raise
+        
+        self.receive_task = asyncio.ensure_future(self._receive_responses())
+    
+    async def open_stream(self):
+        """使用相同的会话ID再建立一条并行连接"""
+        connection = AsyncSenderConnection(self.ip_address, self.port, self.client_name, self.session_id,
+                                           self.executor)
+        await connection.connect()
+        return connection
+    
+    async def _receive_responses(self):
+        """按顺序读取接收端的控制消息，交给对应的等待者"""
+        try:
+            while True:
+                try:
+                    header = await self.reader.readexactly(FRAME_HEADER_SIZE)
+                    frame_type, flags, stream_id, length = FRAME_HEADER.unpack(header)
+                    if frame_type != FRAME_CONTROL:
+                        raise ConnectionError(f"期望控制帧，收到帧类型: {frame_type}")
+                    check_frame_length(frame_type, length, 0)
+                    payload = await self.reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    raise ConnectionError("连接已关闭")
+                message = parse_control_frame(payload)
+                if not self.waiters:
+                    raise ConnectionError(f"收到意外的消息: {message.msg_type}")
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(message)
+        except asyncio.CancelledError:
+            error = ConnectionError("连接已关闭")
+        except Exception as e:
+            error = e
+        self.broken = True
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(error)
+    
+    def _expect_response(self):
+        """登记一个等待中的响应，必须在发送对应的消息之前调用"""
+        waiter = asyncio.get_running_loop().create_future()
+        if self.broken:
+            waiter.set_exception(ConnectionError("与接收端的连接已中断"))
+        else:
+            self.waiters.append(waiter)
+        return waiter
+    
+    async def _send_control(self, message):
+        self.writer.write(pack_control_frame(message))
+        await self.writer.drain()
+    
+    async def request(self, message, response_type):
+        """发送控制消息并等待指定类型的响应"""
+        try:
+            waiter = self._expect_response()
+            await self._send_control(message)
+            response = await waiter
+            if response.msg_type == MSG_TYPE_ERROR:
+                raise ConnectionError(response.error_msg)
+            if response.msg_type != response_type:
+                raise ConnectionError(f"无效的响应: {response.msg_type}")
+        except Exception:
+            self.broken = True
+            raise
+        return response
+    
+    async def query_resume(self, files):
+        """查询接收端已接收的字节数，返回 {file_id: 字节数}；文件较多时分成几条消息查询"""
+        offsets = {}
+        for start in range(0, len(files), QUERY_BATCH_SIZE):
+            response = await self.request(ResumeQueryMessage(files[start:start + QUERY_BATCH_SIZE]),
+                                          MSG_TYPE_RESUME_INFO)
+            offsets.update(response.offsets)
+        return offsets
+    
+    async def query_dedup(self, files):
+        """查询接收端已有的文件，返回 DedupInfoMessage；文件较多时分成几条消息查询"""
+        candidates = []
+        existing = []
+        for start in range(0, len(files), QUERY_BATCH_SIZE):
+            response = await self.request(DedupQueryMessage(files[start:start + QUERY_BATCH_SIZE]),
+                                          MSG_TYPE_DEDUP_INFO)
+            candidates += response.candidates
+            existing += response.existing
+        return DedupInfoMessage(candidates=candidates, existing=existing)
+    
+    async def send_file(self, file_path, current_file=1, file_count=1, progress=None, should_continue=None,
+                        offset=0, length=None, file_id=None, transfer_id=None):
+        """发送一个文件（或其中 [offset, offset+length) 的一段）
+        
+        返回等待接收端校验结果（FileAckMessage）的Future，没有协商校验时返回None。
+        调用方可以先发送下一个文件，之后再等待校验结果。
+        should_continue 在每个数据块之前检查，返回False时抛出 ConnectionAbortedError。
+        """
+        loop = asyncio.get_running_loop()
+        filename = os.path.basename(file_path)
+        f = await loop.run_in_executor(self.executor, open, file_path, 'rb')
+        try:
+            filesize = os.fstat(f.fileno()).st_size
+            data_size = filesize if length is None else length
+            if offset + data_size > filesize:
+                raise ValueError(f"条带范围超出文件大小: {filename}")
+            compress = False
+            if self.codec is not None and data_size >= MIN_COMPRESS_SIZE:
+                sample = await loop.run_in_executor(self.executor, read_at, f, offset,
+                                                    min(SAMPLE_SIZE, data_size), threading.Lock())
+                compress = await loop.run_in_executor(self.executor, self.codec.worth_compressing, sample)
+            raw = not compress and FEATURE_RAW_DATA in self.features and data_size >= RAW_DATA_THRESHOLD
+            hasher = new_hasher() if self.checksum else None
+            add_bytes = progress.add_bytes if progress else None
+            if progress:
+                progress.start_file(current_file, filename, data_size)
+            
+            try:
+                await self._send_control(FileInfoMessage(
+                    filename=filename,
+                    filesize=filesize,
+                    file_count=file_count,
+                    current_file=current_file,
+                    stream_id=current_file,
+                    raw=raw,
+                    offset=offset,
+                    length=length,
+                    file_id=file_id,
+                    transfer_id=transfer_id
+                ))
+                
+                if raw and hasher is None:
+                    await self._sendfile(f, offset, data_size, add_bytes, should_continue)
+                else:
+                    await self._send_pipelined(f, offset, data_size, current_file, raw, hasher, compress, add_bytes,
+                                               should_continue)
+                
+                ack = self._expect_response() if self.checksum else None
+                await self._send_control(FileEndMessage(hasher.hexdigest() if hasher else None))
+            except Exception:
+                self.broken = True
+                raise
+        finally:
+            f.close()
+        return ack
+    
+    async def _sendfile(self, f, offset, size, add_bytes, should_continue):
+        """原始数据模式：分段使用 loop.sendfile 零拷贝发送"""
+        loop = asyncio.get_running_loop()
+        sent_bytes = 0
+        while sent_bytes < size:
+            if should_continue and not should_continue():
+                raise ConnectionAbortedError("发送已取消")
+            count = min(RAW_SEGMENT_SIZE, size - sent_bytes)
+            sent = await loop.sendfile(self.writer.transport, f, offset + sent_bytes, count)
+            if sent == 0:
+                raise IOError("文件在发送过程中被截断")
+            sent_bytes += sent
+            if add_bytes:
+                add_bytes(sent)
+    
+    async def _send_pipelined(self, f, offset, size, stream_id, raw, hasher, compress, add_bytes, should_continue):
+        """在线程池中预读、哈希和压缩后续的数据块，同时发送已准备好的数据块
+        
+        返回前等待所有已提交的读取结束，调用方随后可以安全地关闭文件。
+        """
+        loop = asyncio.get_running_loop()
+        chunk_size = min(self.max_chunk_size, READ_SIZE)
+        codec = self.codec
+        lock = threading.Lock()
+        ready = asyncio.Queue(READ_AHEAD)
+        
+        def prepare(data):
+            # 同一文件的数据块按顺序逐个处理，哈希的顺序与文件内容一致
+            if hasher:
+                hasher.update(data)
+            if compress:
+                compressed = codec.compress(data)
+                if len(compressed) < len(data):
+                    return compressed, FRAME_FLAG_COMPRESSED, len(data)
+            return data, 0, len(data)
+        
+        async def produce():
+            reads = deque()
+            position = offset
+            end = offset + size
+            try:
+                while position < end or reads:
+                    while position < end and len(reads) < READ_AHEAD:
+                        count = min(chunk_size, end - position)
+                        reads.append((loop.run_in_executor(self.executor, read_at, f, position, count, lock), count))
+                        position += count
+                    # 已经在线程中执行的读取无法取消，读取完成之前一直留在队列中
+                    future, count = reads[0]
+                    data = await asyncio.shield(future)
+                    reads.popleft()
+                    if len(data) != count:
+                        raise IOError("文件在发送过程中被截断")
+                    await ready.put(await loop.run_in_executor(self.executor, prepare, data))
+                await ready.put(None)
+            except Exception as e:
+                await ready.put(e)
+            finally:
+                if reads:
+                    await asyncio.wait([future for future, _ in reads])
+        
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                item = await ready.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if should_continue and not should_continue():
+                    raise ConnectionAbortedError("发送已取消")
+                payload, flags, count = item
+                if raw:
+                    self.writer.write(payload)
+                else:
+                    self.writer.write(FRAME_HEADER.pack(FRAME_DATA, flags, stream_id, len(payload)))
+                    self.writer.write(payload)
+                await self.writer.drain()
+                if add_bytes:
+                    add_bytes(count)
+        finally:
+            producer.cancel()
+            await asyncio.wait([producer])
+    
+    async def send_batch_end(self, file_count=None):
+        """发送批量传输结束消息"""
+        await self._send_control(BatchEndMessage(file_count))
+    
+    async def close(self):
+        """关闭连接"""
+        if self.receive_task:
+            self.receive_task.cancel()
+            self.receive_task = None
+        if self.writer:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+async def query_existing_files(connection, file_paths, filesizes, file_ids, log):
+    """向接收端查询已有的文件，返回不需要发送的文件下标集合；候选文件的哈希在线程池中计算"""
+    if FEATURE_DEDUP not in connection.features:
+        return set()
+    
+    loop = asyncio.get_running_loop()
+    files = dedup_query_files(file_paths, filesizes, file_ids)
+    candidates = set((await connection.query_dedup(files)).candidates) if files else set()
+    files = []
+    if candidates:
+        files = await loop.run_in_executor(connection.executor, dedup_query_files,
+                                           file_paths, filesizes, file_ids, candidates)
+    if not files:
+        return set()
+    return existing_indexes(file_ids, (await connection.query_dedup(files)).existing, log)
+
+async def query_resume_offsets(connection, file_paths, filesizes, file_ids, skipped, log):
+    """向接收端查询每个文件的续传位置，返回续传位置列表"""
+    if FEATURE_RESUME not in connection.features:
+        return [0] * len(file_paths)
+    
+    files = resume_query_files(file_paths, filesizes, file_ids, skipped)
+    remote_offsets = (await connection.query_resume(files)) if files else {}
+    return resume_offsets(file_paths, filesizes, file_ids, skipped, remote_offsets, log)
+
+async def send_batch(connection, file_paths, stream_count=DEFAULT_STREAM_COUNT, progress=None,
+                     should_continue=None, on_file_done=None, log=None):
+    """发送一批文件，任务划分和完成状态由 BatchPlan 管理（不含增量传输和小文件打包）
+    
+    每条连接由一个协程发送，文件的校验结果在后台到达，不阻塞下一个文件的发送；
+    校验失败的文件重新放回队列。返回发送成功的文件路径列表。
+    """
+    log = log or (lambda message: None)
+    loop = asyncio.get_running_loop()
+    file_count = len(file_paths)
+    filesizes, file_ids = await loop.run_in_executor(connection.executor, stat_files, file_paths)
+    skipped = await query_existing_files(connection, file_paths, filesizes, file_ids, log)
+    offsets = await query_resume_offsets(connection, file_paths, filesizes, file_ids, skipped, log)
+    plan = BatchPlan(file_paths, filesizes, file_ids, skipped, offsets, progress=progress,
+                     on_file_done=on_file_done, log=log)
+    
+    connections = [connection]
+    for _ in range(min(stream_count, plan.task_count(stream_count)) - 1):
+        try:
+            connections.append(await connection.open_stream())
+        except Exception as e:
+            log(f"建立并行连接失败: {str(e)}")
+            break
+    if len(connections) > 1:
+        log(f"使用 {len(connections)} 条并行连接发送")
+    plan.build(len(connections))
+    
+    async def receive_ack(worker_id, unacked):
+        item, waiter = unacked.popleft()
+        try:
+            ack = await waiter
+        except Exception as e:
+            plan.stripe_done(worker_id, item, e)
+            return
+        if ack.msg_type != MSG_TYPE_FILE_ACK:
+            plan.stripe_done(worker_id, item, ConnectionError(f"无效的响应: {ack.msg_type}"))
+        elif ack.ok:
+            plan.stripe_done(worker_id, item, None)
+        else:
+            plan.stripe_done(worker_id, item, ValueError(ack.error or "接收端校验失败"), rejected=True)
+    
+    async def worker(worker_id, conn):
+        stream = progress.add_stream() if progress else None
+        unacked = deque()
+        try:
+            while not conn.broken and (should_continue is None or should_continue()):
+                # 已经到达的校验结果先处理，失败的文件尽早重新放回队列
+                while unacked and unacked[0][1].done():
+                    await receive_ack(worker_id, unacked)
+                item = plan.queue.get(worker_id)
+                if item is None:
+                    if not unacked:
+                        break
+                    await receive_ack(worker_id, unacked)
+                    continue
+                
+                # 异步客户端不做增量传输，任务中的签名总是None
+                current_file, file_path, offset, length, file_id, transfer_id, _ = item
+                try:
+                    waiter = await conn.send_file(file_path, current_file, file_count, stream, should_continue,
+                                                  offset=offset, length=length, file_id=file_id,
+                                                  transfer_id=transfer_id)
+                except Exception as e:
+                    plan.stripe_done(worker_id, item, e)
+                    continue
+                if waiter is None:
+                    plan.stripe_done(worker_id, item, None)
+                else:
+                    unacked.append((item, waiter))
+            while unacked:
+                await receive_ack(worker_id, unacked)
+        finally:
+            if progress:
+                progress.remove_stream(stream)
+    
+    try:
+        await asyncio.gather(*(worker(i, conn) for i, conn in enumerate(connections)))
+    finally:
+        for conn in connections[1:]:
+            await conn.close()
+    
+    if connection.broken:
+        raise ConnectionError("与接收端的连接已中断")
+    if should_continue is None or should_continue():
+        await connection.send_batch_end(len(plan.sent_files))
+    return plan.sent_files
+
+async def send_files(ip_address, file_paths, port=PORT, stream_count=DEFAULT_STREAM_COUNT, progress=None,
+                     should_continue=None, on_file_done=None, log=None, client_name="DeskTransfer Sender"):
+    """连接接收端、发送一批文件后断开，返回发送成功的文件路径列表"""
+    connection = AsyncSenderConnection(ip_address, port, client_name)
+    await connection.connect()
+    try:
+        return await send_batch(connection, file_paths, stream_count=stream_count, progress=progress,
+                                should_continue=should_continue, on_file_done=on_file_done, log=log)
+    finally:
+        await connection.close()
@@ -0,0 +1,789 @@
+"""
+发送端核心
+与界面无关的连接、握手和文件发送逻辑
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+
+from common.protocol import *
+from common.utils import format_size, generate_file_id
+from common.chunk_sizer import ChunkSizer
+from common.content_index import cached_file_digest, new_hasher
+from common.delta import DELTA_MIN_SIZE, MAX_SIGNATURE_SIZE, COPY_OP, generate_delta, map_file, parse_signature
+from common.compression import Codec, available_codecs, SAMPLE_SIZE, MIN_COMPRESS_SIZE
+
+# 并行连接数
+DEFAULT_STREAM_COUNT = 1
+MAX_STREAM_COUNT = 8
+# 使用多条连接时，不小于该大小的文件拆成条带并发发送
+STRIPE_THRESHOLD = 64 * 1024 * 1024
+# 每个条带的最小大小
+MIN_STRIPE_SIZE = 16 * 1024 * 1024
+# 接收端校验失败的文件最多重新发送的次数
+MAX_CHECKSUM_RETRIES = 2
+# 小于该大小的文件（不需要续传或增量发送时）打包发送，省去每个文件各自的消息往返和写盘同步
+BUNDLE_FILE_THRESHOLD = 256 * 1024
+# 每个包的最大文件数和最大数据量
+BUNDLE_MAX_FILES = 500
+BUNDLE_MAX_BYTES = 8 * 1024 * 1024
+# 每条连接上已发送但尚未收到FILE_ACK的文件数上限，超过后先读取校验结果，
+# 避免接收端因回复积压而阻塞
+MAX_PENDING_ACKS = 64
+
+class SenderConnection:
+    """到接收端的一条连接"""
+    def __init__(self, ip_address, port=PORT, client_name="DeskTransfer Sender", session_id=None):
+        self.ip_address = ip_address
+        self.port = port
+        self.client_name = client_name
+        # 同一批次的并行连接共享会话ID，接收端据此把它们归为一个批次
+        self.session_id = session_id or uuid.uuid4().hex
+        self.sock = None
+        self.reader = None
+        self.receiver_name = ""
+        self.features = []
+        self.max_chunk_size = DEFAULT_CHUNK_SIZE
+        self.rtt = 0.0
+        self.sizer = None
+        self.buffer_view = None
+        # 协商的压缩算法（Codec），接收端不支持时为None
+        self.codec = None
+        # 发送过程中出错后连接上的数据流已不完整，不能继续使用
+        self.broken = False
+    
+    def connect(self):
+        """建立连接并完成握手，失败时抛出异常"""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.sock.connect((self.ip_address, self.port))
+            
+            # 发送握手消息
+            handshake = HandshakeMessage(client_name=self.client_name, protocol_version=PROTOCOL_VERSION,
+                                         features=SUPPORTED_FEATURES, chunk_size=MAX_CHUNK_SIZE,
+                                         session_id=self.session_id, codecs=available_codecs())
+            handshake_started = time.perf_counter()
+            self.sock.sendall(pack_message(handshake))
+            
+            # 接收握手响应
+            # 接收端发来的数据帧只有旧文件的签名
+            self.reader = FrameReader(self.sock, max_data_size=MAX_SIGNATURE_SIZE)
+            response = self.reader.read_message()
+            if response is None:
+                raise ConnectionError("未收到响应")
+            # 握手往返时间作为RTT估计，供块大小调整使用
+            self.rtt = time.perf_counter() - handshake_started
+            
+            if response.msg_type == MSG_TYPE_ERROR:
+                raise ConnectionError(response.error_msg)
+            
+            if response.msg_type != MSG_TYPE_HANDSHAKE:
+                raise ConnectionError(f"无效的握手响应: {response.msg_type}")
+            
+            # 握手之后改用二进制帧
+            negotiate_protocol_version(response.protocol_version)
+            self.features = negotiate_features(response.features)
+            self.max_chunk_size = negotiate_chunk_size(response.chunk_size)
+            self.receiver_name = response.client_name
+            if FEATURE_COMPRESSION in self.features and response.codecs:
+                self.codec = Codec(response.codecs[0])
+        except Exception:
+            self.close()
+            raise
+        
+        # 块大小根据实测吞吐量动态调整，读取缓冲区按协商的最大块大小预分配
+        self.sizer = ChunkSizer(self.max_chunk_size, rtt=self.rtt)
+        self.buffer_view = memoryview(bytearray(self.max_chunk_size))
+    
+    def open_stream(self):
+        """使用相同的会话ID再建立一条并行连接"""
+        connection = SenderConnection(self.ip_address, self.port, self.client_name, self.session_id)
+        connection.connect()
+        return connection
+    
+    def send_file(self, file_path, current_file=1, file_count=1, progress=None, should_continue=None, log=None,
+                  offset=0, length=None, file_id=None, transfer_id=None, signature=None):
+        """发送一个文件（FILE_INFO、文件数据、FILE_END），返回发送的数据字节数
+        
+        progress 为该连接的 StreamProgress；should_continue 返回False时中止发送。
+        指定length时只发送 [offset, offset+length) 这一段，transfer_id 用于接收端合并各段；
+        file_id 为文件标识，接收端据此记录续传位置。
+        signature 为接收端旧文件的 (块大小, 签名表)，指定时以增量方式发送整个文件。
+        协商了校验功能时在读取数据的同时计算哈希，随FILE_END发送，接收端随后回复FILE_ACK（由 read_ack 读取）。
+        """
+        filename = os.path.basename(file_path)
+        
+        # 先打开文件，文件本身的错误不影响连接
+        with open(file_path, 'rb') as f:
+            filesize = os.fstat(f.fileno()).st_size
+            data_size = filesize if length is None else length
+            if offset + data_size > filesize:
+                raise ValueError(f"条带范围超出文件大小: {filename}")
+            delta = signature is not None and length is None
+            compress = self._worth_compressing(f, offset, data_size)
+            # 不压缩的大文件在接收端支持时使用原始数据模式，通过sendfile零拷贝发送
+            raw = (not delta and not compress and FEATURE_RAW_DATA in self.features
+                   and data_size >= RAW_DATA_THRESHOLD)
+            add_bytes = progress.add_bytes if progress else None
+            hasher = new_hasher() if self.checksum else None
+            if progress:
+                progress.start_file(current_file, filename, data_size)
+            
+            try:
+                file_info = FileInfoMessage(
+                    filename=filename,
+                    filesize=filesize,
+                    file_count=file_count,
+                    current_file=current_file,
+                    stream_id=current_file,
+                    raw=raw,
+                    offset=offset,
+                    length=length,
+                    file_id=file_id,
+                    transfer_id=transfer_id,
+                    delta=delta
+                )
+                send_control(self.sock, file_info)
+                
+                if delta:
+                    sent_bytes = self._send_delta(f, signature, current_file, add_bytes, should_continue, hasher,
+                                                  compress)
+                elif raw:
+                    sent_bytes = send_raw_file(self.sock, f, data_size, on_progress=add_bytes,
+                                               should_continue=should_continue, offset=offset,
+                                               hasher=hasher, buffer=self.buffer_view)
+                else:
+                    f.seek(offset)
+                    sent_bytes = self._send_frames(f, data_size, current_file, add_bytes, should_continue, log,
+                                                   hasher, compress)
+                
+                if sent_bytes < data_size:
+                    raise ConnectionAbortedError("发送已取消")
+                
+                send_control(self.sock, FileEndMessage(hasher.hexdigest() if hasher else None))
+            except Exception:
+                self.broken = True
+                raise
+        
+        return data_size
+    
+    def send_bundle(self, files, file_count=1, progress=None, should_continue=None):
+        """把多个小文件打包发送（BUNDLE_INFO、各文件内容依次拼接的数据帧、FILE_END）
+        
+        files 为 [(文件序号, 文件路径, 文件ID), ...]。文件先全部读入内存，读取失败的文件不放入包中，
+        返回 {文件序号: 异常}；文件本身的错误不影响连接，也不影响包中的其他文件。
+        协商了校验功能时FILE_END中的哈希覆盖整个包，接收端整体校验后回复一个FILE_ACK。
+        """
+        errors = {}
+        entries = []
+        contents = []
+        # 实际放入包中的文件序号，包使用第一个文件的序号作为流ID
+        included = []
+        for current_file, file_path, file_id in files:
+            try:
+                with open(file_path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                errors[current_file] = e
+                continue
+            entries.append({"filename": os.path.basename(file_path), "filesize": len(data), "file_id": file_id})
+            contents.append(data)
+            included.append(current_file)
+        if not entries:
+            return errors
+        
+        data = b"".join(contents)
+        view = memoryview(data)
+        first_file = included[0]
+        hasher = new_hasher() if self.checksum else None
+        if progress:
+            progress.start_file(included[-1], f"{len(entries)} 个小文件", len(data))
+        try:
+            send_control(self.sock, BundleInfoMessage(entries, file_count=file_count, current_file=first_file,
+                                                      stream_id=first_file))
+            chunk_size = self.sizer.chunk_size
+            for start in range(0, len(data), chunk_size):
+                if should_continue and not should_continue():
+                    raise ConnectionAbortedError("发送已取消")
+                chunk = view[start:start + chunk_size]
+                if hasher:
+                    hasher.update(chunk)
+                send_frame(self.sock, FRAME_DATA, chunk, stream_id=first_file)
+                if progress:
+                    progress.add_bytes(len(chunk))
+            send_control(self.sock, FileEndMessage(hasher.hexdigest() if hasher else None))
+        except Exception:
+            self.broken = True
+            raise
+        finally:
+            view.release()
+        return errors
+    
+    @property
+    def checksum(self):
+        """是否与接收端协商了端到端校验"""
+        return FEATURE_CHECKSUM in self.features
+    
+    def _worth_compressing(self, f, offset, size):
+        """读取要发送部分的第一块作为样本，判断是否值得压缩"""
+        if self.codec is None or size < MIN_COMPRESS_SIZE:
+            return False
+        f.seek(offset)
+        sample = f.read(min(SAMPLE_SIZE, size))
+        return self.codec.worth_compressing(sample)
+    
+    def _send_data(self, payload, stream_id, compress):
+        """发送一个数据帧，compress为True且压缩后确实变小时发送压缩后的负载"""
+        if compress:
+            compressed = self.codec.compress(payload)
+            if len(compressed) < len(payload):
+                send_frame(self.sock, FRAME_DATA, compressed, flags=FRAME_FLAG_COMPRESSED, stream_id=stream_id)
+                return
+        send_frame(self.sock, FRAME_DATA, payload, stream_id=stream_id)
+    
+    def _send_frames(self, f, size, stream_id, add_bytes, should_continue, log, hasher=None, compress=False):
+        """从文件当前位置以数据帧发送size字节，返回已发送的字节数"""
+        sent_bytes = 0
+        while sent_bytes < size:
+            if should_continue and not should_continue():
+                break
+            
+            started = time.perf_counter()
+            count = f.readinto(self.buffer_view[:min(self.sizer.chunk_size, size - sent_bytes)])
+            if not count:
+                break
+            
+            if hasher:
+                hasher.update(self.buffer_view[:count])
+            self._send_data(self.buffer_view[:count], stream_id, compress)
+            
+            if self.sizer.record(count, time.perf_counter() - started) and log:
+                log(f"块大小调整为: {format_size(self.sizer.chunk_size)}")
+            
+            sent_bytes += count
+            if add_bytes:
+                add_bytes(count)
+        return sent_bytes
+    
+    def _send_delta(self, f, signature, stream_id, add_bytes, should_continue, hasher=None, compress=False):
+        """按旧文件的签名增量发送整个文件，返回已处理的新文件字节数
+        
+        变化的部分以普通数据帧发送，与旧文件相同的连续块以带FRAME_FLAG_COPY的块引用发送。
+        """
+        block_size, table = signature
+        data = map_file(f)
+        view = memoryview(data)
+        ops = generate_delta(data, block_size, table)
+        sent_bytes = 0
+        try:
+            for op, first, second in ops:
+                if should_continue and not should_continue():
+                    break
+                
+                if op == "copy":
+                    send_frame(self.sock, FRAME_DATA, COPY_OP.pack(first, second), flags=FRAME_FLAG_COPY,
+                               stream_id=stream_id)
+                    count = second * block_size
+                    if hasher:
+                        # 哈希覆盖接收端还原出的整个文件，相同的块也从映射中计入
+                        hasher.update(view[sent_bytes:sent_bytes + count])
+                    sent_bytes += count
+                    if add_bytes:
+                        add_bytes(count)
+                    continue
+                
+                chunk_size = self.sizer.chunk_size
+                for start in range(first, second, chunk_size):
+                    end = min(start + chunk_size, second)
+                    if hasher:
+                        hasher.update(view[start:end])
+                    self._send_data(view[start:end], stream_id, compress)
+                    sent_bytes += end - start
+                    if add_bytes:
+                        add_bytes(end - start)
+        finally:
+            # mmap关闭前必须释放所有引用它的memoryview
+            ops.close()
+            view.release()
+            if hasattr(data, 'close'):
+                data.close()
+        return sent_bytes
+    
+    def request(self, message, response_type):
+        """发送控制消息并等待指定类型的响应"""
+        try:
+            send_control(self.sock, message)
+            response = self.reader.read_control()
+            if response is None:
+                raise ConnectionError("连接已关闭")
+            if response.msg_type == MSG_TYPE_ERROR:
+                raise ConnectionError(response.error_msg)
+            if response.msg_type != response_type:
+                raise ConnectionError(f"无效的响应: {response.msg_type}")
+        except Exception:
+            self.broken = True
+            raise
+        return response
+    
+    def read_ack(self):
+        """读取接收端对下一个已发送文件的校验结果，返回 FileAckMessage"""
+        try:
+            response = self.reader.read_control()
+            if response is None:
+                raise ConnectionError("连接已关闭")
+            if response.msg_type == MSG_TYPE_ERROR:
+                raise ConnectionError(response.error_msg)
+            if response.msg_type != MSG_TYPE_FILE_ACK:
+                raise ConnectionError(f"无效的响应: {response.msg_type}")
+        except Exception:
+            self.broken = True
+            raise
+        return response
+    
+    def query_resume(self, files):
+        """查询接收端已接收的字节数
+        
+        files 为 [{"file_id": ..., "filename": ..., "filesize": ...}, ...]，返回 {file_id: 字节数}。
+        文件较多时分成几条消息查询（QUERY_BATCH_SIZE），以下两个查询相同。
+        """
+        offsets = {}
+        for start in range(0, len(files), QUERY_BATCH_SIZE):
+            offsets.update(self.request(ResumeQueryMessage(files[start:start + QUERY_BATCH_SIZE]),
+                                        MSG_TYPE_RESUME_INFO).offsets)
+        return offsets
+    
+    def query_dedup(self, files):
+        """查询接收端已有的文件，返回 DedupInfoMessage"""
+        candidates = []
+        existing = []
+        for start in range(0, len(files), QUERY_BATCH_SIZE):
+            response = self.request(DedupQueryMessage(files[start:start + QUERY_BATCH_SIZE]), MSG_TYPE_DEDUP_INFO)
+            candidates += response.candidates
+            existing += response.existing
+        return DedupInfoMessage(candidates=candidates, existing=existing)
+    
+    def query_delta(self, files):
+        """查询接收端旧文件的块签名，返回 {file_id: (块大小, 签名表)}"""
+        signatures = {}
+        for start in range(0, len(files), QUERY_BATCH_SIZE):
+            signatures.update(self._query_delta(files[start:start + QUERY_BATCH_SIZE]))
+        return signatures
+    
+    def _query_delta(self, files):
+        response = self.request(DeltaQueryMessage(files), MSG_TYPE_DELTA_INFO)
+        signatures = {}
+        try:
+            for entry in response.signatures:
+                frame = self.reader.read_frame()
+                if frame is None:
+                    raise ConnectionError("连接已关闭")
+                frame_type, flags, stream_id, payload = frame
+                if frame_type != FRAME_DATA:
+                    raise ConnectionError(f"期望签名数据帧，收到帧类型: {frame_type}")
+                signatures[entry["file_id"]] = (entry["block_size"], parse_signature(payload))
+        except Exception:
+            self.broken = True
+            raise
+        return signatures
+    
+    def send_batch_end(self, file_count=None):
+        """发送批量传输结束消息"""
+        send_control(self.sock, BatchEndMessage(file_count))
+    
+    def close(self):
+        """关闭连接"""
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+class WorkStealingQueue:
+    """工作窃取队列
+    
+    任务预先轮流分配给各个工作线程，线程优先从自己队列的头部取任务，
+    自己的队列取空后从剩余任务最多的队列尾部窃取，慢连接不会拖住整批传输。
+    deque 的 popleft/pop 本身是线程安全的，不需要额外加锁。
+    """
+    def __init__(self, items, worker_count):
+        self.queues = [deque() for _ in range(worker_count)]
+        for i, item in enumerate(items):
+            self.queues[i % worker_count].append(item)
+    
+    def get(self, worker_id):
+        """取下一个任务，所有队列都为空时返回None"""
+        try:
+            return self.queues[worker_id].popleft()
+        except IndexError:
+            pass
+        
+        while True:
+            victim = max(self.queues, key=len)
+            if not victim:
+                return None
+            try:
+                return victim.pop()
+            except IndexError:
+                # 被其他线程抢先取走，重新选择
+                continue
+    
+    def put(self, worker_id, item):
+        """把任务重新放回指定工作线程的队列（如校验失败需要重新发送的文件）"""
+        self.queues[worker_id].append(item)
+
+def split_stripes(filesize, stream_count, start=0):
+    """把文件中 [start, filesize) 的部分拆成若干条带，返回 [(offset, length), ...]；不需要拆分时返回None"""
+    size = filesize - start
+    if stream_count < 2 or size < STRIPE_THRESHOLD:
+        return None
+    stripe_count = min(stream_count, size // MIN_STRIPE_SIZE)
+    stripe_size = -(-size // stripe_count)
+    return [(offset, min(stripe_size, filesize - offset)) for offset in range(start, filesize, stripe_size)]
+
+def describe_file(file_path, filesize, file_id):
+    """批次开始前的查询消息中描述一个文件"""
+    return {"file_id": file_id, "filename": os.path.basename(file_path), "filesize": filesize}
+
+def stat_files(file_paths):
+    """返回 (文件大小列表, 文件ID列表)，无法访问的文件大小为0、ID为None，发送时再报告错误"""
+    filesizes = []
+    file_ids = []
+    for file_path in file_paths:
+        try:
+            filesizes.append(os.path.getsize(file_path))
+            file_ids.append(generate_file_id(file_path))
+        except OSError:
+            filesizes.append(0)
+            file_ids.append(None)
+    return filesizes, file_ids
+
+def dedup_query_files(file_paths, filesizes, file_ids, candidates=None):
+    """去重查询中列出的文件
+    
+    第一轮（candidates为None）只列出文件大小，接收端返回有同样大小文件的候选；
+    第二轮只为候选文件计算内容哈希（会读取文件），无法读取的文件不参与查询。
+    """
+    files = []
+    for file_path, filesize, file_id in zip(file_paths, filesizes, file_ids):
+        if not file_id or filesize <= 0:
+            continue
+        if candidates is None:
+            files.append(describe_file(file_path, filesize, file_id))
+            continue
+        if file_id not in candidates:
+            continue
+        try:
+            file_info = describe_file(file_path, filesize, file_id)
+            file_info["hash"] = cached_file_digest(file_path)
+        except OSError:
+            continue
+        files.append(file_info)
+    return files
+
+def existing_indexes(file_ids, existing, log):
+    """根据去重查询的结果返回接收端已有、不需要发送的文件下标集合"""
+    skipped = {i for i, file_id in enumerate(file_ids) if file_id in existing}
+    if skipped:
+        log(f"接收端已有 {len(skipped)} 个文件，跳过传输")
+    return skipped
+
+def resume_query_files(file_paths, filesizes, file_ids, skipped):
+    """续传查询中列出的文件（跳过接收端已有的文件）"""
+    return [describe_file(file_path, filesize, file_id)
+            for i, (file_path, filesize, file_id) in enumerate(zip(file_paths, filesizes, file_ids))
+            if file_id and i not in skipped]
+
+def resume_offsets(file_paths, filesizes, file_ids, skipped, remote_offsets, log):
+    """根据续传查询的结果返回每个文件的续传位置列表"""
+    offsets = [0] * len(file_paths)
+    for i, (file_path, filesize, file_id) in enumerate(zip(file_paths, filesizes, file_ids)):
+        offset = remote_offsets.get(file_id, 0) if file_id and i not in skipped else 0
+        if 0 < offset < filesize:
+            offsets[i] = offset
+            log(f"{os.path.basename(file_path)} 从 {format_size(offset)} 处续传")
+    return offsets
+
+def query_existing_files(connection, file_paths, filesizes, file_ids, log):
+    """向接收端查询已有的文件，返回不需要发送的文件下标集合
+    
+    先只发送文件大小，接收端返回有同样大小文件的候选，
+    再只为候选文件计算内容哈希，避免每次发送前都把整批文件读一遍。
+    """
+    if FEATURE_DEDUP not in connection.features:
+        return set()
+    
+    files = dedup_query_files(file_paths, filesizes, file_ids)
+    candidates = set(connection.query_dedup(files).candidates) if files else set()
+    files = dedup_query_files(file_paths, filesizes, file_ids, candidates) if candidates else []
+    if not files:
+        return set()
+    return existing_indexes(file_ids, connection.query_dedup(files).existing, log)
+
+def query_resume_offsets(connection, file_paths, filesizes, file_ids, skipped, log):
+    """向接收端查询每个文件的续传位置，返回续传位置列表"""
+    if FEATURE_RESUME not in connection.features:
+        return [0] * len(file_paths)
+    
+    files = resume_query_files(file_paths, filesizes, file_ids, skipped)
+    remote_offsets = connection.query_resume(files) if files else {}
+    return resume_offsets(file_paths, filesizes, file_ids, skipped, remote_offsets, log)
+
+def query_delta_signatures(connection, file_paths, filesizes, file_ids, skipped, offsets, log):
+    """向接收端查询可以增量发送的文件，返回 {文件下标: (块大小, 签名表)}"""
+    if FEATURE_DELTA not in connection.features:
+        return {}
+    
+    indexes = [i for i, (filesize, file_id) in enumerate(zip(filesizes, file_ids))
+               if file_id and i not in skipped and not offsets[i] and filesize >= DELTA_MIN_SIZE]
+    if not indexes:
+        return {}
+    
+    remote = connection.query_delta([describe_file(file_paths[i], filesizes[i], file_ids[i]) for i in indexes])
+    signatures = {i: remote[file_ids[i]] for i in indexes if file_ids[i] in remote}
+    for i in signatures:
+        log(f"{os.path.basename(file_paths[i])} 在接收端有旧版本，增量发送")
+    return signatures
+
+class BatchPlan:
+    """一批文件的发送任务和完成状态，同步（sender_core）和异步（sender_client）的 send_batch 共用
+    
+    查询结果确定后由 build 生成任务：接收端已有的文件直接完成，续传的文件只发送剩余的一段，
+    超大文件拆成条带，增量发送的文件带签名，bundling为True时小文件打包发送。
+    任务为 (文件序号, 文件路径, 偏移, 长度, 文件ID, 分段传输ID, 签名)，长度为None表示整个文件；
+    打包发送的小文件为这样的任务组成的列表。
+    每个任务结束后调用 item_done，文件的全部条带结束后调用 on_file_done(file_path, filesize, error)，
+    接收端校验失败的文件整个放回队列重新发送（最多 MAX_CHECKSUM_RETRIES 次）。
+    """
+    def __init__(self, file_paths, filesizes, file_ids, skipped=(), offsets=None, signatures=None,
+                 bundling=False, progress=None, on_file_done=None, log=None):
+        self.file_paths = file_paths
+        self.filesizes = filesizes
+        self.file_ids = file_ids
+        self.skipped = skipped
+        self.offsets = offsets or [0] * len(file_paths)
+        self.signatures = signatures or {}
+        self.progress = progress
+        self.on_file_done = on_file_done
+        self.log = log or (lambda message: None)
+        
+        # 打包发送的小文件（不续传、不增量发送）
+        self.bundled = set()
+        if bundling:
+            self.bundled = {i for i in range(len(file_paths)) if i not in skipped and i not in self.signatures
+                            and not self.offsets[i] and filesizes[i] < BUNDLE_FILE_THRESHOLD}
+        
+        # 文件序号 -> [未完成的条带数, 文件大小, 第一个错误, 已重新发送的次数, 是否校验失败]
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.sent_files = []
+        self.queue = None
+    
+    def task_count(self, stream_count):
+        """可以并行发送的任务数（文件数加上条带拆分多出的数量，小文件按包计算），连接数不超过这个数量"""
+        count = sum(1 if i in self.signatures else
+                    len(split_stripes(self.filesizes[i], stream_count, self.offsets[i]) or [None])
+                    for i in range(len(self.file_paths)) if i not in self.skipped and i not in self.bundled)
+        if self.bundled:
+            count += max(-(-len(self.bundled) // BUNDLE_MAX_FILES),
+                         -(-sum(self.filesizes[i] for i in self.bundled) // BUNDLE_MAX_BYTES))
+        return count
+    
+    def build(self, connection_count):
+        """按实际建立的连接数生成任务，放入工作窃取队列 self.queue"""
+        if self.progress:
+            # 已经在接收端的部分不计入本次传输量
+            skipped_bytes = sum(self.filesizes[i] for i in self.skipped) + sum(self.offsets)
+            self.progress.total_bytes = max(0, self.progress.total_bytes - skipped_bytes)
+        
+        items = []
+        bundle = []
+        bundle_bytes = 0
+        for current_file, (file_path, filesize, file_id, start) in enumerate(
+                zip(self.file_paths, self.filesizes, self.file_ids, self.offsets), 1):
+            if current_file - 1 in self.skipped:
+                # 接收端已在本地复制
+                self.sent_files.append(file_path)
+                if self.on_file_done:
+                    self.on_file_done(file_path, filesize, None)
+                continue
+            signature = self.signatures.get(current_file - 1)
+            if signature:
+                # 增量发送的文件不拆分条带
+                items.append((current_file, file_path, 0, None, file_id, None, signature))
+                self.pending[current_file] = [1, filesize, None, 0, False]
+                continue
+            if current_file - 1 in self.bundled:
+                if len(bundle) >= BUNDLE_MAX_FILES or bundle_bytes + filesize > BUNDLE_MAX_BYTES:
+                    items.append(bundle if len(bundle) > 1 else bundle[0])
+                    bundle = []
+                    bundle_bytes = 0
+                bundle.append((current_file, file_path, 0, None, file_id, None, None))
+                bundle_bytes += filesize
+                self.pending[current_file] = [1, filesize, None, 0, False]
+                continue
+            stripes = split_stripes(filesize, connection_count, start)
+            if stripes:
+                self.log(f"{os.path.basename(file_path)} 拆成 {len(stripes)} 个条带并行发送")
+            elif start:
+                # 续传：只发送剩余的一段
+                stripes = [(start, filesize - start)]
+            if stripes:
+                # 每次发送使用新的ID，前一批次同一文件的分段可能仍在传输
+                transfer_id = uuid.uuid4().hex
+                items.extend((current_file, file_path, offset, length, file_id, transfer_id, None)
+                             for offset, length in stripes)
+            else:
+                items.append((current_file, file_path, 0, None, file_id, None, None))
+            self.pending[current_file] = [len(stripes) if stripes else 1, filesize, None, 0, False]
+        if bundle:
+            items.append(bundle if len(bundle) > 1 else bundle[0])
+        
+        self.queue = WorkStealingQueue(items, connection_count)
+    
+    def stripe_done(self, worker_id, item, error, rejected=False):
+        """一个文件或条带的任务结束，error为None表示发送成功，rejected表示接收端校验失败"""
+        current_file, file_path, file_id = item[0], item[1], item[4]
+        with self.pending_lock:
+            state = self.pending[current_file]
+            state[0] -= 1
+            state[2] = state[2] or error
+            state[4] = state[4] or rejected
+            if state[0] > 0:
+                return
+            # 只在连接仍然可用时重新发送，任务放回当前工作线程的队列
+            retry = state[4] and state[3] < MAX_CHECKSUM_RETRIES and (error is None or rejected)
+            filesize, error = state[1], state[2]
+            if retry:
+                # 接收端校验失败，整个文件重新发送（不再拆分或增量发送）
+                self.pending[current_file] = [1, filesize, None, state[3] + 1, False]
+        if retry:
+            self.log(f"{os.path.basename(file_path)} 校验失败，重新发送")
+            if self.progress:
+                self.progress.total_bytes += filesize
+            self.queue.put(worker_id, (current_file, file_path, 0, None, file_id, None, None))
+            return
+        if error is None:
+            self.sent_files.append(file_path)
+        if self.on_file_done:
+            self.on_file_done(file_path, filesize, error)
+    
+    def item_done(self, worker_id, item, error, rejected=False):
+        """一个任务结束；小文件包中的每个文件分别结束，校验失败的文件各自重新发送"""
+        for member in (item if isinstance(item, list) else [item]):
+            self.stripe_done(worker_id, member, error, rejected)
+
+def send_batch(connection, file_paths, stream_count=1, progress=None, should_continue=None,
+               on_file_done=None, log=None, delta=True):
+    """发送一批文件
+    
+    批次开始前先查询接收端已有的文件（跳过发送）和中断文件已接收的字节数（只发送剩余部分），
+    delta为True时再查询接收端同名旧文件的块签名，这些文件只发送变化的部分。
+    除主连接外再建立 stream_count-1 条并行连接，文件通过工作窃取队列分配给各连接，
+    超大文件拆成条带，由多条连接同时发送。
+    每个文件（的全部条带）结束后调用 on_file_done(file_path, filesize, error)，error为None表示发送成功。
+    全部完成后关闭额外的连接，并在主连接上发送BATCH_END，附带发送成功的文件数，
+    接收端据此等待其他连接上的文件全部到达。
+    """
+    log = log or (lambda message: None)
+    file_count = len(file_paths)
+    filesizes, file_ids = stat_files(file_paths)
+    skipped = query_existing_files(connection, file_paths, filesizes, file_ids, log)
+    offsets = query_resume_offsets(connection, file_paths, filesizes, file_ids, skipped, log)
+    signatures = {}
+    if delta:
+        signatures = query_delta_signatures(connection, file_paths, filesizes, file_ids, skipped, offsets, log)
+    plan = BatchPlan(file_paths, filesizes, file_ids, skipped, offsets, signatures,
+                     bundling=FEATURE_BUNDLE in connection.features, progress=progress,
+                     on_file_done=on_file_done, log=log)
+    
+    connections = [connection]
+    for _ in range(min(stream_count, plan.task_count(stream_count)) - 1):
+        try:
+            connections.append(connection.open_stream())
+        except Exception as e:
+            log(f"建立并行连接失败: {str(e)}")
+            break
+    if len(connections) > 1:
+        log(f"使用 {len(connections)} 条并行连接发送")
+    plan.build(len(connections))
+    
+    def receive_ack(worker_id, conn, unacked):
+        item = unacked.popleft()
+        ack = conn.read_ack()
+        if ack.ok:
+            plan.item_done(worker_id, item, None)
+        else:
+            plan.item_done(worker_id, item, ValueError(ack.error or "接收端校验失败"), rejected=True)
+    
+    def worker(worker_id, conn):
+        stream = progress.add_stream() if progress else None
+        # 已发送、等待接收端校验结果的任务，FILE_ACK按发送顺序到达
+        unacked = deque()
+        try:
+            while not conn.broken and (should_continue is None or should_continue()):
+                if len(unacked) >= MAX_PENDING_ACKS:
+                    receive_ack(worker_id, conn, unacked)
+                    continue
+                
+                item = plan.queue.get(worker_id)
+                if item is None:
+                    if not unacked:
+                        break
+                    # 等待校验结果，失败的文件会重新放回队列
+                    receive_ack(worker_id, conn, unacked)
+                    continue
+                
+                if isinstance(item, list):
+                    try:
+                        errors = conn.send_bundle([(member[0], member[1], member[4]) for member in item],
+                                                  file_count, stream, should_continue)
+                    except Exception as e:
+                        plan.item_done(worker_id, item, e)
+                        continue
+                    # 无法读取的文件没有放入包中
+                    for member in item:
+                        if member[0] in errors:
+                            plan.stripe_done(worker_id, member, errors[member[0]])
+                    item = [member for member in item if member[0] not in errors]
+                    if not item:
+                        continue
+                else:
+                    current_file, file_path, offset, length, file_id, transfer_id, signature = item
+                    try:
+                        conn.send_file(file_path, current_file, file_count, stream, should_continue, log,
+                                       offset=offset, length=length, file_id=file_id, transfer_id=transfer_id,
+                                       signature=signature)
+                    except Exception as e:
+                        plan.stripe_done(worker_id, item, e)
+                        continue
+                if conn.checksum:
+                    unacked.append(item)
+                else:
+                    plan.item_done(worker_id, item, None)
+        except Exception as e:
+            log(f"读取校验结果失败: {str(e)}")
+        finally:
+            # 连接中断或取消时，没有收到校验结果的任务视为失败
+            while unacked:
+                plan.item_done(worker_id, unacked.popleft(), ConnectionError("未收到接收端的校验结果"))
+            if progress:
+                progress.remove_stream(stream)
+    
+    threads = [threading.Thread(target=worker, args=(i, conn), daemon=True) for i, conn in enumerate(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    for conn in connections[1:]:
+        conn.close()
+    
+    if connection.broken:
+        raise ConnectionError("与接收端的连接已中断")
+    if should_continue is None or should_continue():
+        connection.send_batch_end(len(plan.sent_files))
@@ -0,0 +1,53 @@
+"""
+启动计时
+记录程序启动各阶段的耗时，窗口显示后输出与 python -X importtime 类似的报告。
+设置环境变量 DESKTRANSFER_STARTUP_TIMING=1 或使用 --startup-timing 参数时启用
+"""
+import os
+import sys
+import time
+
+STARTUP_TIMING_ENV = "DESKTRANSFER_STARTUP_TIMING"
+STARTUP_TIMING_ARG = "--startup-timing"
+
+def startup_timing_enabled(argv=None):
+    """是否需要输出启动计时报告"""
+    argv = sys.argv if argv is None else argv
+    return STARTUP_TIMING_ARG in argv or os.environ.get(STARTUP_TIMING_ENV, "") not in ("", "0")
+
+class StartupTimer:
+    """启动阶段计时器
+    
+    在启动脚本的最开始创建，每完成一个阶段调用 mark()，窗口显示后调用 finish()。
+    未启用时也记录各阶段（开销可以忽略），只是不输出报告。
+    """
+    def __init__(self, enabled=None):
+        self.enabled = startup_timing_enabled() if enabled is None else enabled
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases = []  # (阶段名称, 本阶段秒数, 累计秒数)
+    
+    def mark(self, name):
+        """记录从上一个阶段结束到现在的耗时"""
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last, now - self.start))
+        self.last = now
+    
+    def report(self):
+        """生成报告文字，每行为 本阶段毫秒 | 累计毫秒 | 阶段名称"""
+        lines = ["startup time: self [ms] | cumulative | phase"]
+        for name, elapsed, total in self.phases:
+            lines.append(f"startup time: {elapsed * 1000:9.1f} | {total * 1000:10.1f} | {name}")
+        return "\n".join(lines)
+    
+    def finish(self, log=None):
+        """窗口已显示，启用时把报告写到标准错误（无控制台的打包程序中没有）和 log"""
+        self.mark("显示窗口")
+        if not self.enabled:
+            return
+        report = self.report()
+        if sys.stderr is not None:
+            print(report, file=sys.stderr, flush=True)
+        if log:
+            for line in report.splitlines():
+                log(line)
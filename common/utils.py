@@ -43,6 +43,15 @@ def format_size(size_bytes):
     else:
         return f"{size_bytes/(1024*1024*1024):.2f} GB"
 
+def format_duration(seconds):
+    """格式化时长显示，如 01:05 或 1:02:03"""
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
 def get_timestamp():
     """获取当前时间戳字符串"""
     return datetime.now().strftime("%Y%m%d_%H%M%S")
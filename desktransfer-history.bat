@@ -0,0 +1,4 @@
+@echo off
+rem DeskTransfer 传输历史查询，不需要图形界面
+python "%~dp0cli\history_cli.py" %*
+exit /b %ERRORLEVEL%
@@ -0,0 +1,4 @@
+@echo off
+rem DeskTransfer 命令行接收端，不需要图形界面
+python "%~dp0cli\receiver_cli.py" %*
+exit /b %ERRORLEVEL%
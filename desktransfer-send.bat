@@ -0,0 +1,4 @@
+@echo off
+rem DeskTransfer 命令行发送端，不需要图形界面
+python "%~dp0cli\sender_cli.py" %*
+exit /b %ERRORLEVEL%
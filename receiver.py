@@ -1,24 +1,30 @@
 #!/usr/bin/env python3
 """
 DeskTransfer 接收端主程序
-启动接收端应用程序
+启动接收端应用程序，使用 --startup-timing 参数时输出启动各阶段的耗时
 """
 import sys
 import os
-import tkinter as tk
-from tkinter import messagebox
-from tkinterdnd2 import TkinterDnD
 
 # 添加项目根目录到系统路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from ui.receiver_ui import ReceiverUI
+from common.startup import StartupTimer
+
+# 尽早开始计时，之后的导入都计入启动时间
+startup_timer = StartupTimer()
 
 def main():
     """主函数"""
     try:
+        from tkinterdnd2 import TkinterDnD
+        startup_timer.mark("导入 tkinter/tkinterdnd2")
+        from ui.receiver_ui import ReceiverUI
+        startup_timer.mark("导入界面模块")
+        
         # 创建主窗口
         root = TkinterDnD.Tk()
+        startup_timer.mark("创建主窗口")
         
         # 设置窗口图标（如果有的话）
         try:
@@ -30,11 +36,16 @@ def main():
         
         # 创建应用实例
         app = ReceiverUI(root)
+        startup_timer.mark("创建界面")
+        
+        # 事件循环第一次空闲时窗口已经显示
+        root.after_idle(startup_timer.finish, app.log_message)
         
         # 运行主循环
         root.mainloop()
         
     except Exception as e:
+        from tkinter import messagebox
         messagebox.showerror("错误", f"应用程序启动失败: {str(e)}")
         sys.exit(1)
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 传输历史数据库
+"""
+import os
+import sys
+import json
+import time
+import threading
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from common.history import HistoryDatabase, make_record
+
+def open_history(tmp_path, **kwargs):
+    """打开临时目录中的历史数据库，返回 (HistoryDatabase, 日志列表)"""
+    logs = []
+    history_db = HistoryDatabase(str(tmp_path / "history.db"), log=logs.append, **kwargs)
+    history_db.loaded.wait(5)
+    assert history_db.error is None
+    return history_db, logs
+
+def test_append_is_written_in_background(tmp_path):
+    """追加的记录由后台线程合并写入，flush 之后可以查询到，重新打开后仍然存在"""
+    history_db, logs = open_history(tmp_path)
+    try:
+        for i in range(50):
+            history_db.append(make_record(f"IMG_{i:04d}.jpg", i * 1000, "192.168.1.20", "网络接收"))
+        assert history_db.flush(5)
+        assert history_db.count() == 50
+    finally:
+        history_db.close()
+    
+    history_db, logs = open_history(tmp_path)
+    try:
+        records = history_db.query()
+        assert len(records) == 50
+        assert records[0]["filename"] == "IMG_0049.jpg"
+        assert records[0]["peer"] == "192.168.1.20"
+        assert logs == []
+    finally:
+        history_db.close()
+
+def test_write_errors_are_logged(tmp_path):
+    """写入失败通过log回调报告，后台线程继续处理之后的记录"""
+    history_db, logs = open_history(tmp_path)
+    try:
+        history_db.append(make_record(None, 0))
+        assert history_db.flush(5)
+        history_db.append(make_record("ok.png", 10))
+        assert history_db.flush(5)
+        assert len(logs) == 1 and "写入历史记录失败" in logs[0]
+        assert [record["filename"] for record in history_db.query()] == ["ok.png"]
+    finally:
+        history_db.close()
+    assert not history_db.thread.is_alive()
+
+def test_legacy_history_imported_once(tmp_path):
+    """旧版本的JSON和JSON Lines历史文件在第一次打开时导入，原文件改名为 .bak"""
+    legacy_json = tmp_path / "history.json"
+    legacy_jsonl = tmp_path / "history.jsonl"
+    legacy_json.write_text(json.dumps([{"time": "2024-05-01 08:00:00", "filename": "a.jpg", "filesize": 1,
+                                        "receiver": "10.0.0.2", "status": "发送成功"}]), encoding='utf-8')
+    legacy_jsonl.write_text(json.dumps({"time": "2024-05-02 08:00:00", "filename": "b.jpg", "filesize": 2,
+                                        "type": "拖拽上传"}) + "\n损坏的行\n", encoding='utf-8')
+    legacy_files = [str(legacy_json), str(legacy_jsonl)]
+    
+    history_db, logs = open_history(tmp_path, legacy_files=legacy_files)
+    try:
+        records = history_db.query()
+        assert [(record["filename"], record["peer"], record["status"]) for record in records] == [
+            ("b.jpg", "", "拖拽上传"), ("a.jpg", "10.0.0.2", "发送成功")]
+    finally:
+        history_db.close()
+    assert not legacy_json.exists() and (tmp_path / "history.json.bak").exists()
+    assert not legacy_jsonl.exists() and (tmp_path / "history.jsonl.bak").exists()
+    
+    history_db, logs = open_history(tmp_path, legacy_files=legacy_files)
+    try:
+        assert history_db.count() == 2
+    finally:
+        history_db.close()
+
+def add_records(history_db):
+    """写入一组固定时间的记录"""
+    records = [
+        ("2024-04-30 23:59:59", "IMG_0001.jpg", "10.0.0.2", "网络接收", "aa"),
+        ("2024-05-01 08:00:00", "IMG_0042.jpg", "10.0.0.2", "网络接收", "bb"),
+        ("2024-05-15 12:00:00", "img_0042 copy.png", "10.0.0.3", "拖拽上传", None),
+        ("2024-05-31 23:00:00", "100%_done.png", "10.0.0.3", "网络接收", "cc"),
+        ("2024-06-01 00:00:00", "IMG_0100.jpg", "10.0.0.2", "网络接收", "bb"),
+    ]
+    for time_text, filename, peer, status, digest in records:
+        record = make_record(filename, 1000, peer, status, "/data/" + filename, digest)
+        record["time"] = time_text
+        history_db.append(record)
+    assert history_db.flush(5)
+
+def test_query_filters(tmp_path):
+    """按日期范围、对方地址、状态、文件名和内容哈希查询，结果按时间从新到旧"""
+    history_db, logs = open_history(tmp_path)
+    try:
+        add_records(history_db)
+        names = lambda **filters: [record["filename"] for record in history_db.query(**filters)]
+        assert names(start="2024-05-01", end="2024-05-31") == ["100%_done.png", "img_0042 copy.png", "IMG_0042.jpg"]
+        assert names(peer="10.0.0.3") == ["100%_done.png", "img_0042 copy.png"]
+        assert names(status="拖拽上传") == ["img_0042 copy.png"]
+        assert names(name="img_0042") == ["img_0042 copy.png", "IMG_0042.jpg"]
+        # LIKE的通配符按普通字符搜索
+        assert names(name="0%_") == ["100%_done.png"]
+        assert names(filename="img_0042.JPG") == ["IMG_0042.jpg"]
+        assert names(digest="bb", peer="10.0.0.2") == ["IMG_0100.jpg", "IMG_0042.jpg"]
+        assert history_db.count(start="2024-05-01", end="2024-05-31", peer="10.0.0.2") == 1
+        assert history_db.count() == 5
+    finally:
+        history_db.close()
+
+def test_query_pages(tmp_path):
+    """按上一页最后一条记录分页，期间新增的记录不会让后面的页重复或遗漏"""
+    history_db, logs = open_history(tmp_path)
+    try:
+        add_records(history_db)
+        first = history_db.query(limit=2)
+        newest_id = history_db.last_id()
+        history_db.append(make_record("new.jpg", 10))
+        assert history_db.flush(5)
+        
+        second = history_db.query(before=(first[-1]["time"], first[-1]["id"]), limit=2)
+        third = history_db.query(before=(second[-1]["time"], second[-1]["id"]), limit=2)
+        assert [record["filename"] for record in first + second + third] == [
+            "IMG_0100.jpg", "100%_done.png", "img_0042 copy.png", "IMG_0042.jpg", "IMG_0001.jpg"]
+        
+        new = history_db.query(since_id=newest_id)
+        assert [record["filename"] for record in new] == ["new.jpg"]
+        assert history_db.last_id() == new[0]["id"]
+        assert history_db.get(new[0]["id"])["filename"] == "new.jpg"
+        assert history_db.get(history_db.last_id() + 1) is None
+    finally:
+        history_db.close()
+
+def test_history_cli(tmp_path, capsys):
+    """命令行查询：每条记录一行，--count 只输出记录数，数据库不存在时退出码为1"""
+    from cli import history_cli
+    history_db, logs = open_history(tmp_path)
+    try:
+        add_records(history_db)
+    finally:
+        history_db.close()
+    db_file = str(tmp_path / "history.db")
+    
+    assert history_cli.main(["--db", db_file, "--name", "IMG_0042", "--since", "2024-05-01"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split("\t")[1] for line in lines] == ["img_0042 copy.png", "IMG_0042.jpg"]
+    assert lines[1].split("\t")[0] == "2024-05-01 08:00:00"
+    
+    assert history_cli.main(["--db", db_file, "--peer", "10.0.0.2", "--count"]) == 0
+    assert capsys.readouterr().out.strip() == "3"
+    
+    assert history_cli.main(["--db", db_file, "-n", "1"]) == 0
+    assert len(capsys.readouterr().out.splitlines()) == 1
+    
+    assert history_cli.main(["--db", str(tmp_path / "missing.db")]) == 1
+
+class FakeTree:
+    """记录调用线程的Treeview替身，after() 的回调由测试在当前线程中执行"""
+    def __init__(self):
+        self.rows = []
+        self.scheduled = []
+        self.threads = set()
+    
+    def configure(self, **kwargs):
+        pass
+    
+    def after(self, ms, func, *args):
+        self.threads.add(threading.get_ident())
+        self.scheduled.append((func, args))
+    
+    def after_idle(self, func, *args):
+        self.after(0, func, *args)
+    
+    def get_children(self):
+        return [iid for iid, values in self.rows]
+    
+    def delete(self, *items):
+        self.rows = [row for row in self.rows if row[0] not in items]
+    
+    def exists(self, iid):
+        return iid in self.get_children()
+    
+    def insert(self, parent, index, iid, values):
+        self.rows.insert(len(self.rows) if index == "end" else index, (iid, values))
+    
+    def run_scheduled(self, timeout=5):
+        """执行到期的回调，直到没有等待中的回调"""
+        deadline = time.monotonic() + timeout
+        while self.scheduled:
+            assert time.monotonic() < deadline
+            func, args = self.scheduled.pop(0)
+            func(*args)
+            time.sleep(0.01)
+
+class FakeScrollbar:
+    def set(self, first, last):
+        pass
+
+def test_history_view_polls_for_writes(tmp_path, monkeypatch):
+    """刷新和显示新记录时写入线程只设置Event，界面线程轮询后查询；滚动到底部时加载下一页"""
+    from ui import history_view
+    monkeypatch.setattr(history_view, "PAGE_SIZE", 2)
+    history_db, logs = open_history(tmp_path)
+    tree = FakeTree()
+    try:
+        add_records(history_db)
+        view = history_view.HistoryView(tree, FakeScrollbar(), history_db, lambda record: record["filename"],
+                                        lambda: {"peer": "10.0.0.2"})
+        view.reload()
+        tree.run_scheduled()
+        assert [values for iid, values in tree.rows] == ["IMG_0100.jpg", "IMG_0042.jpg"]
+        
+        view.on_scroll("0.0", "1.0")
+        tree.run_scheduled()
+        assert [values for iid, values in tree.rows] == ["IMG_0100.jpg", "IMG_0042.jpg", "IMG_0001.jpg"]
+        assert view.exhausted
+        
+        history_db.append(make_record("new.jpg", 10, "10.0.0.2"))
+        history_db.append(make_record("other.jpg", 10, "10.0.0.9"))
+        view.show_new()
+        tree.run_scheduled()
+        assert [values for iid, values in tree.rows][0] == "new.jpg"
+        assert len(tree.rows) == 4
+        # 只有界面线程（测试线程）调用过Treeview
+        assert tree.threads == {threading.get_ident()}
+    finally:
+        history_db.close(timeout=5)
+    assert not history_db.thread.is_alive()
@@ -3,18 +3,22 @@
 命令行版本的接收端 - 用于测试
 """
 import os
+import json
 import sys
 import socket
 import struct
 import threading
 import time
-import json
 
 # 添加项目根目录到系统路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from common.protocol import *
 from common.utils import get_local_ip
+from common.content_index import ContentIndex, cached_file_digest
+from common.file_writer import FileWriter
+from common.receiver_core import FileReceiver, WritePipeline
+from common.resume import ResumeIndex
 
 class CommandLineReceiver:
     """命令行版本的接收端"""
@@ -63,10 +67,8 @@ class CommandLineReceiver:
         """处理客户端请求"""
         try:
             # 接收握手消息
-            data = self.client_socket.recv(HEADER_SIZE)
-            msg_len = struct.unpack('!I', data[:HEADER_SIZE])[0]
-            msg_data = self.client_socket.recv(msg_len)
-            message = ProtocolMessage.from_json(msg_data.decode('utf-8'))
+            self.reader = FrameReader(self.client_socket)
+            message = self.reader.read_message()
             
             if message.msg_type != MSG_TYPE_HANDSHAKE:
                 print(f"无效的握手消息: {message.msg_type}")
@@ -74,8 +76,10 @@ class CommandLineReceiver:
             
             print(f"收到握手消息，客户端: {message.client_name}")
             
+            negotiate_protocol_version(message.protocol_version)
+            
             # 发送握手响应
-            response = HandshakeMessage(client_name="Test Receiver")
+            response = HandshakeMessage(client_name="Test Receiver", protocol_version=PROTOCOL_VERSION)
             self.client_socket.send(pack_message(response))
             
             # 处理文件传输
@@ -87,54 +91,33 @@ class CommandLineReceiver:
     def receive_files(self):
         """接收文件"""
         try:
-            while True:
-                # 接收消息头
-                data = self.client_socket.recv(HEADER_SIZE)
-                if not data:
-                    break
-                    
-                # 解析消息长度
-                msg_len = struct.unpack('!I', data[:HEADER_SIZE])[0]
-                
-                # 接收消息数据
-                msg_data = b''
-                remaining = msg_len
-                while remaining > 0:
-                    chunk = self.client_socket.recv(min(remaining, BUFFER_SIZE))
-                    if not chunk:
-                        break
-                    msg_data += chunk
-                    remaining -= len(chunk)
-                
+            for frame_type, flags, stream_id, msg_data in self.reader.frames():
                 # 解析消息
                 try:
-                    # 尝试解析JSON部分
-                    json_part = msg_data.split(b'}', 1)[0] + b'}'
-                    json_data = json.loads(json_part.decode('utf-8'))
-                    msg_type = json_data.get('msg_type')
+                    if frame_type == FRAME_DATA:
+                        # 文件数据帧
+                        self.file_handle.write(msg_data)
+                        self.received_bytes += len(msg_data)
+                        
+                        # 显示进度
+                        progress = int((self.received_bytes / self.current_file_size) * 100)
+                        print(f"\r接收进度: {progress}%", end="")
+                        continue
+                    
+                    message = parse_control_frame(msg_data)
+                    msg_type = message.msg_type
                     
                     if msg_type == MSG_TYPE_FILE_INFO:
                         # 文件信息消息
-                        info_data = json.loads(msg_data.decode('utf-8'))
-                        print(f"准备接收文件: {info_data['filename']} ({info_data['filesize']} 字节)")
-                        print(f"文件进度: {info_data['current_file']}/{info_data['file_count']}")
+                        print(f"准备接收文件: {message.filename} ({message.filesize} 字节)")
+                        print(f"文件进度: {message.current_file}/{message.file_count}")
                         
                         # 创建文件
-                        self.current_file = os.path.join(self.save_dir, info_data['filename'])
-                        self.current_file_size = info_data['filesize']
+                        self.current_file = os.path.join(self.save_dir, message.filename)
+                        self.current_file_size = message.filesize
                         self.received_bytes = 0
                         self.file_handle = open(self.current_file, 'wb')
                         
-                    elif msg_type == MSG_TYPE_FILE_DATA:
-                        # 文件数据消息
-                        file_data = msg_data[len(json_part):]
-                        self.file_handle.write(file_data)
-                        self.received_bytes += len(file_data)
-                        
-                        # 显示进度
-                        progress = int((self.received_bytes / self.current_file_size) * 100)
-                        print(f"\r接收进度: {progress}%", end="")
-                        
                     elif msg_type == MSG_TYPE_FILE_END:
                         # 关闭文件
                         self.file_handle.close()
@@ -167,6 +150,370 @@ class CommandLineReceiver:
             
         print("服务器已停止")
 
+def test_frame_round_trip():
+    """握手消息、控制帧和数据帧打包后能原样读出"""
+    sender, receiver = socket.socketpair()
+    try:
+        sender.sendall(pack_message(HandshakeMessage(client_name="Test Sender", protocol_version=PROTOCOL_VERSION)))
+        send_control(sender, FileInfoMessage(filename="a.png", filesize=5, stream_id=3))
+        send_frame(sender, FRAME_DATA, b"hello", stream_id=3)
+        reader = FrameReader(receiver)
+        
+        handshake = reader.read_message()
+        assert (handshake.msg_type, handshake.client_name) == (MSG_TYPE_HANDSHAKE, "Test Sender")
+        message = reader.read_control()
+        assert (message.msg_type, message.filename, message.filesize) == (MSG_TYPE_FILE_INFO, "a.png", 5)
+        frame_type, flags, stream_id, payload = reader.read_frame()
+        assert (frame_type, flags, stream_id, bytes(payload)) == (FRAME_DATA, 0, 3, b"hello")
+    finally:
+        sender.close()
+        receiver.close()
+
+def test_oversized_frames_rejected():
+    """帧头中的长度超过协商的块大小（数据帧）或控制帧上限时，不读取负载，直接抛出ProtocolError"""
+    for frame_type, length in ((FRAME_DATA, 64 * 1024 + 1), (FRAME_DATA, 2 ** 32 - 1),
+                               (FRAME_CONTROL, MAX_CONTROL_FRAME_SIZE + 1)):
+        sender, receiver = socket.socketpair()
+        try:
+            sender.sendall(FRAME_HEADER.pack(frame_type, 0, 1, length))
+            reader = FrameReader(receiver, max_data_size=64 * 1024)
+            buffer_size = len(reader.buffer)
+            try:
+                reader.read_frame()
+            except ProtocolError:
+                pass
+            else:
+                raise AssertionError(f"长度 {length} 的帧没有被拒绝")
+            assert len(reader.buffer) == buffer_size
+        finally:
+            sender.close()
+            receiver.close()
+    
+    sender, receiver = socket.socketpair()
+    try:
+        sender.sendall(struct.pack('!I', MAX_CONTROL_FRAME_SIZE + 1))
+        try:
+            FrameReader(receiver).read_message()
+        except ProtocolError:
+            pass
+        else:
+            raise AssertionError("超长的握手消息没有被拒绝")
+    finally:
+        sender.close()
+        receiver.close()
+
+def handshake_receiver(receiver, features=()):
+    """在socketpair上启动接收端的连接处理线程并完成握手，返回 (发送端socket, 处理线程)"""
+    sender, client = socket.socketpair()
+    thread = threading.Thread(target=receiver.handle_client, args=(client, ("127.0.0.1", 0)), daemon=True)
+    thread.start()
+    sender.sendall(pack_message(HandshakeMessage(client_name="Test Sender", protocol_version=PROTOCOL_VERSION,
+                                                 features=list(features))))
+    assert FrameReader(sender).read_message().msg_type == MSG_TYPE_HANDSHAKE
+    return sender, thread
+
+def test_file_size_checked_against_file_info(tmp_path):
+    """没有协商校验时，FILE_END之前数据不足的文件不算接收完成并记录续传位置；超出声明大小的数据被拒绝"""
+    received = []
+    receiver = FileReceiver(str(tmp_path), log=lambda message: None,
+                            on_file_received=lambda *args: received.append(args[0]))
+    
+    sender, thread = handshake_receiver(receiver)
+    send_control(sender, FileInfoMessage(filename="short.png", filesize=100, file_id="short"))
+    send_frame(sender, FRAME_DATA, b"x" * 60)
+    send_control(sender, FileEndMessage())
+    thread.join(5)
+    sender.close()
+    assert received == []
+    assert receiver.resume_index.offset("short", 100) == 60
+    
+    sender, thread = handshake_receiver(receiver)
+    send_control(sender, FileInfoMessage(filename="long.png", filesize=10))
+    send_frame(sender, FRAME_DATA, b"x" * 20)
+    send_control(sender, FileEndMessage())
+    thread.join(5)
+    sender.close()
+    assert received == []
+    
+    writer = FileWriter(str(tmp_path / "direct.png"), 4)
+    writer.write(b"abcd")
+    try:
+        writer.write(b"e")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("超出声明大小的写入没有被拒绝")
+    finally:
+        writer.close()
+    assert (tmp_path / "direct.png").read_bytes() == b"abcd"
+
+def test_resume_index_reports_save_errors(tmp_path):
+    """续传记录无法保存时通过log报告，不影响接收"""
+    (tmp_path / "not_a_dir").write_bytes(b"")
+    messages = []
+    index = ResumeIndex(str(tmp_path / "not_a_dir" / "resume_index.json"), log=messages.append)
+    
+    index.record("id", str(tmp_path / "a.png"), 100, 40)
+    
+    assert index.get("id") == (str(tmp_path / "a.png"), 40)
+    assert len(messages) == 1 and "保存续传记录失败" in messages[0]
+
+def test_server_drops_connections_without_handshake(tmp_path):
+    """不发送握手的连接在 handshake_timeout 后被断开，不会一直占用连接数"""
+    server, logs = start_server(tmp_path, max_connections=1, handshake_timeout=0.5)
+    try:
+        idle = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+        time.sleep(0.1)
+        client, response = connect_and_handshake(server.port)
+        assert response.msg_type == MSG_TYPE_ERROR
+        client.close()
+        
+        assert idle.recv(1) == b""
+        idle.close()
+        client, response = connect_and_handshake(server.port)
+        assert response.msg_type == MSG_TYPE_HANDSHAKE
+        client.close()
+        assert any("等待握手超时" in message for message in logs)
+    finally:
+        server.stop()
+        server.join(5)
+
+def make_receiver(tmp_path):
+    """接收目录 tmp_path/save 中已经有一个收到过的文件，返回 (FileReceiver, 会话, 文件内容哈希)"""
+    save_dir = tmp_path / "save"
+    save_dir.mkdir()
+    existing = save_dir / "orig.png"
+    existing.write_bytes(b"x" * 200000)
+    content_index = ContentIndex(str(tmp_path / "content_index.json"))
+    digest = cached_file_digest(str(existing))
+    content_index.add(str(existing), digest)
+    receiver = FileReceiver(str(save_dir), log=lambda message: None, content_index=content_index)
+    return receiver, receiver.join_session(None), digest
+
+def test_dedup_query_stays_in_save_dir(tmp_path):
+    """去重查询中带路径的文件名只取文件名部分，复制的文件不会落在接收目录之外；缺少哈希的条目被忽略"""
+    receiver, session, digest = make_receiver(tmp_path)
+    (tmp_path / "outside.png").write_bytes(b"keep")
+    files = [{"file_id": "a", "filename": "../outside.png", "filesize": 200000, "hash": digest},
+             {"file_id": "b", "filename": "..", "filesize": 200000, "hash": digest},
+             {"file_id": "c", "filename": "no_hash.png", "filesize": 200000}]
+    message = parse_control_frame(pack_control_frame(DedupQueryMessage(files))[FRAME_HEADER_SIZE:])
+    
+    info = receiver.answer_dedup_query(session, message)
+    
+    assert info.existing == ["a"]
+    assert (tmp_path / "outside.png").read_bytes() == b"keep"
+    assert (tmp_path / "save" / "outside.png").read_bytes() == b"x" * 200000
+
+def test_content_index_appends_changes(tmp_path):
+    """内容索引只把变化追加到文件末尾，重新加载后得到同样的记录；旧版本的整文件格式也能加载"""
+    index_file = tmp_path / "content_index.json"
+    first = tmp_path / "a.png"
+    second = tmp_path / "b.png"
+    first.write_bytes(b"a" * 10)
+    second.write_bytes(b"b" * 20)
+    index = ContentIndex(str(index_file))
+    index.add(str(first), "hash-a")
+    index.save()
+    saved = index_file.read_bytes()
+    
+    index.add(str(second), "hash-b")
+    index.discard(str(first))
+    index.save()
+    
+    assert index_file.read_bytes().startswith(saved)
+    assert len(index_file.read_bytes().splitlines()) == 3
+    reloaded = ContentIndex(str(index_file))
+    assert list(reloaded.entries) == [str(second)]
+    assert reloaded.find(20, "hash-b") == str(second)
+    
+    legacy_file = tmp_path / "legacy.json"
+    legacy_file.write_text(json.dumps({str(first): {"size": 10, "mtime": first.stat().st_mtime_ns, "hash": "hash-a"}}))
+    assert ContentIndex(str(legacy_file)).find(10, "hash-a") == str(first)
+    assert "path" in json.loads(legacy_file.read_text().splitlines()[0])
+
+def test_delta_query_stays_in_save_dir(tmp_path):
+    """增量查询不能返回接收目录之外的文件（包括经由符号链接）的块签名"""
+    receiver, session, _ = make_receiver(tmp_path)
+    (tmp_path / "secret.png").write_bytes(os.urandom(200000))
+    names = ["../secret.png", "..", "/etc/passwd"]
+    if hasattr(os, "symlink"):
+        os.symlink(str(tmp_path / "secret.png"), str(tmp_path / "save" / "link.png"))
+        names.append("link.png")
+    files = [{"file_id": str(i), "filename": name, "filesize": 200000} for i, name in enumerate(names)]
+    message = parse_control_frame(pack_control_frame(DeltaQueryMessage(files))[FRAME_HEADER_SIZE:])
+    
+    info = receiver.answer_delta_query(session, message)[0]
+    
+    assert not info.signatures
+
+def start_server(save_dir, **kwargs):
+    """在本机随机端口上启动asyncio接收服务器，返回 (ReceiverServer, 日志列表)"""
+    from common.receiver_server import ReceiverServer
+    logs = []
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    server = ReceiverServer(FileReceiver(str(save_dir), log=logs.append), host='127.0.0.1', port=port, **kwargs)
+    server.start()
+    return server, logs
+
+def connect_and_handshake(port):
+    client = socket.create_connection(('127.0.0.1', port), timeout=5)
+    client.sendall(pack_message(HandshakeMessage(client_name="Test Sender", protocol_version=PROTOCOL_VERSION)))
+    return client, FrameReader(client).read_message()
+
+def test_server_closes_connection_on_oversized_frame(tmp_path):
+    """asyncio服务器收到超长的帧头时断开连接，不缓存帧数据"""
+    server, logs = start_server(tmp_path)
+    try:
+        client, response = connect_and_handshake(server.port)
+        assert response.msg_type == MSG_TYPE_HANDSHAKE
+        client.sendall(FRAME_HEADER.pack(FRAME_DATA, 0, 1, 2 ** 32 - 1))
+        assert client.recv(1) == b""
+        client.close()
+        assert any("帧过长" in message for message in logs)
+    finally:
+        server.stop()
+        server.join(5)
+
+def start_put(pipeline, size):
+    """在另一个线程中放入一项，返回线程，放入后线程结束"""
+    thread = threading.Thread(target=pipeline.put, args=(lambda: None, (), size), daemon=True)
+    thread.start()
+    return thread
+
+def test_write_pipeline_backpressure(tmp_path):
+    """超过每条连接或所有连接的排队上限时 put() 等待，队列为空的连接总可以放入一项"""
+    receiver = FileReceiver(str(tmp_path), log=lambda message: None)
+    receiver.connection_buffer_limit = 100
+    receiver.max_buffered_bytes = 150
+    sockets = [socket.socketpair() for _ in range(2)]
+    first = WritePipeline(receiver, None, sockets[0][0])
+    second = WritePipeline(receiver, None, sockets[1][0])
+    first_disk = threading.Event()
+    second_disk = threading.Event()
+    try:
+        first.put(lambda: first_disk.wait() and None, (), 60)
+        first.put(lambda: None, (), 30)
+        # 这条连接的排队数据超过上限
+        blocked = start_put(first, 30)
+        # 队列为空的连接不受所有连接的上限限制
+        second.put(lambda: second_disk.wait() and None, (), 50)
+        # 所有连接的排队数据超过上限
+        blocked_global = start_put(second, 20)
+        time.sleep(0.2)
+        assert blocked.is_alive() and blocked_global.is_alive()
+        assert receiver.buffered_bytes == 140
+        
+        first_disk.set()
+        blocked.join(5)
+        blocked_global.join(5)
+        assert not blocked.is_alive() and not blocked_global.is_alive()
+        second_disk.set()
+    finally:
+        first_disk.set()
+        second_disk.set()
+        first.close()
+        second.close()
+        for a, b in sockets:
+            a.close()
+            b.close()
+    assert receiver.buffered_bytes == 0
+
+def test_write_pipeline_error_stops_reading(tmp_path):
+    """写盘出错后丢弃排队的操作，关闭socket的读取方向，之后的 put() 抛出写盘的错误"""
+    receiver = FileReceiver(str(tmp_path), log=lambda message: None)
+    a, b = socket.socketpair()
+    pipeline = WritePipeline(receiver, None, a)
+    disk = threading.Event()
+    executed = []
+    
+    def failing_write():
+        disk.wait()
+        raise OSError("磁盘已满")
+    
+    try:
+        pipeline.put(failing_write, (), 10)
+        pipeline.put(lambda: executed.append(True), (), 10)
+        disk.set()
+        deadline = time.monotonic() + 5
+        while pipeline.error is None:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        try:
+            pipeline.put(lambda: None, (), 10)
+            assert False, "写盘出错后应该抛出异常"
+        except OSError as e:
+            assert str(e) == "磁盘已满"
+        assert a.recv(1) == b''
+    finally:
+        pipeline.close()
+        a.close()
+        b.close()
+    assert executed == []
+    assert receiver.buffered_bytes == 0
+
+def test_server_limits_buffered_data(tmp_path, monkeypatch):
+    """磁盘较慢时asyncio服务器排队的数据不超过上限，文件仍然完整接收"""
+    from common import file_writer, receiver_server
+    from common.sender_core import SenderConnection, send_batch
+    original_write = file_writer.FileWriter.write
+    
+    def slow_write(self, data):
+        # 约 40 MB/s 的磁盘
+        time.sleep(len(data) / (40 * 1024 * 1024))
+        return original_write(self, data)
+    
+    monkeypatch.setattr(file_writer.FileWriter, "write", slow_write)
+    source = tmp_path / "source"
+    save_dir = tmp_path / "received"
+    source.mkdir()
+    save_dir.mkdir()
+    paths = []
+    for i in range(3):
+        path = source / f"{i}.bin"
+        path.write_bytes(os.urandom(4 * 1024 * 1024))
+        paths.append(str(path))
+    
+    server, logs = start_server(save_dir)
+    server.receiver.connection_buffer_limit = 256 * 1024
+    server.receiver.max_buffered_bytes = 512 * 1024
+    peak = [0]
+    sending = threading.Event()
+    
+    def watch():
+        while not sending.is_set():
+            peak[0] = max(peak[0], server.buffered_bytes)
+            time.sleep(0.0005)
+    
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    try:
+        connection = SenderConnection('127.0.0.1', server.port)
+        connection.connect()
+        try:
+            results = {}
+            send_batch(connection, paths, stream_count=2,
+                       on_file_done=lambda path, size, error: results.update({path: error}))
+        finally:
+            connection.close()
+        time.sleep(0.2)
+    finally:
+        sending.set()
+        watcher.join()
+        server.stop()
+        server.join(5)
+    
+    assert results == {path: None for path in paths}
+    for path in paths:
+        with open(path, 'rb') as a, open(str(save_dir / os.path.basename(path)), 'rb') as b:
+            assert a.read() == b.read()
+    # 队列为空的连接总可以放入一项（最多一次读取的数据）
+    assert 0 < peak[0] <= 512 * 1024 + 2 * receiver_server.RAW_READ_SIZE
+    assert server.buffered_bytes == 0
+
 def main():
     """主函数"""
     receiver = CommandLineReceiver()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+测试脚本 - 发送端的文件选择、目录扫描和图片识别
+"""
+import os
+import sys
+import time
+
+# 添加项目根目录到系统路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from common import folder_scan, image_types
+from common.file_selection import FileSelection
+from common.folder_scan import FolderScanner, scan_directory
+from common.image_types import ImageTypeCache, match_image_signature, sniff_image_type
+
+def test_file_selection(tmp_path):
+    """保持添加顺序、跳过重复和无效的路径，总大小随添加和移除增量更新"""
+    paths = []
+    for i, size in enumerate((100, 2000, 30000)):
+        path = tmp_path / f"{i}.jpg"
+        path.write_bytes(b'x' * size)
+        paths.append(str(path))
+    
+    selection = FileSelection()
+    assert selection.add(paths[2])
+    assert [selection.add(path) for path in paths] == [True, True, False]
+    assert not selection.add(str(tmp_path))
+    assert not selection.add(str(tmp_path / "missing.jpg"))
+    assert list(selection) == [paths[2], paths[0], paths[1]]
+    assert len(selection) == 3 and paths[1] in selection
+    assert selection.total_size == 32100
+    
+    # 已有的文件信息直接使用，不再读取
+    extra = tmp_path / "extra.png"
+    extra.write_bytes(b'y' * 5)
+    st = os.stat(str(extra))
+    extra.write_bytes(b'y' * 50)
+    assert selection.add_stats([(str(extra), st), (paths[0], os.stat(paths[0]))]) == [str(extra)]
+    assert selection.total_size == 32105
+    assert selection.stats[str(extra)] == (5, st.st_mtime)
+    
+    selection.remove_at([0, 3])
+    assert list(selection) == [paths[0], paths[1]]
+    assert paths[2] not in selection and str(extra) not in selection
+    assert selection.total_size == 2100
+    selection.remove_at([])
+    assert len(selection) == 2
+    
+    assert selection.add(paths[2])
+    selection.clear()
+    assert len(selection) == 0 and selection.total_size == 0 and selection.stats == {}
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+
+def make_tree(root):
+    """创建测试目录：图片、非图片文件和子目录，返回相对路径到完整路径的映射"""
+    files = {
+        "b.png": PNG_HEADER + b'1',
+        "a.txt": b'text',
+        "sub/c.png": PNG_HEADER + b'2',
+        "sub/deeper/d.jpg": b'\xff\xd8\xff\xe0' + b'3',
+        "sub2/e.gif": b'GIF89a' + b'4',
+    }
+    paths = {}
+    for name, content in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        paths[name] = str(path)
+    return paths
+
+def test_scan_directory(tmp_path):
+    """同一目录中按名称排序，先列出文件再进入子目录，不进入指向目录的符号链接"""
+    paths = make_tree(tmp_path)
+    if hasattr(os, 'symlink'):
+        try:
+            os.symlink(str(tmp_path / "sub"), str(tmp_path / "link"), target_is_directory=True)
+        except OSError:
+            pass
+    
+    found = [entry.path for entry in scan_directory(str(tmp_path))]
+    assert found == [paths["a.txt"], paths["b.png"], paths["sub/c.png"], paths["sub/deeper/d.jpg"],
+                     paths["sub2/e.gif"]]
+    assert [entry.name for entry in scan_directory(str(tmp_path), accept=lambda name: name.endswith(".png"))] == [
+        "b.png", "c.png"]
+    assert list(scan_directory(str(tmp_path / "missing"))) == []
+    assert list(scan_directory(str(tmp_path), should_continue=lambda: False)) == []
+
+def take_all(scanner):
+    """等待扫描结束，返回取出的全部 (路径, 文件信息)"""
+    found = []
+    deadline = time.monotonic() + 10
+    while not scanner.done.is_set():
+        assert time.monotonic() < deadline
+        found += scanner.take()
+        time.sleep(0.01)
+    return found + scanner.take()
+
+def test_folder_scanner(tmp_path, monkeypatch):
+    """文件和文件夹在后台展开、按内容保留图片并分批交出，不存在的路径被跳过"""
+    monkeypatch.setattr(folder_scan, "SCAN_BATCH_SIZE", 2)
+    paths = make_tree(tmp_path)
+    
+    scanner = FolderScanner([str(tmp_path / "sub"), paths["b.png"], paths["a.txt"], str(tmp_path / "missing"),
+                             str(tmp_path / "sub2")])
+    scanner.start()
+    found = take_all(scanner)
+    assert [path for path, st in found] == [paths["sub/c.png"], paths["sub/deeper/d.jpg"], paths["b.png"],
+                                            paths["sub2/e.gif"]]
+    assert all(st.st_size == os.path.getsize(path) for path, st in found)
+    assert scanner.skipped == 1
+    
+    scanner = FolderScanner([str(tmp_path)], images_only=False)
+    scanner.start()
+    assert len(take_all(scanner)) == 5 and scanner.skipped == 0
+
+def test_folder_scanner_cancel(tmp_path):
+    """取消后扫描线程停止，已经找到但没有取出的文件被丢弃"""
+    for i in range(200):
+        (tmp_path / f"{i:03d}.png").write_bytes(PNG_HEADER)
+    scanner = FolderScanner([str(tmp_path)] * 50)
+    scanner.cancel()
+    scanner.start()
+    assert scanner.done.wait(5)
+    assert scanner.take() == []
+
+def test_match_image_signature():
+    """按文件开头的字节识别格式，与扩展名无关"""
+    assert match_image_signature(b'\xff\xd8\xff\xdb') == "jpeg"
+    assert match_image_signature(PNG_HEADER + b'\x00\x00') == "png"
+    assert match_image_signature(b'GIF87a') == "gif"
+    assert match_image_signature(b'GIF89a') == "gif"
+    assert match_image_signature(b'BM\x36\x00') == "bmp"
+    assert match_image_signature(b'II*\x00') == "tiff"
+    assert match_image_signature(b'MM\x00*') == "tiff"
+    assert match_image_signature(b'RIFF\x24\x00\x00\x00WEBP') == "webp"
+    # RIFF容器中的其他格式不是图片，签名只匹配文件开头
+    assert match_image_signature(b'RIFF\x24\x00\x00\x00WAVE') is None
+    assert match_image_signature(b'GIF88a') is None
+    assert match_image_signature(b'x' + PNG_HEADER) is None
+    assert match_image_signature(b'\xff\xd8') is None
+    assert match_image_signature(b'') is None
+
+def test_sniff_and_filter_images(tmp_path, monkeypatch):
+    """改错扩展名的文件按内容识别；结果按 (路径, 大小, 修改时间) 缓存，文件改变后重新识别"""
+    photo = tmp_path / "photo.txt"
+    photo.write_bytes(b'\xff\xd8\xff\xe0' + b'0' * 100)
+    fake = tmp_path / "fake.png"
+    fake.write_bytes(b'not an image')
+    assert sniff_image_type(str(photo)) == "jpeg"
+    assert sniff_image_type(str(fake)) is None
+    assert sniff_image_type(str(tmp_path / "missing.png")) is None
+    
+    cache = ImageTypeCache()
+    found = [(str(photo), None), (str(fake), os.stat(str(fake))), (str(tmp_path / "missing.png"), None)]
+    assert cache.filter_images(found) == [(str(photo), None)]
+    
+    sniffed = []
+    monkeypatch.setattr(image_types, "sniff_image_type", lambda path: sniffed.append(path) or "png")
+    assert cache.filter_images(found) == [(str(photo), None)]
+    assert sniffed == []
+    
+    fake.write_bytes(PNG_HEADER + b'changed')
+    assert cache.filter_images([(str(photo), None), (str(fake), None)]) == [(str(photo), None), (str(fake), None)]
+    assert sniffed == [str(fake)]
+
+def test_filter_images_in_parallel(tmp_path):
+    """文件较多时在线程池中分组识别，结果保持原来的顺序"""
+    found = []
+    for i in range(image_types.PARALLEL_THRESHOLD * 2 + 3):
+        path = tmp_path / f"{i:03d}.bin"
+        path.write_bytes(PNG_HEADER if i % 3 else b'plain text')
+        found.append((str(path), None))
+    assert ImageTypeCache().filter_images(found) == [item for i, item in enumerate(found) if i % 3]
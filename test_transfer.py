@@ -5,7 +5,7 @@
 import os
 import sys
 import socket
-import struct
+import threading
 import time
 
 # 添加项目根目录到系统路径
@@ -13,6 +13,13 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from common.protocol import *
 from common.utils import get_local_ip, validate_ip_address
+from common import sender_core
+from common.compression import Codec, available_codecs, negotiate_codec, CODEC_ZLIB, SAMPLE_SIZE
+from common.content_index import ContentIndex, cached_file_digest
+from common.progress import TransferProgress
+from common.receiver_core import FileReceiver
+from common.resume import ResumeIndex
+from common.sender_core import SenderConnection, send_batch
 
 def test_file_transfer():
     """测试文件传输功能"""
@@ -34,20 +41,19 @@ def test_file_transfer():
         print("已连接到接收端")
         
         # 发送握手消息
-        handshake = HandshakeMessage(client_name="Test Sender")
+        handshake = HandshakeMessage(client_name="Test Sender", protocol_version=PROTOCOL_VERSION)
         client_socket.send(pack_message(handshake))
         print("已发送握手消息")
         
         # 接收握手响应
-        data = client_socket.recv(HEADER_SIZE)
-        msg_len = struct.unpack('!I', data[:HEADER_SIZE])[0]
-        msg_data = client_socket.recv(msg_len)
-        response = ProtocolMessage.from_json(msg_data.decode('utf-8'))
+        response = FrameReader(client_socket).read_message()
         
         if response.msg_type != MSG_TYPE_HANDSHAKE:
             print(f"无效的握手响应: {response.msg_type}")
             return
         
+        negotiate_protocol_version(response.protocol_version)
+        
         print(f"握手成功，接收端: {response.client_name}")
         
         # 发送文件
@@ -63,13 +69,14 @@ def test_file_transfer():
                 filename=filename,
                 filesize=filesize,
                 file_count=file_count,
-                current_file=i+1
+                current_file=i+1,
+                stream_id=i+1
             )
-            client_socket.send(pack_message(file_info))
+            send_control(client_socket, file_info)
             
             # 发送文件数据
             with open(file_path, 'rb') as f:
-                chunk_size = BUFFER_SIZE
+                chunk_size = DEFAULT_CHUNK_SIZE
                 sent_bytes = 0
                 
                 while sent_bytes < filesize:
@@ -77,8 +84,7 @@ def test_file_transfer():
                     if not chunk:
                         break
                     
-                    file_data = FileDataMessage(data=chunk)
-                    client_socket.send(pack_message(file_data))
+                    send_frame(client_socket, FRAME_DATA, chunk, stream_id=i+1)
                     
                     sent_bytes += len(chunk)
                     progress = int((sent_bytes / filesize) * 100)
@@ -87,14 +93,12 @@ def test_file_transfer():
             print(f"\n文件 {filename} 发送完成")
             
             # 发送文件结束消息
-            file_end = FileEndMessage()
-            client_socket.send(pack_message(file_end))
+            send_control(client_socket, FileEndMessage())
             
             time.sleep(0.5)  # 短暂延迟，确保接收端处理完成
         
         # 发送批量传输结束消息
-        batch_end = BatchEndMessage()
-        client_socket.send(pack_message(batch_end))
+        send_control(client_socket, BatchEndMessage())
         print("所有文件发送完成")
         
         # 关闭连接
@@ -106,7 +110,348 @@ def test_file_transfer():
         if 'client_socket' in locals():
             client_socket.close()
 
+def start_receiver(save_dir, **kwargs):
+    """在本机随机端口上启动接收端（每个连接一个线程），返回 (FileReceiver, 端口, 日志列表)"""
+    logs = []
+    receiver = FileReceiver(save_dir, log=logs.append, **kwargs)
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(8)
+    
+    def accept():
+        while True:
+            client_socket, addr = server_socket.accept()
+            threading.Thread(target=receiver.handle_client, args=(client_socket, addr), daemon=True).start()
+    
+    threading.Thread(target=accept, daemon=True).start()
+    return receiver, server_socket.getsockname()[1], logs
+
+def send_to(port, file_paths, **kwargs):
+    """建立连接发送一批文件，返回 (每个文件的结果 {路径: 错误}, 发送端日志)"""
+    results = {}
+    messages = []
+    connection = SenderConnection('127.0.0.1', port)
+    connection.connect()
+    try:
+        send_batch(connection, file_paths, on_file_done=lambda path, size, error: results.update({path: error}),
+                   log=messages.append, **kwargs)
+    finally:
+        connection.close()
+    # 接收端在BATCH_END之后才报告最后的文件
+    time.sleep(0.2)
+    return results, messages
+
+def write_random(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+def same_content(a, b):
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        return fa.read() == fb.read()
+
+def test_striped_transfer(tmp_path):
+    """不小于 STRIPE_THRESHOLD 的文件拆成条带，由多条并行连接发送后在接收端拼成完整文件"""
+    save_dir = tmp_path / "received"
+    save_dir.mkdir()
+    big = write_random(str(tmp_path / "big.bin"), 64 * 1024 * 1024 + 123)
+    small = write_random(str(tmp_path / "small.bin"), 300 * 1024)
+    _, port, logs = start_receiver(str(save_dir))
+    
+    results, messages = send_to(port, [big, small], stream_count=4)
+    
+    assert results == {big: None, small: None}
+    assert any("拆成 4 个条带" in message for message in messages)
+    assert same_content(big, str(save_dir / "big.bin"))
+    assert same_content(small, str(save_dir / "small.bin"))
+
+def test_resume_after_truncated_stream(tmp_path):
+    """连接中途断开后重新发送，只发送剩余部分；接收端换了新的接收目录时也能续传"""
+    first_dir = tmp_path / "first"
+    second_dir = tmp_path / "second"
+    first_dir.mkdir()
+    second_dir.mkdir()
+    index_file = str(tmp_path / "resume_index.json")
+    path = write_random(str(tmp_path / "photo.bin"), 12 * 1024 * 1024)
+    _, port, _ = start_receiver(str(first_dir), resume_index=ResumeIndex(index_file))
+    
+    progress = TransferProgress()
+    progress.reset(1, 0)
+    try:
+        send_to(port, [path], progress=progress, should_continue=lambda: progress.snapshot().transferred_bytes < 5 * 1024 * 1024)
+    except ConnectionError:
+        pass
+    time.sleep(0.2)
+    entries = list(ResumeIndex(index_file).entries.values())
+    assert len(entries) == 1
+    assert 0 < entries[0]["received"] < 12 * 1024 * 1024
+    
+    # 模拟接收端重启：新的接收目录，共用续传记录
+    _, port, logs = start_receiver(str(second_dir), resume_index=ResumeIndex(index_file))
+    results, messages = send_to(port, [path])
+    
+    assert results == {path: None}
+    assert any("处续传" in message for message in messages)
+    assert same_content(path, str(first_dir / "photo.bin"))
+    assert not os.path.exists(index_file)
+
+def test_delta_against_modified_base(tmp_path, monkeypatch):
+    """修改过少量内容的文件再次发送时，只发送变化的部分，接收端用旧文件拼出新内容"""
+    save_dir = tmp_path / "received"
+    save_dir.mkdir()
+    path = write_random(str(tmp_path / "scan.bin"), 2 * 1024 * 1024)
+    _, port, _ = start_receiver(str(save_dir))
+    results, _ = send_to(port, [path])
+    assert results == {path: None}
+    
+    with open(path, 'r+b') as f:
+        f.seek(1024 * 1024)
+        f.write(b"changed" * 100)
+        f.seek(0, os.SEEK_END)
+        f.write(b"appended")
+    # 统计实际发送的文件数据（不含块引用）
+    data_bytes = []
+    
+    def counting_send_frame(sock, frame_type, payload=b'', flags=0, stream_id=0):
+        if frame_type == FRAME_DATA and not flags & FRAME_FLAG_COPY:
+            data_bytes.append(len(payload))
+        send_frame(sock, frame_type, payload, flags=flags, stream_id=stream_id)
+    
+    monkeypatch.setattr(sender_core, "send_frame", counting_send_frame)
+    results, messages = send_to(port, [path], delta=True)
+    
+    assert results == {path: None}
+    assert any("增量发送" in message for message in messages)
+    assert 0 < sum(data_bytes) < os.path.getsize(path) // 4
+    assert os.listdir(save_dir) == ["scan.bin"]
+    assert same_content(path, str(save_dir / "scan.bin"))
+
+def test_codec_round_trip():
+    """每种可用的压缩算法都能还原数据，解压后超出上限的数据被拒绝，只有可压缩的样本值得压缩"""
+    data = b"DeskTransfer " * 10000
+    for name in available_codecs():
+        codec = Codec(name)
+        compressed = codec.compress(data)
+        assert len(compressed) < len(data)
+        assert bytes(codec.decompress(compressed, len(data))) == data
+        try:
+            codec.decompress(compressed, len(data) // 2)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"{name} 解压后超出上限的数据没有被拒绝")
+        assert codec.worth_compressing(data[:SAMPLE_SIZE])
+        assert not codec.worth_compressing(os.urandom(SAMPLE_SIZE))
+    assert negotiate_codec(["unknown", CODEC_ZLIB]) == CODEC_ZLIB
+    assert negotiate_codec(["unknown"]) is None
+
+def test_compressed_transfer(tmp_path, monkeypatch):
+    """可压缩的文件以压缩的数据帧发送，已压缩的（随机）数据不压缩，接收端都能还原"""
+    save_dir = tmp_path / "received"
+    save_dir.mkdir()
+    text = str(tmp_path / "scan.bmp")
+    with open(text, 'wb') as f:
+        f.write(b"".join(b"row %06d " % i + b"\x00" * 200 for i in range(10000)))
+    photo = write_random(str(tmp_path / "photo.jpg"), 1024 * 1024)
+    _, port, _ = start_receiver(str(save_dir))
+    frames = {True: 0, False: 0}
+    
+    def counting_send_frame(sock, frame_type, payload=b'', flags=0, stream_id=0):
+        if frame_type == FRAME_DATA:
+            frames[bool(flags & FRAME_FLAG_COMPRESSED)] += 1
+        send_frame(sock, frame_type, payload, flags=flags, stream_id=stream_id)
+    
+    monkeypatch.setattr(sender_core, "send_frame", counting_send_frame)
+    results, _ = send_to(port, [text])
+    assert results == {text: None}
+    assert frames[True] > 0 and frames[False] == 0
+    
+    frames[True] = 0
+    results, _ = send_to(port, [photo])
+    assert results == {photo: None}
+    assert frames[True] == 0
+    assert same_content(text, str(save_dir / "scan.bmp"))
+    assert same_content(photo, str(save_dir / "photo.jpg"))
+
+def test_bundle_split_and_file_hashes(tmp_path, monkeypatch):
+    """小文件按 BUNDLE_MAX_FILES 分成多个包发送，每个文件的内容哈希分别交给接收端；
+    包中第一个文件无法读取时其余文件照常发送"""
+    monkeypatch.setattr(sender_core, "BUNDLE_MAX_FILES", 10)
+    save_dir = tmp_path / "received"
+    save_dir.mkdir()
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    missing = str(source_dir / "missing.bin")
+    paths = [write_random(str(source_dir / f"small_{i:02d}.bin"), 1000 + i * 37) for i in range(35)]
+    digests = {}
+    receiver, port, logs = start_receiver(
+        str(save_dir), content_index=ContentIndex(str(tmp_path / "content_index.json")),
+        on_file_received=lambda filename, file_path, filesize, peer, digest: digests.update({filename: digest}))
+    # 打包前才检查文件是否可读，开始发送前删除
+    paths.insert(0, write_random(missing, 10))
+    
+    connection = SenderConnection('127.0.0.1', port)
+    connection.connect()
+    assert FEATURE_BUNDLE in connection.features
+    connection.close()
+    os.remove(missing)
+    results, _ = send_to(port, paths, stream_count=2)
+    
+    assert isinstance(results.pop(missing), OSError)
+    assert all(error is None for error in results.values())
+    assert sum(message.startswith("接收了") for message in logs) == 4
+    for path in paths[1:]:
+        name = os.path.basename(path)
+        assert same_content(path, str(save_dir / name))
+        assert digests[name] == cached_file_digest(path)
+
+def start_async_receiver(save_dir):
+    """在本机随机端口上启动asyncio接收服务器，返回 (ReceiverServer, 日志列表)"""
+    from common.receiver_server import ReceiverServer
+    logs = []
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    server = ReceiverServer(FileReceiver(str(save_dir), log=logs.append), host='127.0.0.1', port=port)
+    server.start()
+    return server, logs
+
+def test_async_client_transfer(tmp_path):
+    """异步发送端通过两条连接把一批文件发送到asyncio接收服务器"""
+    import asyncio
+    from common.sender_client import send_files
+    source = tmp_path / "source"
+    save_dir = tmp_path / "received"
+    source.mkdir()
+    save_dir.mkdir()
+    paths = [write_random(str(source / "big.bin"), 6 * 1024 * 1024),
+             write_random(str(source / "small.bin"), 5000),
+             str(source / "notes.txt")]
+    with open(paths[2], 'w') as f:
+        f.write("DeskTransfer " * 20000)
+    
+    server, logs = start_async_receiver(save_dir)
+    try:
+        results = {}
+        sent = asyncio.run(send_files('127.0.0.1', paths, port=server.port, stream_count=2,
+                                      on_file_done=lambda path, size, error: results.update({path: error})))
+        time.sleep(0.2)
+    finally:
+        server.stop()
+        server.join(5)
+    
+    assert sorted(sent) == sorted(paths)
+    assert results == {path: None for path in paths}
+    for path in paths:
+        assert same_content(path, str(save_dir / os.path.basename(path)))
+
+def test_async_client_cancel_waits_for_reads(tmp_path, monkeypatch):
+    """取消在文件中途生效，关闭文件之前等待线程池中已经开始的读取"""
+    import asyncio
+    from common import sender_client
+    source = tmp_path / "source"
+    save_dir = tmp_path / "received"
+    source.mkdir()
+    save_dir.mkdir()
+    path = write_random(str(source / "big.bin"), 16 * 1024 * 1024)
+    
+    reads = []
+    
+    def slow_read_at(f, offset, size, lock):
+        time.sleep(0.05)
+        reads.append(f.closed)
+        return os.pread(f.fileno(), size, offset)
+    
+    monkeypatch.setattr(sender_client, "read_at", slow_read_at)
+    checks = []
+    
+    def should_continue():
+        checks.append(None)
+        return len(checks) < 4
+    
+    server, logs = start_async_receiver(save_dir)
+    try:
+        results = {}
+        try:
+            asyncio.run(sender_client.send_files('127.0.0.1', [path], port=server.port, stream_count=1,
+                                                 should_continue=should_continue,
+                                                 on_file_done=lambda path, size, error: results.update(
+                                                     {path: error})))
+        except ConnectionError:
+            pass
+        # 取消之后不会再有读取完成
+        count = len(reads)
+        time.sleep(0.3)
+    finally:
+        server.stop()
+        server.join(5)
+    
+    assert isinstance(results[path], ConnectionAbortedError)
+    assert len(reads) == count
+    assert not any(reads)
+    assert count < 16
+
+def test_sender_cli(tmp_path, capsys):
+    """命令行发送端展开目录、只发送图片，全部成功时退出码为0"""
+    from cli import sender_cli
+    source = tmp_path / "source"
+    save_dir = tmp_path / "received"
+    source.mkdir()
+    save_dir.mkdir()
+    with open(str(source / "photo.jpg"), 'wb') as f:
+        f.write(b'\xff\xd8\xff\xe0' + os.urandom(20000))
+    write_random(str(source / "notes.bin"), 1000)
+    
+    receiver, port, logs = start_receiver(str(save_dir))
+    assert sender_cli.main(['127.0.0.1', str(source), '-p', str(port), '-s', '1']) == 0
+    time.sleep(0.2)
+    assert os.listdir(str(save_dir)) == ["photo.jpg"]
+    assert same_content(str(source / "photo.jpg"), str(save_dir / "photo.jpg"))
+    assert "1/1" in capsys.readouterr().out
+    
+    assert sender_cli.main(['127.0.0.1', str(source / "notes.bin"), '-p', '1', '-q']) == 2
+
+def test_cli_scripts(tmp_path):
+    """通过符号链接调用启动脚本，命令行接收端收到SIGTERM后正常退出"""
+    if os.name != 'posix':
+        import pytest
+        pytest.skip("shell启动脚本只用于Linux和macOS")
+    import signal
+    import subprocess
+    root = os.path.dirname(os.path.abspath(__file__))
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name in ("desktransfer-send", "desktransfer-receive"):
+        os.symlink(os.path.join(root, name), str(bin_dir / name))
+    source = write_random(str(tmp_path / "data.bin"), 300000)
+    save_dir = tmp_path / "received"
+    
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    receiver = subprocess.Popen([str(bin_dir / "desktransfer-receive"), '-d', str(save_dir), '--host', '127.0.0.1',
+                                 '-p', str(port), '--no-history', '--no-index',
+                                 '--resume-index', str(tmp_path / "resume.json"), '-q'])
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                assert time.time() < deadline
+                time.sleep(0.1)
+        sender = subprocess.run([str(bin_dir / "desktransfer-send"), '127.0.0.1', source, '-p', str(port), '-q'],
+                                timeout=30)
+        assert sender.returncode == 0
+    finally:
+        receiver.send_signal(signal.SIGTERM)
+        assert receiver.wait(timeout=15) == 0
+    assert same_content(source, str(save_dir / "data.bin"))
+
 if __name__ == "__main__":
     print("开始测试文件传输...")
     test_file_transfer()
-    print("测试完成")
\ No newline at end of file
+    print("测试完成")
@@ -0,0 +1,102 @@
+"""
+传输历史列表
+Treeview 中只放已经加载的记录：先显示最新的一页，滚动到接近底部时再从数据库加载下一页；
+新增的记录插入到列表顶部，不重建整个列表，历史记录很多时界面也不会卡顿
+"""
+from common.progress import PROGRESS_POLL_INTERVAL
+
+# 每次从数据库加载的记录数
+PAGE_SIZE = 200
+# 滚动条的下边缘超过已加载部分的这个比例时加载下一页
+LOAD_MORE_THRESHOLD = 0.9
+
+class HistoryView:
+    """把历史数据库分页显示在Treeview中
+    
+    format_row(record) 返回一行的显示值，get_filters() 返回当前的查询条件（HistoryDatabase.query 的参数）。
+    条目ID为记录ID。所有方法都在界面线程中调用；刷新时先让后台写入线程写完队列中的记录，
+    界面线程用 after() 定时检查是否写完再查询，界面线程和写入线程互不等待。
+    """
+    def __init__(self, tree, scrollbar, history_db, format_row, get_filters):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.history_db = history_db
+        self.format_row = format_row
+        self.get_filters = get_filters
+        
+        # 已加载的最后（最旧）一条记录的 (time, id)，下一页从它之后开始
+        self.last_key = None
+        # 已经查询过新记录的最大记录ID
+        self.newest_id = 0
+        self.exhausted = True
+        self.load_scheduled = False
+        
+        self.tree.configure(yscrollcommand=self.on_scroll)
+    
+    @property
+    def ready(self):
+        return self.history_db.loaded.is_set() and not self.history_db.error
+    
+    def reload(self):
+        """按当前查询条件重新显示，只加载第一页"""
+        if not self.ready:
+            return
+        # 先写入队列中的记录，刷新后能看到刚传输的文件
+        self._after_writes(self._reload)
+    
+    def _reload(self):
+        self.tree.delete(*self.tree.get_children())
+        self.last_key = None
+        self.exhausted = False
+        self.newest_id = self.history_db.last_id()
+        self.load_more()
+    
+    def load_more(self):
+        """在列表末尾追加下一页"""
+        self.load_scheduled = False
+        if not self.ready or self.exhausted:
+            return
+        records = self.history_db.query(before=self.last_key, limit=PAGE_SIZE, **self.get_filters())
+        for record in records:
+            # reload 读取最大ID之后写入的记录可能已经由 show_new 插入
+            if not self.tree.exists(str(record["id"])):
+                self.tree.insert("", "end", iid=str(record["id"]), values=self.format_row(record))
+        if records:
+            self.last_key = (records[-1]["time"], records[-1]["id"])
+        self.exhausted = len(records) < PAGE_SIZE
+    
+    def show_new(self):
+        """把上次查询之后新增的记录插入到列表顶部"""
+        if not self.ready:
+            return
+        self._after_writes(self._show_new)
+    
+    def _after_writes(self, callback):
+        """队列中的记录全部写入后在界面线程中调用 callback()，不阻塞界面线程"""
+        self._poll_written(self.history_db.written(), callback)
+    
+    def _poll_written(self, written, callback):
+        if written.is_set():
+            callback()
+        else:
+            self.tree.after(PROGRESS_POLL_INTERVAL, self._poll_written, written, callback)
+    
+    def _show_new(self):
+        newest_id = self.history_db.last_id()
+        if newest_id <= self.newest_id:
+            return
+        records = self.history_db.query(since_id=self.newest_id, **self.get_filters())
+        self.newest_id = newest_id
+        index = 0
+        for record in records:
+            if not self.tree.exists(str(record["id"])):
+                self.tree.insert("", index, iid=str(record["id"]), values=self.format_row(record))
+                index += 1
+    
+    def on_scroll(self, first, last):
+        """Treeview的滚动回调：更新滚动条，接近底部时加载下一页"""
+        self.scrollbar.set(first, last)
+        if not self.exhausted and not self.load_scheduled and float(last) >= LOAD_MORE_THRESHOLD:
+            # 滚动回调中不能直接修改列表，等界面空闲时再加载
+            self.load_scheduled = True
+            self.tree.after_idle(self.load_more)
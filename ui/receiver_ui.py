@@ -6,11 +6,11 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import threading
+import queue
 import os
 import sys
-import json
 import socket
-import struct
+import time
 from datetime import datetime
 
 # 添加项目根目录到系统路径
@@ -18,6 +18,12 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from common.protocol import *
 from common.utils import get_local_ip, find_available_port, format_size, create_received_dir
+from common.progress import TransferProgress, PROGRESS_POLL_INTERVAL
+from common.history import HistoryDatabase, make_record, RECEIVER_HISTORY_FILE, FLUSH_TIMEOUT
+from common.receiver_core import FileReceiver
+from common.content_index import ContentIndex
+from common.resume import ResumeIndex
+from ui.history_view import HistoryView
 
 class ReceiverUI:
     def __init__(self, root):
@@ -33,11 +39,22 @@ class ReceiverUI:
         self.received_files = []
         self.total_received = 0
         self.total_size = 0
-        self.history_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "transfer_history.json")
-        self.transfer_history = []
-        
-        # 加载传输历史记录
-        self.load_transfer_history()
+        # 握手和文件接收由FileReceiver处理，启动服务器时创建
+        self.receiver = None
+        # 接收线程只更新计数器，界面定时轮询
+        self.progress_tracker = TransferProgress()
+        self.history_file = RECEIVER_HISTORY_FILE
+        # 所有接收目录共用的内容索引，重复发送的文件直接在本地复制；第一次启动服务器时加载
+        self.content_index = None
+        # 所有接收目录共用的续传记录，第一次启动服务器时加载
+        self.resume_index = None
+        # 历史数据库在后台线程中打开，新增的记录由后台线程写入；
+        # 写入线程的错误消息放入队列，由界面线程在 poll_progress 中显示
+        self.history_messages = queue.Queue()
+        self.history_db = HistoryDatabase(self.history_file, legacy_files=[
+            os.path.splitext(self.history_file)[0] + ".json",
+            os.path.splitext(self.history_file)[0] + ".jsonl"
+        ], log=self.history_messages.put)
         
         # 创建界面
         self.create_widgets()
@@ -45,6 +62,12 @@ class ReceiverUI:
         # 设置拖拽功能
         self.setup_drag_drop()
         
+        # 窗口显示后再显示传输历史记录
+        self.root.after_idle(self.poll_history_loaded)
+        
+        # 定时刷新传输进度
+        self.poll_progress()
+        
         # 设置关闭事件处理
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
     
@@ -156,6 +179,17 @@ class ReceiverUI:
         ttk.Button(button_frame, text="清空历史", command=self.clear_history).pack(side=tk.LEFT, padx=(0, 5))
         ttk.Button(button_frame, text="导出历史", command=self.export_history).pack(side=tk.LEFT)
         
+        # 查询条件：文件名搜索和类型
+        self.history_status_var = tk.StringVar(value="全部")
+        ttk.Combobox(button_frame, textvariable=self.history_status_var, values=("全部", "网络接收", "拖拽上传"),
+                     width=8, state="readonly").pack(side=tk.RIGHT)
+        self.history_search_var = tk.StringVar()
+        search_entry = ttk.Entry(button_frame, textvariable=self.history_search_var, width=20)
+        search_entry.pack(side=tk.RIGHT, padx=(0, 5))
+        search_entry.bind("<Return>", lambda event: self.refresh_history())
+        ttk.Label(button_frame, text="搜索文件名:").pack(side=tk.RIGHT)
+        self.history_status_var.trace_add("write", lambda *args: self.refresh_history())
+        
         # 历史记录列表
         list_frame = ttk.Frame(history_frame)
         list_frame.pack(fill=tk.BOTH, expand=True)
@@ -165,20 +199,25 @@ class ReceiverUI:
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
         # 历史记录树形视图
-        self.history_tree = ttk.Treeview(list_frame, columns=("时间", "文件名", "大小", "类型"), show="headings", yscrollcommand=scrollbar.set)
+        self.history_tree = ttk.Treeview(list_frame, columns=("时间", "文件名", "大小", "类型", "发送端"), show="headings")
         self.history_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.config(command=self.history_tree.yview)
+        # 分页显示，滚动条由列表更新
+        self.history_view = HistoryView(self.history_tree, scrollbar, self.history_db,
+                                        self.format_history_row, self.history_filters)
         
         # 设置列标题和宽度
         self.history_tree.heading("时间", text="传输时间")
         self.history_tree.heading("文件名", text="文件名")
         self.history_tree.heading("大小", text="大小")
         self.history_tree.heading("类型", text="类型")
+        self.history_tree.heading("发送端", text="发送端")
         
         self.history_tree.column("时间", width=150)
         self.history_tree.column("文件名", width=250)
         self.history_tree.column("大小", width=100)
         self.history_tree.column("类型", width=80)
+        self.history_tree.column("发送端", width=110)
         
         # 绑定双击事件，用于打开文件
         self.history_tree.bind("<Double-1>", self.open_history_file)
@@ -188,9 +227,6 @@ class ReceiverUI:
         self.context_menu.add_command(label="打开文件", command=self.open_selected_file)
         self.context_menu.add_command(label="打开所在文件夹", command=self.open_file_location)
         self.history_tree.bind("<Button-3>", self.show_context_menu)
-        
-        # 初始加载历史记录
-        self.refresh_history()
     
     def setup_drag_drop(self):
         """设置拖拽功能"""
@@ -231,7 +267,7 @@ class ReceiverUI:
                     
                     # 添加到历史记录
                     file_size = os.path.getsize(dest_path)
-                    self.add_to_history(filename, file_size, "拖拽上传")
+                    self.add_to_history(filename, file_size, "拖拽上传", path=dest_path)
                     
                     saved_count += 1
                 except Exception as e:
@@ -239,69 +275,52 @@ class ReceiverUI:
         
         if saved_count > 0:
             self.log_message(f"通过拖拽保存了 {saved_count} 个文件到接收目录")
-            self.refresh_history()
+            self.history_view.show_new()
     
-    def load_transfer_history(self):
-        """加载传输历史记录"""
-        try:
-            if os.path.exists(self.history_file):
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    self.transfer_history = json.load(f)
-            else:
-                self.transfer_history = []
-        except Exception as e:
-            self.log_message(f"加载历史记录失败: {str(e)}")
-            self.transfer_history = []
+    def poll_history_loaded(self):
+        """历史数据库在后台线程中打开（第一次启动时导入旧版本的历史文件），准备好后显示"""
+        if not self.history_db.loaded.is_set():
+            self.root.after(PROGRESS_POLL_INTERVAL, self.poll_history_loaded)
+            return
+        if self.history_db.error:
+            self.log_message(f"打开历史记录失败: {str(self.history_db.error)}")
+            return
+        self.refresh_history()
     
-    def save_transfer_history(self):
-        """保存传输历史记录"""
-        try:
-            # 确保目录存在
-            os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
-            
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.transfer_history, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            self.log_message(f"保存历史记录失败: {str(e)}")
-    
-    def add_to_history(self, filename, filesize, transfer_type):
-        """添加记录到历史"""
-        record = {
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "filename": filename,
-            "filesize": filesize,
-            "type": transfer_type,
-            "path": os.path.join(self.current_received_dir, filename) if self.current_received_dir else ""
+    def add_to_history(self, filename, filesize, transfer_type, path="", peer="", digest=None):
+        """添加记录到历史（可以在接收线程中调用）"""
+        self.history_db.append(make_record(filename, filesize, peer=peer, status=transfer_type,
+                                           path=path, digest=digest))
+    
+    def history_filters(self):
+        """历史记录页面中的查询条件"""
+        status = self.history_status_var.get()
+        return {
+            "name": self.history_search_var.get().strip() or None,
+            "status": None if status == "全部" else status
         }
-        
-        self.transfer_history.append(record)
-        self.save_transfer_history()
     
     def refresh_history(self):
-        """刷新历史记录显示"""
-        # 清空当前显示
-        for item in self.history_tree.get_children():
-            self.history_tree.delete(item)
-        
-        # 按时间倒序显示历史记录
-        for record in reversed(self.transfer_history):
-            self.history_tree.insert("", "end", values=(
-                record["time"],
-                record["filename"],
-                format_size(record["filesize"]),
-                record["type"]
-            ))
+        """按查询条件重新显示历史记录（只加载第一页，滚动时再加载更多）"""
+        self.history_view.reload()
+    
+    def format_history_row(self, record):
+        """历史记录列表中一行的显示值"""
+        return (record["time"], record["filename"], format_size(record["filesize"]),
+                record["status"], record["peer"])
     
     def clear_history(self):
         """清空历史记录"""
+        if not self.history_db.loaded.is_set():
+            messagebox.showinfo("提示", "历史记录正在加载，请稍后再试")
+            return
         if messagebox.askyesno("确认", "确定要清空所有历史记录吗？"):
-            self.transfer_history = []
-            self.save_transfer_history()
+            self.history_db.clear()
             self.refresh_history()
             self.log_message("已清空历史记录")
     
     def export_history(self):
-        """导出历史记录"""
+        """导出符合当前查询条件的历史记录"""
         file_path = filedialog.asksaveasfilename(
             title="导出历史记录",
             defaultextension=".txt",
@@ -310,10 +329,13 @@ class ReceiverUI:
         
         if file_path:
             try:
+                # 写入线程没有及时写完时只导出已经写入的记录，不让界面卡住
+                if not self.history_db.flush(FLUSH_TIMEOUT):
+                    self.log_message("部分历史记录尚未写入，导出的记录可能不完整")
                 with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write("传输时间\t文件名\t大小\t类型\n")
-                    for record in self.transfer_history:
-                        f.write(f"{record['time']}\t{record['filename']}\t{format_size(record['filesize'])}\t{record['type']}\n")
+                    f.write("传输时间\t文件名\t大小\t类型\t发送端\n")
+                    for record in self.history_db.query(**self.history_filters()):
+                        f.write(f"{record['time']}\t{record['filename']}\t{format_size(record['filesize'])}\t{record['status']}\t{record['peer']}\n")
                 
                 messagebox.showinfo("成功", f"历史记录已导出到: {file_path}")
             except Exception as e:
@@ -323,51 +345,32 @@ class ReceiverUI:
         """双击打开历史记录中的文件"""
         self.open_selected_file()
     
-    def open_selected_file(self):
-        """打开选中的文件"""
+    def selected_history_path(self):
+        """选中的历史记录对应的文件路径，文件不存在时提示并返回None"""
         selection = self.history_tree.selection()
         if not selection:
-            return
-            
-        # 获取选中的记录
-        item = self.history_tree.item(selection[0])
-        filename = item["values"][1]
-        
-        # 在历史记录中查找完整路径
-        for record in self.transfer_history:
-            if record["filename"] == filename and record["path"]:
-                file_path = record["path"]
-                if os.path.exists(file_path):
-                    self.open_file_with_default_app(file_path)
-                    return
-                else:
-                    messagebox.showwarning("警告", f"文件不存在: {file_path}")
-                    return
-        
-        messagebox.showwarning("警告", f"未找到文件: {filename}")
+            return None
+        
+        record = self.history_db.get(int(selection[0]))
+        if not record or not record["path"]:
+            messagebox.showwarning("警告", "未找到文件")
+            return None
+        if not os.path.exists(record["path"]):
+            messagebox.showwarning("警告", f"文件不存在: {record['path']}")
+            return None
+        return record["path"]
+    
+    def open_selected_file(self):
+        """打开选中的文件"""
+        file_path = self.selected_history_path()
+        if file_path:
+            self.open_file_with_default_app(file_path)
     
     def open_file_location(self):
         """打开文件所在位置"""
-        selection = self.history_tree.selection()
-        if not selection:
-            return
-            
-        # 获取选中的记录
-        item = self.history_tree.item(selection[0])
-        filename = item["values"][1]
-        
-        # 在历史记录中查找完整路径
-        for record in self.transfer_history:
-            if record["filename"] == filename and record["path"]:
-                file_path = record["path"]
-                if os.path.exists(file_path):
-                    self.open_file_location_with_default_app(file_path)
-                    return
-                else:
-                    messagebox.showwarning("警告", f"文件不存在: {file_path}")
-                    return
-        
-        messagebox.showwarning("警告", f"未找到文件: {filename}")
+        file_path = self.selected_history_path()
+        if file_path:
+            self.open_file_location_with_default_app(file_path)
     
     def open_file_with_default_app(self, file_path):
         """使用默认应用程序打开文件"""
@@ -417,7 +420,7 @@ class ReceiverUI:
     
     def start_server(self):
         """启动服务器"""
-        if self.is_running:
+        if self.is_running or self.server:
             return
         
         # 创建接收目录
@@ -425,10 +428,33 @@ class ReceiverUI:
         self.current_received_dir = create_received_dir(data_dir)
         self.current_dir_label.config(text=f"接收目录: {self.current_received_dir}")
         
-        # 启动服务器线程
-        self.server_thread = threading.Thread(target=self.run_server)
-        self.server_thread.daemon = True
-        self.server_thread.start()
+        if self.content_index is None:
+            self.content_index = ContentIndex(os.path.join(os.path.dirname(self.history_file), "content_index.json"),
+                                              log=self.log_message)
+        if self.resume_index is None:
+            # 每次启动使用新的接收目录，续传记录放在data目录中，中断的文件重启后在原目录中续传
+            self.resume_index = ResumeIndex(os.path.join(os.path.dirname(self.history_file), "resume_index.json"),
+                                            log=self.log_message)
+        
+        self.receiver = FileReceiver(
+            self.current_received_dir,
+            progress=self.progress_tracker,
+            log=self.log_message,
+            on_file_received=self.on_file_received,
+            on_batch_end=self.on_batch_end,
+            content_index=self.content_index,
+            resume_index=self.resume_index
+        )
+        
+        # 在后台线程的事件循环中接受和处理所有连接（asyncio导入较慢，启动服务器时才导入）
+        from common.receiver_server import ReceiverServer
+        self.server = ReceiverServer(self.receiver, port=PORT)
+        try:
+            self.server.start()
+        except Exception as e:
+            self.server = None
+            self.log_message(f"无法启动服务器: {str(e)}")
+            return
         
         # 更新UI状态
         self.is_running = True
@@ -445,155 +471,60 @@ class ReceiverUI:
             return
         
         self.is_running = False
+        self.stop_button.config(state=tk.DISABLED)
         
-        # 关闭服务器
+        # 停止监听并断开空闲的连接，正在接收的文件完成后再断开
         if self.server:
-            self.server.close()
+            self.server.stop()
+            self.status_label.config(text="状态: 正在停止", foreground="orange")
+            # 服务器线程退出（端口释放）后才能重新启动，正在接收的文件最多等待 shutdown_timeout 秒
+            self.stop_deadline = time.monotonic() + self.server.shutdown_timeout + 5
+        self.wait_server_stopped()
+    
+    def wait_server_stopped(self):
+        """在界面线程中轮询等待服务器线程退出，之后才重新启用启动按钮"""
+        if self.server:
+            self.server.join(0)
+            if self.server.thread.is_alive():
+                if time.monotonic() < self.stop_deadline:
+                    self.root.after(PROGRESS_POLL_INTERVAL, self.wait_server_stopped)
+                    return
+                self.log_message("服务器未能按时停止")
+            self.server = None
         
         # 更新UI状态
         self.start_button.config(state=tk.NORMAL)
-        self.stop_button.config(state=tk.DISABLED)
         self.status_label.config(text="状态: 已停止", foreground="red")
         
         self.log_message("服务器已停止")
     
-    def run_server(self):
-        """运行服务器"""
-        try:
-            import socket
-            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server.bind(('', PORT))
-            self.server.listen(5)
-            
-            while self.is_running:
-                try:
-                    # 设置超时，以便可以检查is_running标志
-                    self.server.settimeout(1.0)
-                    client_socket, addr = self.server.accept()
-                    
-                    # 处理客户端连接
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, addr)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                    
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    if self.is_running:
-                        self.log_message(f"服务器错误: {str(e)}")
-                    break
-                    
-        except Exception as e:
-            self.log_message(f"无法启动服务器: {str(e)}")
-            self.stop_server()
+    def on_file_received(self, filename, file_path, filesize, peer, digest):
+        """文件接收完成（在接收线程中调用）"""
+        self.received_files.append(file_path)
+        self.total_received += 1
+        self.total_size += filesize
+        
+        # 添加到历史记录
+        self.add_to_history(filename, filesize, "网络接收", path=file_path, peer=peer, digest=digest)
+        
+        self.root.after(0, self.update_stats)
     
-    def handle_client(self, client_socket, addr):
-        """处理客户端连接"""
-        try:
-            self.log_message(f"客户端连接: {addr[0]}:{addr[1]}")
-            
-            # 接收握手消息
-            data = client_socket.recv(HEADER_SIZE)
-            if not data:
-                return
-                
-            msg_len = struct.unpack('!I', data[:HEADER_SIZE])[0]
-            msg_data = client_socket.recv(msg_len)
-            handshake = ProtocolMessage.from_json(msg_data.decode('utf-8'))
-            
-            if handshake.msg_type != MSG_TYPE_HANDSHAKE:
-                self.log_message(f"无效的握手消息: {handshake.msg_type}")
-                return
-                
-            self.log_message(f"握手成功，客户端: {handshake.client_name}")
-            
-            # 发送握手响应
-            response = HandshakeMessage(client_name="DeskTransfer Receiver")
-            client_socket.send(pack_message(response))
-            
-            # 处理文件传输
-            self.receive_files(client_socket)
-            
-        except Exception as e:
-            self.log_message(f"处理客户端连接时出错: {str(e)}")
-        finally:
-            client_socket.close()
-            self.log_message(f"客户端断开连接: {addr[0]}:{addr[1]}")
-    
-    def receive_files(self, client_socket):
-        """接收文件"""
-        current_file = None
-        current_file_size = 0
-        received_size = 0
-        file_count = 0
-        current_file_num = 0
-        
-        while self.is_running:
-            try:
-                # 接收消息头
-                header = client_socket.recv(HEADER_SIZE)
-                if not header:
-                    break
-                    
-                msg_len = struct.unpack('!I', header[:HEADER_SIZE])[0]
-                msg_data = client_socket.recv(msg_len)
-                message = ProtocolMessage.from_json(msg_data.decode('utf-8'))
-                
-                if message.msg_type == MSG_TYPE_FILE_INFO:
-                    # 文件信息消息
-                    file_info = message
-                    current_file = file_info.filename
-                    current_file_size = file_info.filesize
-                    file_count = file_info.file_count
-                    current_file_num = file_info.current_file
-                    received_size = 0
-                    
-                    self.root.after(0, self.update_progress, 0, 
-                                   f"接收文件 {current_file_num}/{file_count}: {current_file}")
-                    
-                elif message.msg_type == MSG_TYPE_FILE_DATA:
-                    # 文件数据消息
-                    file_data = message
-                    file_path = os.path.join(self.current_received_dir, current_file)
-                    
-                    with open(file_path, 'ab') as f:
-                        f.write(file_data.data)
-                    
-                    received_size += len(file_data.data)
-                    progress = int((received_size / current_file_size) * 100) if current_file_size > 0 else 0
-                    
-                    self.root.after(0, self.update_progress, progress, 
-                                   f"接收文件 {current_file_num}/{file_count}: {current_file} ({format_size(received_size)}/{format_size(current_file_size)})")
-                    
-                elif message.msg_type == MSG_TYPE_FILE_END:
-                    # 文件传输结束
-                    file_path = os.path.join(self.current_received_dir, current_file)
-                    self.received_files.append(file_path)
-                    self.total_received += 1
-                    self.total_size += current_file_size
-                    
-                    # 添加到历史记录
-                    self.add_to_history(current_file, current_file_size, "网络接收")
-                    
-                    self.root.after(0, self.update_stats)
-                    self.log_message(f"文件接收完成: {current_file} ({format_size(current_file_size)})")
-                    
-                elif message.msg_type == MSG_TYPE_BATCH_END:
-                    # 批量传输结束
-                    self.log_message(f"批量传输完成，共接收 {file_count} 个文件")
-                    self.root.after(0, self.update_progress, 100, "传输完成")
-                    
-                elif message.msg_type == MSG_TYPE_ERROR:
-                    # 错误消息
-                    error = message
-                    self.log_message(f"传输错误: {error.error_msg}")
-                    
-            except Exception as e:
-                self.log_message(f"接收文件时出错: {str(e)}")
-                break
+    def on_batch_end(self, file_count, total_bytes):
+        """批量传输结束（在接收线程中调用）"""
+        self.progress_tracker.finish()
+        self.root.after(0, self.update_progress, 100, "传输完成")
+        # 新接收的文件插入到历史记录列表顶部
+        self.root.after(0, self.history_view.show_new)
+    
+    def poll_progress(self):
+        """按固定频率从进度计数器刷新进度条，显示历史记录写入线程的消息"""
+        if self.progress_tracker.active:
+            snapshot = self.progress_tracker.snapshot()
+            self.progress['value'] = snapshot.percent
+            self.progress_label.config(text=snapshot.describe("接收"))
+        while not self.history_messages.empty():
+            self.log_message(self.history_messages.get())
+        self.root.after(PROGRESS_POLL_INTERVAL, self.poll_progress)
     
     def update_progress(self, value, text):
         """更新进度条"""
@@ -695,9 +626,14 @@ class ReceiverUI:
         if self.is_running:
             if messagebox.askokcancel("退出", "服务器正在运行，确定要退出吗？"):
                 self.stop_server()
-                self.root.destroy()
+                self.close_window()
         else:
-            self.root.destroy()
+            self.close_window()
+    
+    def close_window(self):
+        """写入剩余的历史记录后关闭窗口"""
+        self.history_db.close()
+        self.root.destroy()
 
 def main():
     """主函数"""
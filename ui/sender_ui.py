@@ -6,10 +6,9 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import threading
+import queue
 import os
 import sys
-import struct
-import json
 from datetime import datetime
 
 # 添加项目根目录到系统路径
@@ -17,7 +16,12 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from common.protocol import *
 from common.utils import get_local_ip, validate_ip_address, format_size
-from common.protocol import is_image_file
+from common.progress import TransferProgress, PROGRESS_POLL_INTERVAL
+from common.file_selection import FileSelection
+from common.folder_scan import FolderScanner
+from common.history import HistoryDatabase, make_record, SENDER_HISTORY_FILE, FLUSH_TIMEOUT
+from common.sender_core import SenderConnection, send_batch, DEFAULT_STREAM_COUNT, MAX_STREAM_COUNT
+from ui.history_view import HistoryView
 
 class SenderUI:
     def __init__(self, root):
@@ -27,13 +31,26 @@ class SenderUI:
         self.root.resizable(True, True)
         
         # 初始化变量
-        self.selected_files = []
+        self.selected_files = FileSelection()
+        # 正在后台扫描（展开文件夹、识别图片）的任务，以及本轮扫描添加和跳过的文件数
+        self.scanners = []
+        self.scan_added_count = 0
+        self.scan_skipped_count = 0
         self.is_sending = False
-        self.client_socket = None
+        # 到接收端的主连接，握手和发送由SenderConnection处理
+        self.connection = None
+        # 发送线程只更新计数器，界面定时轮询
+        self.progress_tracker = TransferProgress()
         
         # 历史记录相关
-        self.history_file = os.path.join(os.path.expanduser("~"), ".desktransfer", "sender_history.json")
-        self.transfer_history = []
+        self.history_file = SENDER_HISTORY_FILE
+        # 历史数据库在后台线程中打开，新增的记录由后台线程写入；
+        # 写入线程的错误消息放入队列，由界面线程在 poll_progress 中显示
+        self.history_messages = queue.Queue()
+        self.history_db = HistoryDatabase(self.history_file, legacy_files=[
+            os.path.splitext(self.history_file)[0] + ".json",
+            os.path.splitext(self.history_file)[0] + ".jsonl"
+        ], log=self.history_messages.put)
         
         # 创建界面
         self.create_widgets()
@@ -41,8 +58,12 @@ class SenderUI:
         # 设置拖拽功能
         self.setup_drag_drop()
         
-        # 加载历史记录
-        self.load_transfer_history()
+        # 窗口显示后再显示历史记录和枚举网卡，不拖慢启动
+        self.root.after_idle(self.poll_history_loaded)
+        self.root.after_idle(self.load_available_ips_async)
+        
+        # 定时刷新传输进度
+        self.poll_progress()
         
         # 设置关闭事件处理
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -88,13 +109,8 @@ class SenderUI:
         self.ip_combo = ttk.Combobox(ip_frame, textvariable=self.ip_var, width=20, state="readonly")
         self.ip_combo.pack(side=tk.LEFT, padx=(5, 5))
         
-        # 获取并设置所有可用的IP地址
-        self.available_ips = self.get_available_ips()
-        self.ip_combo['values'] = self.available_ips
-        
-        # 如果有可用IP，默认选择第一个
-        if self.available_ips:
-            self.ip_combo.current(0)
+        # 可用的IP地址在窗口显示后由后台线程填入
+        self.available_ips = []
         
         # 刷新IP地址按钮
         self.refresh_ip_button = ttk.Button(ip_frame, text="刷新IP", command=self.refresh_available_ips)
@@ -108,6 +124,17 @@ class SenderUI:
         self.port_label = ttk.Label(port_frame, text=str(PORT))
         self.port_label.pack(side=tk.LEFT, padx=(5, 0))
         
+        # 并行连接数
+        ttk.Label(port_frame, text="并行连接:").pack(side=tk.LEFT, padx=(20, 0))
+        self.stream_count_var = tk.IntVar(value=DEFAULT_STREAM_COUNT)
+        self.stream_count_spinbox = ttk.Spinbox(port_frame, from_=1, to=MAX_STREAM_COUNT, width=5,
+                                                textvariable=self.stream_count_var, state="readonly")
+        self.stream_count_spinbox.pack(side=tk.LEFT, padx=(5, 0))
+        
+        # 接收端有旧版本的文件只发送变化的部分
+        self.delta_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(port_frame, text="增量传输", variable=self.delta_var).pack(side=tk.LEFT, padx=(20, 0))
+        
         # 文件选择框架
         file_frame = ttk.LabelFrame(self.send_frame, text="文件选择", padding="10")
         file_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
@@ -133,11 +160,18 @@ class SenderUI:
         self.add_button = ttk.Button(button_frame, text="添加文件", command=self.add_files)
         self.add_button.pack(side=tk.LEFT, padx=(0, 5))
         
+        self.add_folder_button = ttk.Button(button_frame, text="添加文件夹", command=self.add_folder)
+        self.add_folder_button.pack(side=tk.LEFT, padx=(0, 5))
+        
         self.remove_button = ttk.Button(button_frame, text="移除选中", command=self.remove_selected)
         self.remove_button.pack(side=tk.LEFT, padx=(0, 5))
         
         self.clear_button = ttk.Button(button_frame, text="清空列表", command=self.clear_list)
-        self.clear_button.pack(side=tk.LEFT)
+        self.clear_button.pack(side=tk.LEFT, padx=(0, 5))
+        
+        self.stop_scan_button = ttk.Button(button_frame, text="停止扫描", command=self.cancel_scan,
+                                           state=tk.DISABLED)
+        self.stop_scan_button.pack(side=tk.LEFT)
         
         # 文件信息
         self.file_info_label = ttk.Label(file_frame, text="已选择 0 个文件，总大小: 0 B")
@@ -188,6 +222,17 @@ class SenderUI:
         ttk.Button(toolbar_frame, text="清空记录", command=self.clear_history).pack(side=tk.LEFT, padx=(0, 5))
         ttk.Button(toolbar_frame, text="导出记录", command=self.export_history).pack(side=tk.LEFT)
         
+        # 查询条件：文件名搜索和状态
+        self.history_status_var = tk.StringVar(value="全部")
+        ttk.Combobox(toolbar_frame, textvariable=self.history_status_var, values=("全部", "发送成功", "发送失败"),
+                     width=8, state="readonly").pack(side=tk.RIGHT)
+        self.history_search_var = tk.StringVar()
+        search_entry = ttk.Entry(toolbar_frame, textvariable=self.history_search_var, width=20)
+        search_entry.pack(side=tk.RIGHT, padx=(0, 5))
+        search_entry.bind("<Return>", lambda event: self.refresh_history())
+        ttk.Label(toolbar_frame, text="搜索文件名:").pack(side=tk.RIGHT)
+        self.history_status_var.trace_add("write", lambda *args: self.refresh_history())
+        
         # 历史记录表格
         history_frame = ttk.Frame(self.history_frame)
         history_frame.pack(fill=tk.BOTH, expand=True)
@@ -201,9 +246,10 @@ class SenderUI:
             self.history_tree.heading(col, text=col)
             self.history_tree.column(col, width=120)
         
-        # 添加滚动条
+        # 添加滚动条，分页显示时滚动条由列表更新
         scrollbar = ttk.Scrollbar(history_frame, orient=tk.VERTICAL, command=self.history_tree.yview)
-        self.history_tree.configure(yscrollcommand=scrollbar.set)
+        self.history_view = HistoryView(self.history_tree, scrollbar, self.history_db,
+                                        self.format_history_row, self.history_filters)
         
         # 布局
         self.history_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
@@ -241,86 +287,53 @@ class SenderUI:
         self.add_dropped_files(files)
     
     def add_dropped_files(self, file_paths):
-        """添加拖拽的文件"""
-        added_count = 0
-        for file_path in file_paths:
-            # 移除文件路径前后的可能引号
-            file_path = file_path.strip('"\'')
-            
-            # 检查是否是文件
-            if os.path.isfile(file_path) and is_image_file(file_path) and file_path not in self.selected_files:
-                self.selected_files.append(file_path)
-                filename = os.path.basename(file_path)
-                self.file_listbox.insert(tk.END, filename)
-                added_count += 1
-        
-        if added_count > 0:
-            self.update_file_info()
-            self.log_message(f"通过拖拽添加了 {added_count} 个文件")
-    
-    def load_transfer_history(self):
-        """加载传输历史记录"""
-        try:
-            if os.path.exists(self.history_file):
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    self.transfer_history = json.load(f)
-            else:
-                self.transfer_history = []
-        except Exception as e:
-            self.log_message(f"加载历史记录失败: {str(e)}")
-            self.transfer_history = []
-    
-    def save_transfer_history(self):
-        """保存传输历史记录"""
-        try:
-            # 确保目录存在
-            os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
-            
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.transfer_history, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            self.log_message(f"保存历史记录失败: {str(e)}")
-    
-    def add_to_history(self, filename, filesize, receiver_ip, status):
-        """添加记录到历史"""
-        record = {
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "filename": filename,
-            "filesize": filesize,
-            "receiver": receiver_ip,
-            "status": status,
-            "path": filename  # 发送端记录原始文件路径
+        """添加拖拽的文件和文件夹"""
+        # 移除文件路径前后的可能引号
+        self.start_scan([file_path.strip('"\'') for file_path in file_paths])
+    
+    def poll_history_loaded(self):
+        """历史数据库在后台线程中打开（第一次启动时导入旧版本的历史文件），准备好后显示"""
+        if not self.history_db.loaded.is_set():
+            self.root.after(PROGRESS_POLL_INTERVAL, self.poll_history_loaded)
+            return
+        if self.history_db.error:
+            self.log_message(f"打开历史记录失败: {str(self.history_db.error)}")
+            return
+        self.refresh_history()
+    
+    def add_to_history(self, filename, filesize, receiver_ip, status, path=""):
+        """添加记录到历史（可以在发送线程中调用）"""
+        self.history_db.append(make_record(filename, filesize, peer=receiver_ip, status=status, path=path))
+    
+    def history_filters(self):
+        """历史记录页面中的查询条件"""
+        status = self.history_status_var.get()
+        return {
+            "name": self.history_search_var.get().strip() or None,
+            "status": None if status == "全部" else status
         }
-        
-        self.transfer_history.append(record)
-        self.save_transfer_history()
     
     def refresh_history(self):
-        """刷新历史记录显示"""
-        # 清空当前显示
-        for item in self.history_tree.get_children():
-            self.history_tree.delete(item)
-        
-        # 按时间倒序显示历史记录
-        for record in reversed(self.transfer_history):
-            self.history_tree.insert("", "end", values=(
-                record["time"],
-                record["filename"],
-                format_size(record["filesize"]),
-                record["receiver"],
-                record["status"]
-            ))
+        """按查询条件重新显示历史记录（只加载第一页，滚动时再加载更多）"""
+        self.history_view.reload()
+    
+    def format_history_row(self, record):
+        """历史记录列表中一行的显示值"""
+        return (record["time"], record["filename"], format_size(record["filesize"]),
+                record["peer"], record["status"])
     
     def clear_history(self):
         """清空历史记录"""
+        if not self.history_db.loaded.is_set():
+            messagebox.showinfo("提示", "历史记录正在加载，请稍后再试")
+            return
         if messagebox.askyesno("确认", "确定要清空所有历史记录吗？"):
-            self.transfer_history = []
-            self.save_transfer_history()
+            self.history_db.clear()
             self.refresh_history()
             self.log_message("已清空历史记录")
     
     def export_history(self):
-        """导出历史记录"""
+        """导出符合当前查询条件的历史记录"""
         file_path = filedialog.asksaveasfilename(
             title="导出历史记录",
             defaultextension=".txt",
@@ -329,10 +342,13 @@ class SenderUI:
         
         if file_path:
             try:
+                # 写入线程没有及时写完时只导出已经写入的记录，不让界面卡住
+                if not self.history_db.flush(FLUSH_TIMEOUT):
+                    self.log_message("部分历史记录尚未写入，导出的记录可能不完整")
                 with open(file_path, 'w', encoding='utf-8') as f:
                     f.write("传输时间\t文件名\t大小\t接收端\t状态\n")
-                    for record in self.transfer_history:
-                        f.write(f"{record['time']}\t{record['filename']}\t{format_size(record['filesize'])}\t{record['receiver']}\t{record['status']}\n")
+                    for record in self.history_db.query(**self.history_filters()):
+                        f.write(f"{record['time']}\t{record['filename']}\t{format_size(record['filesize'])}\t{record['peer']}\t{record['status']}\n")
                 
                 messagebox.showinfo("成功", f"历史记录已导出到: {file_path}")
             except Exception as e:
@@ -342,51 +358,32 @@ class SenderUI:
         """双击打开历史记录中的文件"""
         self.open_selected_file()
     
-    def open_selected_file(self):
-        """打开选中的文件"""
+    def selected_history_path(self):
+        """选中的历史记录对应的文件路径，文件不存在时提示并返回None"""
         selection = self.history_tree.selection()
         if not selection:
-            return
-            
-        # 获取选中的记录
-        item = self.history_tree.item(selection[0])
-        filename = item["values"][1]
-        
-        # 在历史记录中查找完整路径
-        for record in self.transfer_history:
-            if record["filename"] == filename and record["path"]:
-                file_path = record["path"]
-                if os.path.exists(file_path):
-                    self.open_file_with_default_app(file_path)
-                    return
-                else:
-                    messagebox.showwarning("警告", f"文件不存在: {file_path}")
-                    return
+            return None
         
-        messagebox.showwarning("警告", f"未找到文件: {filename}")
+        record = self.history_db.get(int(selection[0]))
+        if not record or not record["path"]:
+            messagebox.showwarning("警告", "未找到文件")
+            return None
+        if not os.path.exists(record["path"]):
+            messagebox.showwarning("警告", f"文件不存在: {record['path']}")
+            return None
+        return record["path"]
+    
+    def open_selected_file(self):
+        """打开选中的文件"""
+        file_path = self.selected_history_path()
+        if file_path:
+            self.open_file_with_default_app(file_path)
     
     def open_file_location(self):
         """打开文件所在位置"""
-        selection = self.history_tree.selection()
-        if not selection:
-            return
-            
-        # 获取选中的记录
-        item = self.history_tree.item(selection[0])
-        filename = item["values"][1]
-        
-        # 在历史记录中查找完整路径
-        for record in self.transfer_history:
-            if record["filename"] == filename and record["path"]:
-                file_path = record["path"]
-                if os.path.exists(file_path):
-                    self.open_file_location_with_default_app(file_path)
-                    return
-                else:
-                    messagebox.showwarning("警告", f"文件不存在: {file_path}")
-                    return
-        
-        messagebox.showwarning("警告", f"未找到文件: {filename}")
+        file_path = self.selected_history_path()
+        if file_path:
+            self.open_file_location_with_default_app(file_path)
     
     def open_file_with_default_app(self, file_path):
         """使用默认应用程序打开文件"""
@@ -445,15 +442,60 @@ class SenderUI:
         )
         
         if file_paths:
-            for file_path in file_paths:
-                if is_image_file(file_path) and file_path not in self.selected_files:
-                    self.selected_files.append(file_path)
-                    # 只显示文件名，不显示完整路径
-                    filename = os.path.basename(file_path)
-                    self.file_listbox.insert(tk.END, filename)
-            
+            self.start_scan(file_paths)
+    
+    def add_folder(self):
+        """选择文件夹，在后台递归添加其中的图片"""
+        folder = filedialog.askdirectory(title="选择文件夹")
+        if folder:
+            self.log_message(f"正在扫描文件夹: {folder}")
+            self.start_scan([folder])
+    
+    def start_scan(self, paths):
+        """在后台线程中展开文件夹并按内容识别图片，找到的图片随扫描进度加入列表"""
+        scanner = FolderScanner(paths)
+        scanner.start()
+        if not self.scanners:
+            self.scan_added_count = 0
+            self.scan_skipped_count = 0
+            self.stop_scan_button.config(state=tk.NORMAL)
+            self.root.after(PROGRESS_POLL_INTERVAL, self.poll_scans)
+        self.scanners.append(scanner)
+        self.update_file_info()
+    
+    def poll_scans(self):
+        """按固定频率把扫描到的文件加入列表"""
+        if not self.scanners:
+            return
+        for scanner in list(self.scanners):
+            # 先判断是否结束，再取出结果，结束前的最后一批不会遗漏
+            finished = scanner.done.is_set()
+            added = self.show_added_files(self.selected_files.add_stats(scanner.take()))
+            self.scan_added_count += len(added)
+            if finished:
+                self.scan_skipped_count += scanner.skipped
+                self.scanners.remove(scanner)
+        
+        if self.scanners:
+            self.root.after(PROGRESS_POLL_INTERVAL, self.poll_scans)
+        else:
+            self.stop_scan_button.config(state=tk.DISABLED)
             self.update_file_info()
-            self.log_message(f"添加了 {len(file_paths)} 个文件")
+            message = f"添加了 {self.scan_added_count} 个文件"
+            if self.scan_skipped_count:
+                message += f"，跳过 {self.scan_skipped_count} 个不是图片的文件"
+            self.log_message(message)
+    
+    def cancel_scan(self):
+        """停止正在进行的扫描，已经加入列表的文件保留"""
+        if not self.scanners:
+            return
+        for scanner in self.scanners:
+            scanner.cancel()
+        self.scanners = []
+        self.stop_scan_button.config(state=tk.DISABLED)
+        self.update_file_info()
+        self.log_message(f"已停止扫描，添加了 {self.scan_added_count} 个文件")
     
     def remove_selected(self):
         """移除选中的文件"""
@@ -462,24 +504,34 @@ class SenderUI:
         # 从后往前删除，避免索引变化
         for index in reversed(selected_indices):
             self.file_listbox.delete(index)
-            del self.selected_files[index]
+        self.selected_files.remove_at(selected_indices)
         
         self.update_file_info()
     
     def clear_list(self):
-        """清空文件列表"""
+        """清空文件列表（同时停止正在进行的扫描）"""
+        self.cancel_scan()
         self.file_listbox.delete(0, tk.END)
         self.selected_files.clear()
         self.update_file_info()
     
+    def show_added_files(self, added):
+        """在列表框中显示新加入待发送列表的文件"""
+        if added:
+            # 只显示文件名，不显示完整路径；一次插入所有行
+            self.file_listbox.insert(tk.END, *[os.path.basename(file_path) for file_path in added])
+            self.update_file_info()
+        return added
+    
     def update_file_info(self):
-        """更新文件信息显示"""
+        """更新文件信息显示（总大小由待发送列表增量维护）"""
         file_count = len(self.selected_files)
-        total_size = sum(os.path.getsize(file_path) for file_path in self.selected_files)
+        total_size = self.selected_files.total_size
         
-        self.file_info_label.config(
-            text=f"已选择 {file_count} 个文件，总大小: {format_size(total_size)}"
-        )
+        text = f"已选择 {file_count} 个文件，总大小: {format_size(total_size)}"
+        if self.scanners:
+            text += "（正在扫描...）"
+        self.file_info_label.config(text=text)
     
     def connect_to_receiver(self):
         """连接到接收端"""
@@ -519,30 +571,12 @@ class SenderUI:
     def connect_worker(self, ip_address):
         """连接工作线程"""
         try:
-            import socket
-            
-            # 创建socket连接
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((ip_address, PORT))
-            
-            # 发送握手消息
-            handshake = HandshakeMessage(client_name="DeskTransfer Sender")
-            self.client_socket.send(pack_message(handshake))
-            
-            # 接收握手响应
-            data = self.client_socket.recv(HEADER_SIZE)
-            if not data:
-                raise Exception("未收到响应")
-                
-            msg_len = struct.unpack('!I', data[:HEADER_SIZE])[0]
-            msg_data = self.client_socket.recv(msg_len)
-            response = ProtocolMessage.from_json(msg_data.decode('utf-8'))
-            
-            if response.msg_type != MSG_TYPE_HANDSHAKE:
-                raise Exception(f"无效的握手响应: {response.msg_type}")
+            connection = SenderConnection(ip_address, PORT)
+            connection.connect()
+            self.connection = connection
             
             # 连接成功
-            self.root.after(0, self.on_connect_success, ip_address, response.client_name)
+            self.root.after(0, self.on_connect_success, ip_address, connection.receiver_name)
             
         except Exception as e:
             self.root.after(0, self.on_connect_error, str(e))
@@ -554,6 +588,8 @@ class SenderUI:
         self.send_button.config(state=tk.NORMAL)
         self.disconnect_button.config(state=tk.NORMAL)
         self.log_message(f"成功连接到 {ip_address}:{PORT} ({client_name})")
+        self.log_message(f"协商最大块大小: {format_size(self.connection.max_chunk_size)}，"
+                         f"RTT: {self.connection.rtt * 1000:.1f} ms")
     
     def on_connect_error(self, error_msg):
         """连接错误回调"""
@@ -562,15 +598,15 @@ class SenderUI:
         self.log_message(f"连接失败: {error_msg}")
         messagebox.showerror("连接失败", error_msg)
         
-        if self.client_socket:
-            self.client_socket.close()
-            self.client_socket = None
+        if self.connection:
+            self.connection.close()
+            self.connection = None
     
     def disconnect(self):
         """断开连接"""
-        if self.client_socket:
-            self.client_socket.close()
-            self.client_socket = None
+        if self.connection:
+            self.connection.close()
+            self.connection = None
         
         self.status_label.config(text="状态: 未连接", foreground="red")
         self.connect_button.config(state=tk.NORMAL)
@@ -587,7 +623,7 @@ class SenderUI:
             messagebox.showerror("错误", "请先选择要发送的文件")
             return
         
-        if not self.client_socket:
+        if not self.connection:
             messagebox.showerror("错误", "未连接到接收端")
             return
         
@@ -605,79 +641,57 @@ class SenderUI:
     def send_worker(self):
         """发送工作线程"""
         try:
-            file_count = len(self.selected_files)
-            receiver_ip = self.ip_var.get()
+            file_paths = list(self.selected_files)
+            total_bytes = self.selected_files.total_size
+            receiver_ip = self.connection.ip_address
+            stream_count = self.stream_count_var.get()
+            delta = self.delta_var.get()
+            self.progress_tracker.reset(len(file_paths), total_bytes)
+            self.root.after(0, self.log_message, f"初始块大小: {format_size(self.connection.sizer.chunk_size)}")
             
-            for i, file_path in enumerate(self.selected_files):
-                if not self.is_sending:
-                    break
-                
+            def on_file_done(file_path, filesize, error):
                 filename = os.path.basename(file_path)
-                filesize = os.path.getsize(file_path)
-                
-                try:
-                    # 发送文件信息
-                    file_info = FileInfoMessage(
-                        filename=filename,
-                        filesize=filesize,
-                        file_count=file_count,
-                        current_file=i+1
-                    )
-                    self.client_socket.send(pack_message(file_info))
-                    
-                    # 更新进度
-                    self.root.after(0, self.update_progress, 0, 
-                                   f"发送文件 {i+1}/{file_count}: {filename}")
-                    
-                    # 发送文件数据
-                    with open(file_path, 'rb') as f:
-                        sent_bytes = 0
-                        chunk_size = BUFFER_SIZE
-                        
-                        while sent_bytes < filesize and self.is_sending:
-                            chunk = f.read(chunk_size)
-                            if not chunk:
-                                break
-                            
-                            file_data = FileDataMessage(data=chunk)
-                            self.client_socket.send(pack_message(file_data))
-                            
-                            sent_bytes += len(chunk)
-                            progress = int((sent_bytes / filesize) * 100)
-                            
-                            self.root.after(0, self.update_progress, progress,
-                                           f"发送文件 {i+1}/{file_count}: {filename} ({format_size(sent_bytes)}/{format_size(filesize)})")
-                    
-                    # 发送文件结束消息
-                    file_end = FileEndMessage()
-                    self.client_socket.send(pack_message(file_end))
-                    
+                if error is None:
                     self.root.after(0, self.log_message, f"文件发送完成: {filename}")
                     # 添加成功记录到历史
-                    self.root.after(0, lambda fn=filename, fs=filesize: self.add_to_history(fn, fs, receiver_ip, "发送成功"))
-                    
-                except Exception as file_error:
-                    self.root.after(0, self.log_message, f"文件发送失败: {filename} - {str(file_error)}")
+                    self.add_to_history(filename, filesize, receiver_ip, "发送成功", path=file_path)
+                else:
+                    self.root.after(0, self.log_message, f"文件发送失败: {filename} - {str(error)}")
                     # 添加失败记录到历史
-                    self.root.after(0, lambda fn=filename, fs=filesize: self.add_to_history(fn, fs, receiver_ip, "发送失败"))
+                    self.add_to_history(filename, filesize, receiver_ip, "发送失败", path=file_path)
             
-            # 刷新历史记录显示
-            self.root.after(0, self.refresh_history)
+            try:
+                send_batch(
+                    self.connection,
+                    file_paths,
+                    stream_count=stream_count,
+                    progress=self.progress_tracker,
+                    should_continue=lambda: self.is_sending,
+                    on_file_done=on_file_done,
+                    log=lambda message: self.root.after(0, self.log_message, message),
+                    delta=delta
+                )
+            finally:
+                self.progress_tracker.finish()
+                
+                # 本批次的记录插入到历史记录列表顶部
+                self.root.after(0, self.history_view.show_new)
             
-            # 发送批量传输结束消息
             if self.is_sending:
-                batch_end = BatchEndMessage()
-                self.client_socket.send(pack_message(batch_end))
-                
                 self.root.after(0, self.on_send_complete)
             
         except Exception as e:
             self.root.after(0, self.on_send_error, str(e))
     
-    def update_progress(self, value, text):
-        """更新进度条"""
-        self.progress['value'] = value
-        self.progress_label.config(text=text)
+    def poll_progress(self):
+        """按固定频率从进度计数器刷新进度条，显示历史记录写入线程的消息"""
+        if self.progress_tracker.active:
+            snapshot = self.progress_tracker.snapshot()
+            self.progress['value'] = snapshot.percent
+            self.progress_label.config(text=snapshot.describe("发送"))
+        while not self.history_messages.empty():
+            self.log_message(self.history_messages.get())
+        self.root.after(PROGRESS_POLL_INTERVAL, self.poll_progress)
     
     def on_send_complete(self):
         """发送完成回调"""
@@ -694,11 +708,18 @@ class SenderUI:
     def on_send_error(self, error_msg):
         """发送错误回调"""
         self.is_sending = False
+        self.progress_tracker.finish()
         self.status_label.config(text="状态: 发送失败", foreground="red")
         self.send_button.config(state=tk.NORMAL)
         self.disconnect_button.config(state=tk.NORMAL)
         
         self.log_message(f"发送失败: {error_msg}")
+        
+        if self.connection and self.connection.broken:
+            # 连接已中断，重新连接后再次发送会从断点继续
+            self.disconnect()
+            self.log_message("重新连接后再次发送，已接收的部分将从断点继续传输")
+        
         messagebox.showerror("发送失败", error_msg)
     
     def get_available_ips(self):
@@ -742,9 +763,22 @@ class SenderUI:
         
         return sorted(ips, key=lambda x: x.split(' ')[0])
     
+    def load_available_ips_async(self):
+        """在后台线程中枚举网卡（导入psutil较慢），完成后填入下拉菜单"""
+        def worker():
+            ips = self.get_available_ips()
+            self.root.after(0, self.set_available_ips, ips)
+        
+        threading.Thread(target=worker, daemon=True).start()
+    
     def refresh_available_ips(self):
         """刷新可用IP地址列表"""
-        self.available_ips = self.get_available_ips()
+        self.set_available_ips(self.get_available_ips())
+        self.log_message(f"已刷新IP地址列表，共找到 {len(self.available_ips)} 个可用地址")
+    
+    def set_available_ips(self, ips):
+        """更新下拉菜单中的IP地址"""
+        self.available_ips = ips
         self.ip_combo['values'] = self.available_ips
         
         # 保持当前选择的IP（如果仍然可用）
@@ -761,8 +795,6 @@ class SenderUI:
         # 如果当前IP不在列表中，选择第一个
         if not found and self.available_ips:
             self.ip_combo.current(0)
-        
-        self.log_message(f"已刷新IP地址列表，共找到 {len(self.available_ips)} 个可用地址")
     
     def auto_fill_local_ip(self):
         """自动填充本地IP地址到接收端IP输入框"""
@@ -785,16 +817,23 @@ class SenderUI:
         if self.is_sending:
             if messagebox.askokcancel("退出", "正在传输文件，确定要退出吗？"):
                 self.is_sending = False
-                if self.client_socket:
-                    self.client_socket.close()
-                self.root.destroy()
-        elif self.client_socket:
+                if self.connection:
+                    self.connection.close()
+                self.close_window()
+        elif self.connection:
             if messagebox.askokcancel("退出", "已连接到接收端，确定要退出吗？"):
-                if self.client_socket:
-                    self.client_socket.close()
-                self.root.destroy()
+                if self.connection:
+                    self.connection.close()
+                self.close_window()
         else:
-            self.root.destroy()
+            self.close_window()
+    
+    def close_window(self):
+        """停止扫描，写入剩余的历史记录后关闭窗口"""
+        for scanner in self.scanners:
+            scanner.cancel()
+        self.history_db.close()
+        self.root.destroy()
 
 def main():
     root = TkinterDnD.Tk()